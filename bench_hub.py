@@ -0,0 +1,64 @@
+"""Count PacketIns per forwarded frame for controller_hub's two modes.
+
+    python bench_hub.py --frames 5000
+"""
+
+import argparse
+import random
+import time
+
+from controller_hub import SimpleSwitch13
+from fake_datapath import FakeDatapath, build_frame
+
+
+def run(mode, frames, hosts, seed):
+    SimpleSwitch13.packet_in_rate = 0
+    app = SimpleSwitch13()
+    app.hub_mode = mode
+    # every frame is meant to reach the handler, lift the PacketIn limits
+    app.guard.src_rate = app.guard.port_rate = float('inf')
+    datapath = FakeDatapath(ports=range(1, hosts + 1))
+    datapath.attach(app)
+
+    macs = ['00:00:00:00:00:%02x' % i for i in range(1, hosts + 1)]
+    rnd = random.Random(seed)
+    workload = []
+    for _ in range(frames):
+        src, dst = rnd.sample(range(hosts), 2)
+        workload.append((src + 1, build_frame(macs[src], macs[dst])))
+
+    start = time.perf_counter()
+    for in_port, data in workload:
+        datapath.receive(in_port, data)
+    elapsed = time.perf_counter() - start
+
+    return {
+        'mode': mode,
+        'frames': frames,
+        'packet_ins': datapath.packet_ins,
+        'packet_ins_per_frame': datapath.packet_ins / float(frames),
+        'controller_msgs': len(datapath.sent),
+        'frames_per_sec': frames / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=5000)
+    parser.add_argument('--hosts', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print('%-10s %8s %10s %14s %10s %12s' % ('mode', 'frames', 'packet_ins',
+                                              'pkt_in/frame', 'ctrl_msgs',
+                                              'frames/sec'))
+    for mode in ('reactive', 'proactive'):
+        r = run(mode, args.frames, args.hosts, args.seed)
+        print('%-10s %8d %10d %14.3f %10d %12.0f' % (
+            r['mode'], r['frames'], r['packet_ins'],
+            r['packet_ins_per_frame'], r['controller_msgs'],
+            r['frames_per_sec']))
+
+
+if __name__ == '__main__':
+    main()
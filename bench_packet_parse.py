@@ -0,0 +1,81 @@
+"""Compare PacketIn header decoding: full ryu packet.Packet vs pkt_headers.
+
+    python bench_packet_parse.py --events 50000
+"""
+
+import argparse
+import time
+
+from ryu.lib.packet import packet
+from ryu.lib.packet import ethernet
+from ryu.lib.packet import ether_types
+from ryu.lib.packet import arp
+from ryu.lib.packet import ipv4
+
+import pkt_headers
+from fake_datapath import build_frame, build_arp
+
+
+def workload():
+    frames = [
+        build_arp('00:00:00:00:00:01', '10.0.0.1', '10.0.0.42'),
+        build_frame('00:00:00:00:00:01', '00:00:00:00:00:04',
+                    '10.0.0.1', '10.0.0.4', proto='icmp'),
+        build_frame('00:00:00:00:00:02', '00:00:00:00:00:05',
+                    '10.0.0.2', '10.0.0.5', proto='tcp', payload=b'x' * 1400),
+        build_frame('00:00:00:00:00:03', '00:00:00:00:00:04',
+                    '10.0.0.3', '10.0.0.4', proto='udp', payload=b'x' * 512),
+        build_frame('00:00:00:00:00:01', '00:00:00:00:00:02'),
+    ]
+    return frames
+
+
+# what the apps used to do on every PacketIn
+def old_path(data):
+    pkt = packet.Packet(data)
+    eth = pkt.get_protocols(ethernet.ethernet)[0]
+    if eth.ethertype == ether_types.ETH_TYPE_IP:
+        ip = pkt.get_protocol(ipv4.ipv4)
+        return eth.src, eth.dst, ip.src, ip.dst
+    if eth.ethertype == ether_types.ETH_TYPE_ARP:
+        arp_obj = pkt.get_protocol(arp.arp)
+        return eth.src, eth.dst, arp_obj.src_ip, arp_obj.dst_ip
+    return eth.src, eth.dst, None, None
+
+
+def new_path(data):
+    hdr = pkt_headers.parse(data)
+    if hdr.ethertype == ether_types.ETH_TYPE_IP:
+        return hdr.src, hdr.dst, hdr.ipv4_src, hdr.ipv4_dst
+    if hdr.ethertype == ether_types.ETH_TYPE_ARP:
+        return hdr.src, hdr.dst, hdr.arp_src_ip, hdr.arp_dst_ip
+    return hdr.src, hdr.dst, None, None
+
+
+def measure(fn, frames, events):
+    start = time.perf_counter()
+    n = len(frames)
+    for i in range(events):
+        fn(frames[i % n])
+    return events / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=50000)
+    args = parser.parse_args()
+
+    frames = workload()
+    for data in frames:
+        assert old_path(data) == new_path(data), data
+
+    old = measure(old_path, frames, args.events)
+    new = measure(new_path, frames, args.events)
+    print('%-8s %14s' % ('path', 'events/sec'))
+    print('%-8s %14.0f' % ('packet', old))
+    print('%-8s %14.0f' % ('headers', new))
+    print('speedup  %13.1fx' % (new / old))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,341 @@
+"""Replay synthetic or captured PacketIn workloads against the apps.
+
+Each run attaches one app to a FakeDatapath and feeds it a workload as
+EventOFPPacketIn events, timing every call of the app's PacketIn handler
+until its messages are sent. It reports p50/p99 latency, events/sec, the
+FlowMods and PacketOuts it sent, the control-channel bytes per PacketIn
+(both ways) and, from a second untimed pass under tracemalloc, peak
+memory. --json also has the app's own per-stage timings (see
+instrument).
+
+With --buffers the switch buffers frames and the PacketIns carry only as
+much as the app's table-miss flow asks for (see packet_buffer); --payload
+makes the IPv4 frames big enough for that to matter.
+
+Workloads:
+
+    arp_storm      ARP requests between random hosts
+    host_learning  IPv4 frames from a large, rotating set of hosts
+    blocked        frames between pairs blocked by firewall_rules.json,
+                   mixed with allowed ones
+    vip            TCP connections from clients to the load balancer's VIP
+    pcap           frames from --pcap FILE, in order
+
+Without --app/--workload every app runs its usual workloads. --json
+writes the results for later runs to --compare against:
+
+    python bench_replay.py --json base.json
+    python bench_replay.py --app firewall_monitor --compare base.json
+    python bench_replay.py --app learning_switch --workload pcap \\
+        --pcap capture.pcap
+    python bench_replay.py --app firewall_monitor --workload blocked \\
+        --payload 1400 --buffers 256
+"""
+
+import argparse
+import importlib
+import json
+import logging
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+from ryu.lib import pcaplib
+
+from fake_datapath import FakeDatapath, build_arp, build_frame, make_packet_in
+from firewall_rules import load_rules
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_RUNS = [
+    ('controller_hub', 'arp_storm'),
+    ('learning_switch', 'arp_storm'),
+    ('learning_switch', 'host_learning'),
+    ('firewall_monitor', 'arp_storm'),
+    ('firewall_monitor', 'blocked'),
+    ('load_balancer', 'vip'),
+    ('pipeline_switch', 'host_learning'),
+    ('pipeline_switch', 'vip'),
+]
+
+
+def _mac(i):
+    i += 1
+    return '00:00:00:00:%02x:%02x' % (i // 256 % 256, i % 256)
+
+
+def _ip(i):
+    return '10.0.%d.%d' % (i // 250 % 256, i % 250 + 1)
+
+
+def arp_storm(rnd, events, ports):
+    frames = []
+    for _ in range(events):
+        src, dst = rnd.sample(range(ports), 2)
+        frames.append((src + 1, build_arp(_mac(src), _ip(src), _ip(dst))))
+    return frames
+
+
+def host_learning(rnd, events, ports, payload, hosts=2000):
+    frames = []
+    for i in range(events):
+        src = i % hosts
+        dst = rnd.randrange(hosts)
+        frames.append((src % ports + 1,
+                       build_frame(_mac(src), _mac(dst), _ip(src), _ip(dst),
+                                   payload=payload)))
+    return frames
+
+
+def blocked(rnd, events, ports, payload):
+    rules = load_rules(os.path.join(HERE, 'firewall_rules.json'))
+    pairs = [(r.ipv4_src.split('/')[0], r.ipv4_dst.split('/')[0])
+             for r in rules if r.ipv4_src and r.ipv4_dst]
+    frames = []
+    for _ in range(events):
+        if rnd.random() < 0.5:
+            src_ip, dst_ip = rnd.choice(pairs)
+        else:
+            src_ip, dst_ip = '10.0.1.%d' % rnd.randint(1, 200), '10.0.0.3'
+        src = int(src_ip.split('.')[-1]) - 1
+        dst = int(dst_ip.split('.')[-1]) - 1
+        frames.append((src % ports + 1,
+                       build_frame(_mac(src), _mac(dst), src_ip, dst_ip,
+                                   proto='tcp', payload=payload)))
+    return frames
+
+
+def vip(rnd, events, ports, payload, app_cls):
+    # back-ends sit on port 1, clients on the others
+    frames = []
+    for _ in range(events):
+        client = rnd.randrange(64)
+        frames.append((client % (ports - 1) + 2,
+                       build_frame(_mac(100 + client), app_cls.virtual_mac,
+                                   '10.0.1.%d' % (client + 1),
+                                   app_cls.virtual_ip, proto='tcp',
+                                   src_port=rnd.randint(1024, 65535),
+                                   payload=payload)))
+    return frames
+
+
+def pcap(path, ports):
+    frames = []
+    with open(path, 'rb') as f:
+        for _ts, data in pcaplib.Reader(f):
+            # a stable port per source MAC, the capture does not say
+            frames.append((sum(data[6:12]) % ports + 1, bytes(data)))
+    return frames
+
+
+def save_pcap(path, frames):
+    with open(path, 'wb') as f:
+        writer = pcaplib.Writer(f)
+        for i, (_in_port, data) in enumerate(frames):
+            writer.write_pkt(data, ts=i / 1000.0)
+
+
+def make_workload(name, app_cls, events, ports, seed, pcap_path=None,
+                  payload=0):
+    rnd = random.Random(seed)
+    payload = b'\0' * payload
+    if name == 'arp_storm':
+        return arp_storm(rnd, events, ports)
+    if name == 'host_learning':
+        return host_learning(rnd, events, ports, payload)
+    if name == 'blocked':
+        return blocked(rnd, events, ports, payload)
+    if name == 'vip':
+        return vip(rnd, events, ports, payload, app_cls)
+    if name == 'pcap':
+        return pcap(pcap_path, ports)
+    raise ValueError('unknown workload %r' % name)
+
+
+def _percentile(samples, q):
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def _miss_max_len(datapath):
+    """max_len the table-miss flow asks the switch to send up."""
+    ofproto = datapath.ofproto
+    entry = datapath.lookup(0, {})
+    for inst in entry.instructions if entry is not None else []:
+        for action in getattr(inst, 'actions', []):
+            if getattr(action, 'port', None) == ofproto.OFPP_CONTROLLER:
+                return action.max_len
+    return None
+
+
+def replay(app_cls, frames, ports, timed=True, buffers=0):
+    app = app_cls()
+    # pipeline_switch keeps it in its VIP stage
+    health = getattr(getattr(app, 'vip', app), 'health', None)
+    if health is not None:
+        # nothing answers health probes here, keep the back-ends up
+        health.max_missed = float('inf')
+    # replays run far over the PacketIn limits, time the handler instead
+    app.guard.src_rate = app.guard.port_rate = float('inf')
+    datapath = FakeDatapath(ports=range(1, ports + 1))
+    datapath.n_buffers = buffers
+    datapath.attach(app)
+    sent_before = len(datapath.sent)
+    bytes_before = datapath.sent_bytes
+
+    handler = app._packet_in_handler
+    max_len = _miss_max_len(datapath)
+    packet_in_bytes = 0
+    latencies = []
+    clock = time.perf_counter
+    elapsed = 0
+    for in_port, data in frames:
+        # built as it arrives, the switch's buffers are taken per event
+        ev = make_packet_in(datapath, in_port, data, max_len=max_len)
+        packet_in_bytes += ev.msg.msg_len
+        t0 = clock()
+        handler(ev)
+        datapath.settle()
+        took = clock() - t0
+        elapsed += took
+        if timed:
+            latencies.append(took)
+
+    sent = datapath.sent[sent_before:]
+    parser = datapath.ofproto_parser
+    histograms = app.instr.histograms
+    return latencies, elapsed, {
+        'flow_mods': sum(isinstance(m, parser.OFPFlowMod) for m in sent),
+        'packet_outs': sum(isinstance(m, parser.OFPPacketOut) for m in sent),
+        'packet_in_bytes': packet_in_bytes,
+        'ctrl_bytes': datapath.sent_bytes - bytes_before,
+        # where the handler's time went, see instrument
+        'stages': dict((name[len('stage.'):], {
+            'count': h.count, 'p50_us': h.percentile(0.50),
+            'p99_us': h.percentile(0.99)})
+            for name, h in histograms.items() if name.startswith('stage.')),
+    }
+
+
+def run(app_name, workload, events, ports, seed, pcap_path=None,
+        memory=True, payload=0, buffers=0):
+    app_cls = importlib.import_module(app_name).SimpleSwitch13
+    frames = make_workload(workload, app_cls, events, ports, seed, pcap_path,
+                           payload)
+
+    latencies, elapsed, counts = replay(app_cls, frames, ports,
+                                        buffers=buffers)
+    latencies.sort()
+    result = {
+        'app': app_name,
+        'workload': workload,
+        'events': len(frames),
+        'events_per_sec': len(frames) / elapsed,
+        'p50_us': _percentile(latencies, 0.50) * 1e6,
+        'p99_us': _percentile(latencies, 0.99) * 1e6,
+        'max_us': latencies[-1] * 1e6,
+    }
+    result.update(counts)
+    # what a PacketIn costs on the control channel, up and down
+    result['bytes_per_event'] = (counts['packet_in_bytes'] +
+                                 counts['ctrl_bytes']) / float(len(frames))
+
+    if memory:
+        tracemalloc.start()
+        replay(app_cls, frames, ports, timed=False, buffers=buffers)
+        result['peak_kb'] = tracemalloc.get_traced_memory()[1] / 1024.0
+        tracemalloc.stop()
+    return result
+
+
+def compare(results, base_path, out=sys.stdout):
+    with open(base_path) as f:
+        base = dict(((r['app'], r['workload']), r)
+                    for r in json.load(f)['results'])
+    print('\n%-18s %-14s %14s %10s %10s' % (
+        'app', 'workload', 'events/sec x', 'p99 x', 'bytes x'), file=out)
+    for r in results:
+        b = base.get((r['app'], r['workload']))
+        if b is None:
+            continue
+        print('%-18s %-14s %14.2f %10.2f %10s' % (
+            r['app'], r['workload'], r['events_per_sec'] / b['events_per_sec'],
+            r['p99_us'] / b['p99_us'],
+            '%.2f' % (r['bytes_per_event'] / b['bytes_per_event'])
+            if 'bytes_per_event' in b else '-'), file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--app', action='append',
+                        help='learning_switch, controller_hub, '
+                        'firewall_monitor, load_balancer or '
+                        'pipeline_switch')
+    parser.add_argument('--workload', action='append')
+    parser.add_argument('--events', type=int, default=5000)
+    parser.add_argument('--ports', type=int, default=16)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--pcap', help='capture replayed by --workload pcap')
+    parser.add_argument('--payload', type=int, default=0,
+                        help='bytes of payload in IPv4 frames')
+    parser.add_argument('--buffers', type=int, default=0,
+                        help='packet buffers of the switch, 0 for none')
+    parser.add_argument('--save-pcap', metavar='FILE',
+                        help='write the first workload as a capture and exit')
+    parser.add_argument('--no-memory', action='store_true')
+    parser.add_argument('--json', metavar='FILE',
+                        help="'-' for stdout, the table then goes to stderr")
+    parser.add_argument('--compare', metavar='FILE')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    runs = [(a, w) for a, w in DEFAULT_RUNS
+            if (not args.app or a in args.app) and
+            (not args.workload or w in args.workload)]
+    if not runs:
+        runs = [(a, w) for a in args.app or ['learning_switch']
+                for w in args.workload or ['arp_storm']]
+
+    if args.save_pcap:
+        app_name, workload = runs[0]
+        app_cls = importlib.import_module(app_name).SimpleSwitch13
+        save_pcap(args.save_pcap, make_workload(
+            workload, app_cls, args.events, args.ports, args.seed,
+            payload=args.payload))
+        return
+
+    # stdout is left to the JSON alone if it goes there
+    out = sys.stderr if args.json == '-' else sys.stdout
+    results = []
+    print('%-18s %-14s %7s %10s %8s %8s %8s %8s %8s %9s' % (
+        'app', 'workload', 'events', 'events/s', 'p50 us', 'p99 us',
+        'flowmods', 'pktouts', 'B/event', 'peak kB'), file=out)
+    for app_name, workload in runs:
+        r = run(app_name, workload, args.events, args.ports, args.seed,
+                args.pcap, memory=not args.no_memory, payload=args.payload,
+                buffers=args.buffers)
+        results.append(r)
+        print('%-18s %-14s %7d %10.0f %8.1f %8.1f %8d %8d %8.0f %9s' % (
+            r['app'], r['workload'], r['events'], r['events_per_sec'],
+            r['p50_us'], r['p99_us'], r['flow_mods'], r['packet_outs'],
+            r['bytes_per_event'],
+            '%.0f' % r['peak_kb'] if 'peak_kb' in r else '-'), file=out)
+
+    if args.json:
+        doc = json.dumps({'events': args.events, 'ports': args.ports,
+                          'seed': args.seed, 'payload': args.payload,
+                          'buffers': args.buffers, 'results': results},
+                         indent=2)
+        if args.json == '-':
+            print(doc)
+        else:
+            with open(args.json, 'w') as f:
+                f.write(doc + '\n')
+    if args.compare:
+        compare(results, args.compare, out)
+
+
+if __name__ == '__main__':
+    main()
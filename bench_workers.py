@@ -0,0 +1,102 @@
+"""PacketIn events/sec of learning_switch with sharded packet workers.
+
+Every switch gets a stream of ARP requests (answered by the proxy) and
+frames to unknown destinations (flooded), fed straight into the PacketIn
+handler. The run ends once every reply has reached its fake switch.
+Workers are processes, so scaling needs as many free cores; 'inline' is
+the same sharded code on the event loop.
+
+    python bench_workers.py --switches 8 --events 20000 --workers 0 1 2 4
+"""
+
+import argparse
+import logging
+import multiprocessing
+import random
+import time
+
+from ryu.lib import hub
+
+from learning_switch import SimpleSwitch13
+from fake_datapath import FakeDatapath, build_arp, build_frame, make_packet_in
+
+
+def workload(switches, hosts, events, seed):
+    rnd = random.Random(seed)
+    ips = ['10.0.%d.%d' % (i // 250, i % 250 + 1) for i in range(hosts)]
+    macs = ['00:00:00:00:%02x:%02x' % (i // 256, i % 256)
+            for i in range(hosts)]
+    frames = []
+    for _ in range(events):
+        dpid = rnd.randint(1, switches)
+        src, dst = rnd.sample(range(hosts), 2)
+        if rnd.random() < 0.5:
+            data = build_arp(macs[src], ips[src], ips[dst])
+        else:
+            data = build_frame(macs[src], '02:ff:00:00:00:%02x' % (dst % 256),
+                               ips[src], ips[dst])
+        frames.append((dpid, src % 4 + 1, data))
+    return frames
+
+
+def run(workers, switches, hosts, frames):
+    SimpleSwitch13.flow_strategy = 'exact'
+    SimpleSwitch13.packet_workers = workers
+    app = SimpleSwitch13()
+    app.guard.src_rate = app.guard.port_rate = float('inf')
+    datapaths = {}
+    for dpid in range(1, switches + 1):
+        datapaths[dpid] = FakeDatapath(dpid, ports=(1, 2, 3, 4))
+        datapaths[dpid].attach(app)
+    while not app.shards.idle():
+        hub.sleep(0)
+    sent_before = sum(len(dp.sent) for dp in datapaths.values())
+
+    events = [make_packet_in(datapaths[dpid], in_port, data)
+              for dpid, in_port, data in frames]
+    start = time.perf_counter()
+    for ev in events:
+        app._packet_in_handler(ev)
+    while not app.shards.idle():
+        hub.sleep(0)
+    elapsed = time.perf_counter() - start
+    app.shards.stop()
+
+    return {
+        'workers': workers,
+        'events': len(frames),
+        'replies': sum(len(dp.sent) for dp in datapaths.values()) -
+        sent_before,
+        'batches': app.shards.stats['batches'],
+        'events_per_sec': len(frames) / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--switches', type=int, default=8)
+    parser.add_argument('--hosts', type=int, default=64)
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[0, 1, 2, 4])
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    frames = workload(args.switches, args.hosts, args.events, args.seed)
+
+    print('%d cpus, %d switches' % (multiprocessing.cpu_count(),
+                                    args.switches))
+    print('%-8s %8s %8s %8s %12s %8s' % ('workers', 'events', 'replies',
+                                         'batches', 'events/sec', 'speedup'))
+    base = None
+    for workers in args.workers:
+        r = run(workers, args.switches, args.hosts, frames)
+        base = base or r['events_per_sec']
+        print('%-8s %8d %8d %8d %12.0f %8.2f' % (
+            r['workers'] or 'inline', r['events'], r['replies'],
+            r['batches'], r['events_per_sec'], r['events_per_sec'] / base))
+
+
+if __name__ == '__main__':
+    main()
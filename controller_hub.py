@@ -3,27 +3,128 @@ from ryu.controller import ofp_event
 from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER
 from ryu.controller.handler import set_ev_cls
 from ryu.ofproto import ofproto_v1_3
-from ryu.lib.packet import packet
-from ryu.lib.packet import ethernet
 from ryu.lib.packet import ether_types
+from ryu.lib.packet import arp
 
+from flow_pipeline import FlowProgrammer, FlowProgrammerEvents
+from flow_sync import FlowReconciler
+from host_tracker import HostTracker
+from instrument import Instrumentation
+from packet_buffer import PacketBuffering
+from packet_in_guard import PacketInGuard
+from state_store import StateStore
 
-class SimpleSwitch13(app_manager.RyuApp):
+
+class SimpleSwitch13(FlowProgrammerEvents, app_manager.RyuApp):
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
 
+    # 'proactive' installs a FLOOD entry in every switch at connect time so
+    # frames are forwarded without involving the controller; 'reactive'
+    # sends every frame up and floods it with a PacketOut. In both modes
+    # ARP requests go to the controller, which answers them from its host
+    # cache and only floods the ones for unknown hosts.
+    hub_mode = 'proactive'
+    # PacketIns/sec a switch may send, enforced by a meter where the switch
+    # has them; single sources are policed by the controller, see
+    # packet_in_guard. 0 leaves the switches unmetered.
+    packet_in_rate = 1000
+    # bytes of a table-miss frame sent up while the switch buffers the
+    # rest, None for whole frames, see packet_buffer
+    miss_send_len = 128
+    # path prefix of the host cache saved every state_interval seconds and
+    # restored on start while under state_max_age seconds old, see
+    # state_store; None starts empty
+    state_file = None
+    state_interval = 5
+    state_max_age = 300
+    # timing histograms of the event handlers and PacketIn stages, written
+    # to instrument_file every instrument_interval seconds if set, and one
+    # PacketIn in log_every logged, see instrument. SIGUSR1 and SIGUSR2
+    # profile the running controller.
+    instrument_file = None
+    instrument_interval = 10
+    log_every = 100
+
     def __init__(self, *args, **kwargs):
         super(SimpleSwitch13, self).__init__(*args, **kwargs)
         self.mac_to_port = {}
+        self.flow_programmer = FlowProgrammer()
+        self.hosts = HostTracker()
+        self.guard = PacketInGuard(self, self.packet_in_rate)
+        self.buffering = PacketBuffering(self, self.miss_send_len)
+        self.reconciler = FlowReconciler(self)
+        self.instr = Instrumentation(self, self.instrument_file,
+                                     self.instrument_interval, self.log_every)
+        self.instr.instrument(self)
+        self.instr.start()
+        self.store = None
+        if self.state_file is not None:
+            self.store = StateStore(self, self.state_file, self.state_interval,
+                                    max_age=self.state_max_age)
+            self.restore_state(self.store.load())
+            self.store.start()
 
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
     def switch_features_handler(self, ev):
         datapath = ev.msg.datapath
+        self.instr.watch(datapath)
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        self.flow_programmer.reset(datapath)
+        self.reconciler.switch_connected(datapath)
+        self.guard.switch_connected(datapath)
+        self.buffering.switch_features(ev.msg)
+        self._install_table_miss(datapath)
+
+        if self.hub_mode == 'proactive':
+            # LLDP is never flooded by the hub, drop it in the switch
+            match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_LLDP)
+            self.add_flow(datapath, 2, match, [])
+
+            match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_ARP,
+                                    arp_op=arp.ARP_REQUEST)
+            actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,
+                                              ofproto.OFPCML_NO_BUFFER)]
+            self.add_flow(datapath, 2, match, actions)
+
+            # replies are flooded as before, the copy teaches the cache
+            match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_ARP,
+                                    arp_op=arp.ARP_REPLY)
+            actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,
+                                              ofproto.OFPCML_NO_BUFFER),
+                       parser.OFPActionOutput(ofproto.OFPP_FLOOD)]
+            self.add_flow(datapath, 2, match, actions)
+
+            match = parser.OFPMatch()
+            actions = [parser.OFPActionOutput(ofproto.OFPP_FLOOD)]
+            self.add_flow(datapath, 1, match, actions)
+
+    def reconcile(self, datapath, stats):
+        if self.hub_mode == 'proactive':
+            return []
+        # left by a proactive run, they would keep frames from coming up
+        return [stat for stat in stats if stat.priority in (1, 2)]
+
+    def dump_state(self):
+        return {'hosts': self.hosts.dump()}
+
+    def restore_state(self, tables):
+        self.hosts.restore(tables.get('hosts', {}))
+
+    def stop(self):
+        self.instr.close()
+        if self.store is not None:
+            self.store.close()
+        super(SimpleSwitch13, self).stop()
+
+    def _install_table_miss(self, datapath):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
 
         match = parser.OFPMatch()
         actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,
-                                          ofproto.OFPCML_NO_BUFFER)]
+                                          self.buffering.max_len(datapath))]
         self.add_flow(datapath, 0, match, actions)
 
     def add_flow(self, datapath, priority, match, actions, buffer_id=None):
@@ -39,7 +140,17 @@ class SimpleSwitch13(app_manager.RyuApp):
         else:
             mod = parser.OFPFlowMod(datapath=datapath, priority=priority,
                                     match=match, instructions=inst)
-        datapath.send_msg(mod)
+        self.flow_programmer.submit(datapath, self.guard.meter(datapath, mod))
+
+    @set_ev_cls(ofp_event.EventOFPMeterFeaturesStatsReply,
+                [CONFIG_DISPATCHER, MAIN_DISPATCHER])
+    def _meter_features_reply_handler(self, ev):
+        self.guard.meter_features_reply(ev.msg)
+
+    @set_ev_cls(ofp_event.EventOFPFlowStatsReply,
+                [CONFIG_DISPATCHER, MAIN_DISPATCHER])
+    def _flow_stats_reply_handler(self, ev):
+        self.reconciler.flow_stats_reply(ev.msg)
 
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def _packet_in_handler(self, ev):
@@ -52,13 +163,23 @@ class SimpleSwitch13(app_manager.RyuApp):
         parser = datapath.ofproto_parser
         in_port = msg.match['in_port']
 
-        pkt = packet.Packet(msg.data)
-        eth = pkt.get_protocols(ethernet.ethernet)[0]
+        eth = self.instr.parse(msg.data)
 
-        if eth.ethertype == ether_types.ETH_TYPE_LLDP:
+        if eth is None or eth.ethertype == ether_types.ETH_TYPE_LLDP:
+            return
+        if not self.guard.admit(datapath, in_port, eth.src):
+            return
+        if not self.buffering.complete(msg):
+            self._install_table_miss(datapath)
+            return
+
+        self.hosts.learn(datapath.id, in_port, eth)
+        if self.hosts.arp_proxy(datapath, in_port, eth):
+            self.buffering.release(datapath, msg)
+            return
+        if self.hub_mode == 'proactive' and \
+                eth.arp_opcode == arp.ARP_REPLY:
             return
-        dst = eth.dst
-        src = eth.src
 
         out_port = ofproto.OFPP_FLOOD
 
@@ -70,4 +191,4 @@ class SimpleSwitch13(app_manager.RyuApp):
 
         out = parser.OFPPacketOut(datapath=datapath, buffer_id=msg.buffer_id,
                                   in_port=in_port, actions=actions, data=data)
-        datapath.send_msg(out)
\ No newline at end of file
+        self.flow_programmer.send(datapath, out)
\ No newline at end of file
@@ -1,7 +1,58 @@
+"""Mininet networks for the controller apps, interactive or scripted.
+
+    sudo python custom_topology.py
+    sudo python custom_topology.py --topo leafspine --leaves 8 --hosts 64 \\
+        --run arp,ping,iperf --results leafspine.json
+
+LearningSwitch is the fixed network the apps' defaults (the load
+balancer's back-ends h4 and h5, firewall_rules.json) are written for. The
+generated ones name hosts h1..hN with host_mac(i) and host_ip(i), so h1 to
+h5 keep the addresses they have there, and spread them evenly over their
+edge switches. host_ip() leaves out the apps' VIP, 10.0.0.42: h42 and the
+hosts after it are numbered one address on.
+
+    linear     --switches in a chain
+    tree       --depth levels of switches, --fanout children each, hosts on
+               the leaves
+    fattree    k pods of k/2 edge and k/2 aggregation switches under
+               (k/2)^2 core switches, --k even
+    leafspine  every one of --leaves linked to every one of --spines
+
+fattree and leafspine have loops; only learning_switch's 'path' strategy,
+which floods along discovered edge ports, copes with them.
+
+Without --run the Mininet CLI starts. --run takes a comma-separated list
+of phases, run in order once the controller has had --settle seconds to
+discover the network:
+
+    ping   ping matrix over --pairs host pairs, 2 pings each: the first
+           one's RTT minus the second's is taken as the flow setup time
+    arp    ARP sweep: every host's cache flushed, then --pairs ARP
+           resolutions at once
+    iperf  TCP throughput of --iperf-pairs pairs, one after the other
+    vip    every host but the --backends fetches http://VIP/
+           --vip-requests times from an HTTP server on each back-end
+           (needs curl and python3 on the hosts)
+
+Each phase's results go to --results as JSON. With --instrument, the
+path of the controller's instrument_file (see instrument), they also have
+the PacketIns the controller handled during the phase; its
+instrument_interval should be short, the counts are read from the file
+once the controller has rewritten it after the phase.
+"""
+
+import argparse
+import functools
+import json
+import random
+import re
+import time
+
 from mininet.topo import Topo
 from mininet.net import Mininet
-from mininet.node import RemoteController
+from mininet.node import OVSSwitch, RemoteController
 from mininet.cli import CLI
+from mininet.log import info, setLogLevel
 
 
 class LearningSwitch(Topo):
@@ -26,12 +77,302 @@ class LearningSwitch(Topo):
         self.addLink(h5, s2)
 
 
-if __name__ == '__main__':
-    # setLogLevel('info')
-    topo = LearningSwitch()
-    c1 = RemoteController('c1', ip='127.0.0.1')
-    net = Mininet(topo=topo, controller=c1)
+def host_mac(i):
+    return '00:00:%02x:%02x:%02x:%02x' % (i >> 24 & 0xff, i >> 16 & 0xff,
+                                          i >> 8 & 0xff, i & 0xff)
+
+
+VIP = '10.0.0.42'
+
+
+def host_ip(i):
+    if i >= 42:
+        # VIP is nobody's address
+        i += 1
+    return '10.%d.%d.%d' % (i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff)
+
+
+class _Generated(Topo):
+    def new_switch(self):
+        # Mininet takes the dpid from the digits of the name
+        return self.addSwitch('s%d' % (len(self.switches()) + 1))
+
+    def add_hosts(self, n, edges):
+        for i in range(1, n + 1):
+            host = self.addHost('h%d' % i, mac=host_mac(i),
+                                ip='%s/8' % host_ip(i))
+            # h1, h2, ... fill the first edge switch, then the next
+            self.addLink(host, edges[(i - 1) * len(edges) // n])
+
+
+class Linear(_Generated):
+    def build(self, switches=2, hosts=None):
+        chain = [self.new_switch() for _ in range(switches)]
+        for a, b in zip(chain, chain[1:]):
+            self.addLink(a, b)
+        self.add_hosts(hosts or 2 * switches, chain)
+
+
+class Tree(_Generated):
+    def build(self, depth=2, fanout=2, hosts=None):
+        level = [self.new_switch()]
+        for _ in range(depth - 1):
+            children = []
+            for parent in level:
+                for _ in range(fanout):
+                    child = self.new_switch()
+                    self.addLink(parent, child)
+                    children.append(child)
+            level = children
+        self.add_hosts(hosts or fanout * len(level), level)
+
+
+class FatTree(_Generated):
+    def build(self, k=4, hosts=None):
+        if k % 2:
+            raise ValueError('fat-tree k must be even, not %d' % k)
+        half = k // 2
+        core = [self.new_switch() for _ in range(half * half)]
+        edges = []
+        for _pod in range(k):
+            aggs = [self.new_switch() for _ in range(half)]
+            pod_edges = [self.new_switch() for _ in range(half)]
+            for j, agg in enumerate(aggs):
+                for c in core[j * half:(j + 1) * half]:
+                    self.addLink(agg, c)
+                for edge in pod_edges:
+                    self.addLink(agg, edge)
+            edges += pod_edges
+        self.add_hosts(hosts or half * len(edges), edges)
+
+
+class LeafSpine(_Generated):
+    def build(self, spines=2, leaves=4, hosts=None):
+        spine = [self.new_switch() for _ in range(spines)]
+        leaf = [self.new_switch() for _ in range(leaves)]
+        for down in leaf:
+            for up in spine:
+                self.addLink(down, up)
+        self.add_hosts(hosts or 2 * leaves, leaf)
+
+
+TOPOS = {
+    'fixed': LearningSwitch,
+    'linear': Linear,
+    'tree': Tree,
+    'fattree': FatTree,
+    'leafspine': LeafSpine,
+}
+
+
+def build_topo(args):
+    if args.topo == 'fixed':
+        return LearningSwitch()
+    params = {'linear': dict(switches=args.switches),
+              'tree': dict(depth=args.depth, fanout=args.fanout),
+              'fattree': dict(k=args.k),
+              'leafspine': dict(spines=args.spines, leaves=args.leaves),
+              }[args.topo]
+    return TOPOS[args.topo](hosts=args.hosts, **params)
+
+
+_RTT = re.compile(r'time=([\d.]+) ms')
+_BANDWIDTH = re.compile(r'([\d.]+) ([KMG]?)bits/sec')
+
+
+def packet_ins(path, since, timeout=30):
+    """PacketIns the controller has handled, from its instrument_file as
+    written after since; None if it is not rewritten within timeout."""
+    deadline = time.time() + timeout
+    while True:
+        try:
+            with open(path) as f:
+                timings = json.load(f)
+        except (OSError, ValueError):
+            timings = None
+        if timings is not None and timings['time'] >= since:
+            handler = timings['histograms'].get('handler._packet_in_handler')
+            return handler['count'] if handler is not None else 0
+        if time.time() > deadline:
+            info('*** %s not rewritten in %ds\n' % (path, timeout))
+            return None
+        time.sleep(0.5)
+
+
+def _pairs(hosts, n, rnd):
+    """n random (src, dst) host pairs, all of them for 0."""
+    pairs = [(a, b) for a in hosts for b in hosts if a is not b]
+    if n and n < len(pairs):
+        pairs = rnd.sample(pairs, n)
+    return pairs
+
+
+def _summary(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    return {'n': len(values), 'p50': values[len(values) // 2],
+            'p99': values[min(len(values) - 1, int(len(values) * 0.99))],
+            'max': values[-1]}
+
+
+def _mbps(bandwidth):
+    match = _BANDWIDTH.search(bandwidth)
+    if match is None:
+        return 0.0
+    return float(match.group(1)) * {'': 1e-6, 'K': 1e-3, 'M': 1.0,
+                                    'G': 1e3}[match.group(2)]
+
+
+def ping_matrix(net, args, rnd):
+    first = []
+    second = []
+    lost = 0
+    for src, dst in _pairs(net.hosts, args.pairs, rnd):
+        rtts = _RTT.findall(src.cmd('ping -c 2 -i 0.2 -W 1 %s' % dst.IP()))
+        if len(rtts) < 2:
+            lost += 1
+            continue
+        first.append(float(rtts[0]))
+        second.append(float(rtts[1]))
+    return {'pairs': len(first) + lost, 'lost': lost,
+            'first_rtt_ms': _summary(first), 'rtt_ms': _summary(second),
+            'flow_setup_ms': _summary([a - b for a, b in zip(first, second)])}
+
+
+def arp_sweep(net, args, rnd):
+    targets = {}
+    for src, dst in _pairs(net.hosts, args.pairs, rnd):
+        targets.setdefault(src, []).append(dst.IP())
+    for host in net.hosts:
+        host.cmd('ip neigh flush all')
+    for src, ips in targets.items():
+        src.sendCmd('for ip in %s; do ping -c 1 -W 1 $ip >/dev/null 2>&1 '
+                    '&& echo ok & done; wait' % ' '.join(ips))
+    resolved = sum(src.waitOutput().count('ok') for src in targets)
+    return {'requests': sum(len(ips) for ips in targets.values()),
+            'resolved': resolved}
+
+
+def iperf_pairs(net, args, rnd):
+    pairs = []
+    for src, dst in _pairs(net.hosts, args.iperf_pairs, rnd):
+        server_bw, _client_bw = net.iperf((src, dst),
+                                          seconds=args.iperf_time)
+        pairs.append({'client': src.name, 'server': dst.name,
+                      'mbps': _mbps(server_bw)})
+    return {'pairs': pairs, 'mbps': _summary([p['mbps'] for p in pairs])}
+
+
+def vip_clients(net, args, rnd):
+    backends = [net.get(name) for name in args.backends.split(',')]
+    clients = [host for host in net.hosts if host not in backends]
+    for backend in backends:
+        backend.cmd('python3 -m http.server 80 >/dev/null 2>&1 &')
+    time.sleep(1)
+    for client in clients:
+        client.sendCmd("for i in $(seq %d); do curl -s -o /dev/null -m 2 "
+                       "-w '%%{http_code} %%{time_connect}\\n' http://%s/; "
+                       "done" % (args.vip_requests, args.vip))
+    connect = []
+    for client in clients:
+        for line in client.waitOutput().splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[0] == '200':
+                connect.append(float(fields[1]) * 1000)
+    for backend in backends:
+        backend.cmd('kill %python3')
+    return {'requests': len(clients) * args.vip_requests, 'ok': len(connect),
+            'connect_ms': _summary(connect)}
+
+
+PHASES = {
+    'ping': ping_matrix,
+    'arp': arp_sweep,
+    'iperf': iperf_pairs,
+    'vip': vip_clients,
+}
+
+
+def run(net, args):
+    rnd = random.Random(args.seed)
+    results = {'topo': args.topo, 'hosts': len(net.hosts),
+               'switches': len(net.switches), 'links': len(net.links),
+               'phases': []}
+    for name in args.run.split(','):
+        info('*** %s\n' % name)
+        if args.instrument:
+            before = packet_ins(args.instrument, time.time())
+        t0 = time.time()
+        result = PHASES[name](net, args, rnd)
+        result['seconds'] = time.time() - t0
+        if args.instrument:
+            after = packet_ins(args.instrument, time.time())
+            result['packet_ins'] = None if None in (before, after) \
+                else after - before
+        result['phase'] = name
+        results['phases'].append(result)
+        info('%s\n' % json.dumps(result, sort_keys=True))
+    with open(args.results, 'w') as f:
+        json.dump(results, f, indent=2)
+        f.write('\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--topo', choices=sorted(TOPOS), default='fixed')
+    parser.add_argument('--hosts', type=int,
+                        help='default: 2 per edge switch, fattree k/2')
+    parser.add_argument('--switches', type=int, default=2)
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--fanout', type=int, default=2)
+    parser.add_argument('--k', type=int, default=4)
+    parser.add_argument('--spines', type=int, default=2)
+    parser.add_argument('--leaves', type=int, default=4)
+    parser.add_argument('--controller', default='127.0.0.1')
+    parser.add_argument('--port', type=int, help="Mininet's default if unset")
+    parser.add_argument('--run', metavar='PHASES',
+                        help=', '.join(sorted(PHASES)))
+    parser.add_argument('--settle', type=float, default=5,
+                        help='seconds to wait before the first phase')
+    parser.add_argument('--pairs', type=int, default=200,
+                        help='ping/arp host pairs, 0 for all')
+    parser.add_argument('--iperf-pairs', type=int, default=4)
+    parser.add_argument('--iperf-time', type=int, default=5)
+    parser.add_argument('--vip', default=VIP)
+    parser.add_argument('--backends', default='h4,h5')
+    parser.add_argument('--vip-requests', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--instrument', metavar='FILE',
+                        help="the controller's instrument_file")
+    parser.add_argument('--results', default='results.json')
+    args = parser.parse_args()
+    if args.run:
+        unknown = set(args.run.split(',')) - set(PHASES)
+        if unknown:
+            parser.error('unknown phases: %s' % ', '.join(sorted(unknown)))
+
+    if args.run:
+        setLogLevel('info')
+    controller = {'ip': args.controller}
+    if args.port is not None:
+        controller['port'] = args.port
+    c1 = RemoteController('c1', **controller)
+    # the apps only speak OpenFlow 1.3
+    switch = functools.partial(OVSSwitch, protocols='OpenFlow13')
+    net = Mininet(topo=build_topo(args), controller=c1, switch=switch)
     net.start()
-    # net.pingAll()
-    CLI(net)
-    net.stop()
+    try:
+        if args.run:
+            time.sleep(args.settle)
+            run(net, args)
+        else:
+            # net.pingAll()
+            CLI(net)
+    finally:
+        net.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,630 @@
+"""Software stand-in for an OpenFlow 1.3 datapath.
+
+FakeDatapath records every message an app sends, keeps a flow table built
+from the FlowMods it receives and can push frames through that table, so
+PacketIn-driven apps can be exercised and benchmarked without Mininet.
+FakeNetwork wires several of them together so frames sent out of a linked
+port arrive at the switch on the other end.
+"""
+
+import bisect
+import collections
+import struct
+import time
+import zlib
+
+from ryu.controller import ofp_event
+from ryu.lib import addrconv
+from ryu.lib import hub
+from ryu.lib.packet import packet
+from ryu.lib.packet import ethernet
+from ryu.lib.packet import ether_types
+from ryu.lib.packet import arp
+from ryu.lib.packet import ipv4
+from ryu.lib.packet import icmp
+from ryu.lib.packet import tcp
+from ryu.lib.packet import udp
+from ryu.ofproto import ofproto_v1_3
+from ryu.ofproto import ofproto_v1_3_parser
+
+
+def _ip_to_int(addr):
+    return int.from_bytes(addrconv.ipv4.text_to_bin(addr), 'big')
+
+
+def _mac_to_int(addr):
+    return int.from_bytes(addrconv.mac.text_to_bin(addr), 'big')
+
+
+_MASKED_FIELDS = {
+    'ipv4_src': _ip_to_int, 'ipv4_dst': _ip_to_int,
+    'arp_spa': _ip_to_int, 'arp_tpa': _ip_to_int,
+    'eth_src': _mac_to_int, 'eth_dst': _mac_to_int,
+    'tcp_flags': int,
+}
+
+
+def frame_fields(data):
+    pkt = packet.Packet(data)
+    eth = pkt.get_protocol(ethernet.ethernet)
+    fields = {'eth_src': eth.src, 'eth_dst': eth.dst,
+              'eth_type': eth.ethertype}
+    arp_obj = pkt.get_protocol(arp.arp)
+    if arp_obj:
+        fields.update(arp_op=arp_obj.opcode, arp_spa=arp_obj.src_ip,
+                      arp_tpa=arp_obj.dst_ip, arp_sha=arp_obj.src_mac,
+                      arp_tha=arp_obj.dst_mac)
+    ip = pkt.get_protocol(ipv4.ipv4)
+    if ip:
+        fields.update(ipv4_src=ip.src, ipv4_dst=ip.dst, ip_proto=ip.proto)
+    l4 = pkt.get_protocol(tcp.tcp)
+    if l4:
+        fields.update(tcp_src=l4.src_port, tcp_dst=l4.dst_port,
+                      tcp_flags=l4.bits)
+    l4 = pkt.get_protocol(udp.udp)
+    if l4:
+        fields.update(udp_src=l4.src_port, udp_dst=l4.dst_port)
+    return fields
+
+
+_REWRITES = {
+    'eth_src': (ethernet.ethernet, 'src'),
+    'eth_dst': (ethernet.ethernet, 'dst'),
+    'ipv4_src': (ipv4.ipv4, 'src'), 'ipv4_dst': (ipv4.ipv4, 'dst'),
+}
+
+
+def rewrite_frame(data, fields):
+    """Return data with the header fields changed by set-field actions."""
+    pkt = packet.Packet(data)
+    changed = False
+    for name, (proto, attr) in _REWRITES.items():
+        layer = pkt.get_protocol(proto)
+        if layer is not None and name in fields and \
+                getattr(layer, attr) != fields[name]:
+            setattr(layer, attr, fields[name])
+            changed = True
+    if not changed:
+        return data
+    for layer in pkt.protocols:
+        # force checksums and lengths to be recomputed
+        if hasattr(layer, 'csum'):
+            layer.csum = 0
+    pkt.serialize()
+    return bytes(pkt.data)
+
+
+def _field_matches(name, want, have):
+    if have is None:
+        return False
+    if isinstance(want, tuple):
+        value, mask = want
+        conv = _MASKED_FIELDS[name]
+        mask = conv(mask)
+        return conv(value) & mask == conv(have) & mask
+    return want == have
+
+
+def match_covers(match, fields):
+    for name, want in match.items():
+        if not _field_matches(name, want, fields.get(name)):
+            return False
+    return True
+
+
+class FlowEntry(object):
+    def __init__(self, mod):
+        self.table_id = mod.table_id
+        self.priority = mod.priority
+        self.match = mod.match
+        self.instructions = mod.instructions
+        self.cookie = mod.cookie
+        self.idle_timeout = mod.idle_timeout
+        self.hard_timeout = mod.hard_timeout
+        self.flags = mod.flags
+        self.packet_count = 0
+        self.byte_count = 0
+        self._key = (self.table_id, self.priority,
+                     tuple(sorted(self.match.items())))
+
+    def key(self):
+        return self._key
+
+
+class FakeDatapath(object):
+    """Records sent messages and simulates the switch's forwarding.
+
+    Meters drop packets over the rate of their first band; max_meter=0
+    makes the switch report no meter support. With n_buffers, frames sent
+    to the controller with a max_len are buffered and truncated.
+    """
+
+    max_meter = 64
+    n_buffers = 0
+
+    def __init__(self, dpid=1, ports=(1, 2, 3, 4)):
+        self.id = dpid
+        self.ofproto = ofproto_v1_3
+        self.ofproto_parser = ofproto_v1_3_parser
+        self.ports = list(ports)
+        self.app = None
+        self.xid = 0
+        self.sent = []
+        self.sent_bytes = 0
+        self.flows = []
+        # parallel to flows: (table_id, -priority) to bisect on, and key()
+        self._order = []
+        self._by_key = {}
+        # lookup index: flows grouped by table, priority and matched fields,
+        # exact matches in a dict by their values
+        self._tables = {}
+        self._shapes = {}
+        self.groups = {}
+        # meter_id -> [rate, burst, tokens, last refill]
+        self.meters = {}
+        self.metered_drops = 0
+        # buffer_id -> (in_port, frame)
+        self.buffers = {}
+        self._next_buffer = 0
+        self.packet_ins = 0
+        self.packet_in_bytes = 0
+        # (port, fields) for every frame that left the switch
+        self.delivered = []
+        self.network = None
+
+    def attach(self, app):
+        self.app = app
+        features = self.ofproto_parser.OFPSwitchFeatures(self)
+        features.datapath_id = self.id
+        features.n_buffers = self.n_buffers
+        app.switch_features_handler(ofp_event.EventOFPSwitchFeatures(features))
+        self.settle()
+
+    def settle(self):
+        """Let the app's green threads run, e.g. deferred FlowMod batches."""
+        hub.sleep(0)
+
+    def set_xid(self, msg):
+        self.xid += 1
+        msg.set_xid(self.xid)
+        return self.xid
+
+    def send_msg(self, msg):
+        if msg.xid is None:
+            self.set_xid(msg)
+        msg.serialize()
+        self.sent.append(msg)
+        self.sent_bytes += len(msg.buf)
+        parser = self.ofproto_parser
+        if isinstance(msg, parser.OFPFlowMod):
+            self._flow_mod(msg)
+            buffered = self._unbuffer(msg.buffer_id)
+            if buffered is not None:
+                self.receive(*buffered)
+        elif isinstance(msg, parser.OFPGroupMod):
+            self._group_mod(msg)
+        elif isinstance(msg, parser.OFPMeterMod):
+            self._meter_mod(msg)
+        elif isinstance(msg, parser.OFPPacketOut):
+            in_port, data = msg.in_port, msg.data
+            buffered = self._unbuffer(msg.buffer_id)
+            if buffered is not None:
+                in_port, data = buffered
+            fields = frame_fields(data) if data else {}
+            self._apply_actions(msg.actions, data, fields, in_port)
+        elif isinstance(msg, parser.OFPBarrierRequest):
+            handler = getattr(self.app, '_barrier_reply_handler', None)
+            if handler is not None:
+                reply = parser.OFPBarrierReply(self)
+                reply.xid = msg.xid
+                handler(ofp_event.EventOFPBarrierReply(reply))
+        elif isinstance(msg, parser.OFPMeterFeaturesStatsRequest):
+            handler = getattr(self.app, '_meter_features_reply_handler',
+                              None)
+            if handler is not None:
+                reply = parser.OFPMeterFeaturesStatsReply(self)
+                reply.xid = msg.xid
+                reply.body = [parser.OFPMeterFeaturesStats(
+                    max_meter=self.max_meter,
+                    band_types=1 << self.ofproto.OFPMBT_DROP,
+                    capabilities=(self.ofproto.OFPMF_PKTPS |
+                                  self.ofproto.OFPMF_BURST),
+                    max_bands=1, max_color=0)]
+                handler(ofp_event.EventOFPMeterFeaturesStatsReply(reply))
+        elif isinstance(msg, parser.OFPFlowStatsRequest):
+            handler = getattr(self.app, '_flow_stats_reply_handler', None)
+            if handler is not None:
+                reply = parser.OFPFlowStatsReply(self)
+                reply.xid = msg.xid
+                reply.flags = 0
+                reply.body = [self._flow_stats(f) for f in self.flows
+                              if self._selected(f, msg, False)]
+                handler(ofp_event.EventOFPFlowStatsReply(reply))
+        elif isinstance(msg, parser.OFPPortDescStatsRequest):
+            handler = getattr(self.app, '_port_desc_stats_reply_handler',
+                              None)
+            if handler is not None:
+                reply = parser.OFPPortDescStatsReply(self)
+                reply.xid = msg.xid
+                reply.body = [self._port_desc(p) for p in self.ports]
+                handler(ofp_event.EventOFPPortDescStatsReply(reply))
+        return True
+
+    def _flow_stats(self, entry):
+        return self.ofproto_parser.OFPFlowStats(
+            table_id=entry.table_id, duration_sec=0, duration_nsec=0,
+            priority=entry.priority, idle_timeout=entry.idle_timeout,
+            hard_timeout=entry.hard_timeout, flags=entry.flags,
+            cookie=entry.cookie, packet_count=entry.packet_count,
+            byte_count=entry.byte_count, match=entry.match,
+            instructions=entry.instructions)
+
+    def _port_desc(self, port_no):
+        return self.ofproto_parser.OFPPort(
+            port_no=port_no, hw_addr='02:00:00:00:%02x:%02x' % (
+                self.id & 0xff, port_no & 0xff),
+            name=b's%d-eth%d' % (self.id, port_no), config=0, state=0,
+            curr=0, advertised=0, supported=0, peer=0, curr_speed=0,
+            max_speed=0)
+
+    def send(self, buf):
+        """Raw-bytes entry point, as used by packet_workers."""
+        ofp = self.ofproto
+        parser = self.ofproto_parser
+        version, msg_type, msg_len, xid = struct.unpack_from(
+            ofp.OFP_HEADER_PACK_STR, buf)
+        if msg_type == ofp.OFPT_PACKET_OUT:
+            # ryu has no parser for controller-to-switch PacketOuts
+            buffer_id, in_port, actions_len = struct.unpack_from(
+                ofp.OFP_PACKET_OUT_PACK_STR, buf, ofp.OFP_HEADER_SIZE)
+            offset = ofp.OFP_PACKET_OUT_SIZE
+            actions = []
+            while offset < ofp.OFP_PACKET_OUT_SIZE + actions_len:
+                action = parser.OFPAction.parser(buf, offset)
+                actions.append(action)
+                offset += action.len
+            msg = parser.OFPPacketOut(self, buffer_id=buffer_id,
+                                      in_port=in_port, actions=actions,
+                                      data=bytes(buf[offset:msg_len]))
+        else:
+            msg = parser.msg_parser(self, version, msg_type, msg_len, xid,
+                                    buf)
+        msg.xid = xid
+        return self.send_msg(msg)
+
+    def buffer(self, in_port, data):
+        """buffer_id the frame is kept under, OFP_NO_BUFFER if full."""
+        if len(self.buffers) >= self.n_buffers:
+            return self.ofproto.OFP_NO_BUFFER
+        self._next_buffer = (self._next_buffer + 1) & 0xffffff
+        self.buffers[self._next_buffer] = (in_port, data)
+        return self._next_buffer
+
+    def _unbuffer(self, buffer_id):
+        if buffer_id in (None, self.ofproto.OFP_NO_BUFFER):
+            return None
+        # an unknown buffer would be an OFPBRC_BUFFER_UNKNOWN error
+        return self.buffers.pop(buffer_id, None)
+
+    def flow_mods(self):
+        return [m for m in self.sent
+                if isinstance(m, self.ofproto_parser.OFPFlowMod)]
+
+    def _flow_mod(self, mod):
+        ofp = self.ofproto
+        if mod.command == ofp.OFPFC_ADD:
+            entry = FlowEntry(mod)
+            old = self._by_key.get(entry.key())
+            if old is not None:
+                self.flows[self.flows.index(old)] = entry
+            else:
+                order = (entry.table_id, -entry.priority)
+                pos = bisect.bisect_right(self._order, order)
+                self.flows.insert(pos, entry)
+                self._order.insert(pos, order)
+            self._by_key[entry.key()] = entry
+            self._index(entry, old)
+        elif mod.command in (ofp.OFPFC_DELETE, ofp.OFPFC_DELETE_STRICT):
+            strict = mod.command == ofp.OFPFC_DELETE_STRICT
+            self.flows = [f for f in self.flows
+                          if not self._selected(f, mod, strict)]
+            self._order = [(f.table_id, -f.priority) for f in self.flows]
+            self._by_key = dict((f.key(), f) for f in self.flows)
+            self._tables = {}
+            self._shapes = {}
+            for f in self.flows:
+                self._index(f)
+        elif mod.command in (ofp.OFPFC_MODIFY, ofp.OFPFC_MODIFY_STRICT):
+            strict = mod.command == ofp.OFPFC_MODIFY_STRICT
+            for f in self.flows:
+                if self._selected(f, mod, strict):
+                    f.instructions = mod.instructions
+
+    def _group_mod(self, mod):
+        ofp = self.ofproto
+        if mod.command == ofp.OFPGC_DELETE:
+            if mod.group_id == ofp.OFPG_ALL:
+                self.groups.clear()
+            else:
+                self.groups.pop(mod.group_id, None)
+        else:
+            self.groups[mod.group_id] = mod
+
+    def _meter_mod(self, mod):
+        ofp = self.ofproto
+        if mod.command == ofp.OFPMC_DELETE:
+            if mod.meter_id == ofp.OFPM_ALL:
+                self.meters.clear()
+            else:
+                self.meters.pop(mod.meter_id, None)
+        elif mod.bands:
+            band = mod.bands[0]
+            burst = band.burst_size or band.rate
+            self.meters[mod.meter_id] = [band.rate, burst, burst,
+                                         time.monotonic()]
+
+    def _metered(self, meter_id):
+        """True if the meter lets one more packet through."""
+        meter = self.meters.get(meter_id)
+        if meter is None:
+            return True
+        rate, burst, tokens, last = meter
+        now = time.monotonic()
+        tokens = min(burst, tokens + (now - last) * rate)
+        passed = tokens >= 1
+        meter[2] = tokens - 1 if passed else tokens
+        meter[3] = now
+        if not passed:
+            self.metered_drops += 1
+        return passed
+
+    def _select_bucket(self, group, fields):
+        # stand-in for the switch's hash over the flow's 5-tuple
+        buckets = [b for b in group.buckets if b.weight > 0]
+        if not buckets:
+            return None
+        key = tuple(fields.get(k) for k in (
+            'ipv4_src', 'ipv4_dst', 'ip_proto', 'tcp_src', 'tcp_dst',
+            'udp_src', 'udp_dst'))
+        point = zlib.crc32(repr(key).encode()) % sum(b.weight for b in buckets)
+        for bucket in buckets:
+            if point < bucket.weight:
+                return bucket
+            point -= bucket.weight
+
+    def _selected(self, entry, mod, strict):
+        ofp = self.ofproto
+        if mod.table_id != ofp.OFPTT_ALL and entry.table_id != mod.table_id:
+            return False
+        if mod.cookie_mask and \
+                entry.cookie & mod.cookie_mask != mod.cookie & mod.cookie_mask:
+            return False
+        if strict:
+            return (entry.priority == mod.priority and
+                    sorted(entry.match.items()) == sorted(mod.match.items()))
+        have = dict(entry.match.items())
+        return all(have.get(k) == v for k, v in mod.match.items())
+
+    def _index(self, entry, old=None):
+        items = entry.key()[2]
+        names = tuple(name for name, _value in items)
+        masked = any(isinstance(value, tuple) for _name, value in items)
+        shape_key = (entry.table_id, entry.priority, names, masked)
+        shape = self._shapes.get(shape_key)
+        if shape is None:
+            # creation order breaks ties between equal priorities
+            shape = self._shapes[shape_key] = [
+                -entry.priority, len(self._shapes), names,
+                [] if masked else {}]
+            bisect.insort(self._tables.setdefault(entry.table_id, []), shape)
+        flows = shape[3]
+        if not masked:
+            flows[tuple(value for _name, value in items)] = entry
+        elif old is not None:
+            flows[flows.index(old)] = entry
+        else:
+            flows.append(entry)
+
+    def lookup(self, table_id, fields):
+        for _priority, _seq, names, flows in self._tables.get(table_id, ()):
+            if isinstance(flows, dict):
+                entry = flows.get(tuple(fields.get(name) for name in names))
+                if entry is not None:
+                    return entry
+                continue
+            for entry in flows:
+                if match_covers(entry.match, fields):
+                    return entry
+        return None
+
+    def receive(self, in_port, data):
+        """Push a frame arriving on in_port through the flow table."""
+        parser = self.ofproto_parser
+        fields = frame_fields(data)
+        fields['in_port'] = in_port
+        table_id = 0
+        while True:
+            entry = self.lookup(table_id, fields)
+            if entry is None:
+                return
+            entry.packet_count += 1
+            entry.byte_count += len(data)
+            goto = None
+            for inst in entry.instructions:
+                if isinstance(inst, parser.OFPInstructionMeter):
+                    if not self._metered(inst.meter_id):
+                        return
+                elif isinstance(inst, parser.OFPInstructionGotoTable):
+                    goto = inst.table_id
+                elif isinstance(inst, parser.OFPInstructionActions):
+                    # set-field rewrites carry over to the next table
+                    fields = self._apply_actions(inst.actions, data, fields,
+                                                 in_port, table_id,
+                                                 entry.cookie)
+            if goto is None:
+                return
+            table_id = goto
+
+    def _apply_actions(self, actions, data, fields, in_port,
+                       table_id=0, cookie=0):
+        ofp = self.ofproto
+        parser = self.ofproto_parser
+        fields = dict(fields)
+        for action in actions:
+            if isinstance(action, parser.OFPActionSetField):
+                fields[action.key] = action.value
+            elif isinstance(action, parser.OFPActionGroup):
+                group = self.groups.get(action.group_id)
+                if group is None:
+                    continue
+                if group.type == ofp.OFPGT_SELECT:
+                    buckets = [self._select_bucket(group, fields)]
+                else:
+                    buckets = group.buckets
+                for bucket in buckets:
+                    if bucket is not None:
+                        self._apply_actions(bucket.actions, data, fields,
+                                            in_port, table_id, cookie)
+            elif isinstance(action, parser.OFPActionOutput):
+                if action.port == ofp.OFPP_CONTROLLER:
+                    self._packet_in(in_port, rewrite_frame(data, fields),
+                                    table_id, cookie, action.max_len)
+                elif action.port in (ofp.OFPP_FLOOD, ofp.OFPP_ALL):
+                    for port in self.ports:
+                        if port != in_port:
+                            self._output(port, data, fields)
+                elif action.port == ofp.OFPP_IN_PORT:
+                    self._output(in_port, data, fields)
+                else:
+                    self._output(action.port, data, fields)
+        return fields
+
+    def _output(self, port, data, fields):
+        self.delivered.append((port, fields))
+        if self.network is not None:
+            self.network.transmit(self.id, port, rewrite_frame(data, fields))
+
+    def _packet_in(self, in_port, data, table_id=0, cookie=0, max_len=None):
+        self.packet_ins += 1
+        if self.app is not None:
+            ev = make_packet_in(self, in_port, data, table_id, cookie,
+                                max_len)
+            self.packet_in_bytes += ev.msg.msg_len
+            self.app._packet_in_handler(ev)
+            self.settle()
+
+
+class FakeNetwork(object):
+    """FakeDatapaths joined by links, frames cross them in FIFO order.
+
+    max_hops bounds the number of frames handled per burst, so a forwarding
+    loop shows up as a high crossed count instead of a hang.
+    """
+
+    def __init__(self, max_hops=10000):
+        self.datapaths = {}
+        self.peers = {}
+        self.max_hops = max_hops
+        self.crossed = 0
+        self._queue = collections.deque()
+        self._running = False
+
+    def add_switch(self, dpid, ports):
+        datapath = FakeDatapath(dpid, ports)
+        datapath.network = self
+        self.datapaths[dpid] = datapath
+        return datapath
+
+    def link(self, dpid_a, port_a, dpid_b, port_b):
+        self.peers[(dpid_a, port_a)] = (dpid_b, port_b)
+        self.peers[(dpid_b, port_b)] = (dpid_a, port_a)
+
+    def attach(self, app):
+        for datapath in self.datapaths.values():
+            datapath.attach(app)
+
+    def transmit(self, dpid, port, data):
+        peer = self.peers.get((dpid, port))
+        if peer is not None:
+            self.crossed += 1
+            self._queue.append((peer, data))
+            self._drain()
+
+    def receive(self, dpid, in_port, data):
+        self._queue.append(((dpid, in_port), data))
+        self._drain()
+
+    def _drain(self):
+        if self._running:
+            return
+        self._running = True
+        hops = 0
+        try:
+            while self._queue and hops <= self.max_hops:
+                (dpid, port), data = self._queue.popleft()
+                self.datapaths[dpid].receive(port, data)
+                hops += 1
+            self._queue.clear()
+        finally:
+            self._running = False
+
+    def settle(self):
+        for datapath in self.datapaths.values():
+            datapath.settle()
+
+
+def make_packet_in(datapath, in_port, data, table_id=0, cookie=0,
+                   max_len=None):
+    """PacketIn for data as the switch sends it for an output's max_len."""
+    ofp = datapath.ofproto
+    parser = datapath.ofproto_parser
+    total_len = len(data)
+    buffer_id = ofp.OFP_NO_BUFFER
+    if max_len not in (None, ofp.OFPCML_NO_BUFFER):
+        buffer_id = datapath.buffer(in_port, data)
+        if buffer_id != ofp.OFP_NO_BUFFER:
+            data = data[:max_len]
+    msg = parser.OFPPacketIn(datapath, buffer_id=buffer_id,
+                             total_len=total_len, reason=ofp.OFPR_NO_MATCH,
+                             table_id=table_id, cookie=cookie,
+                             match=parser.OFPMatch(in_port=in_port),
+                             data=data)
+    msg.msg_len = ofp.OFP_PACKET_IN_SIZE + len(data)
+    return ofp_event.EventOFPPacketIn(msg)
+
+
+def build_frame(src_mac, dst_mac, src_ip=None, dst_ip=None, proto='icmp',
+                src_port=40000, dst_port=80, payload=b''):
+    pkt = packet.Packet()
+    if src_ip is None:
+        pkt.add_protocol(ethernet.ethernet(dst=dst_mac, src=src_mac,
+                                           ethertype=0x88b5))
+        pkt.serialize()
+        return bytes(pkt.data) + payload
+    pkt.add_protocol(ethernet.ethernet(dst=dst_mac, src=src_mac,
+                                       ethertype=ether_types.ETH_TYPE_IP))
+    if proto == 'tcp':
+        pkt.add_protocol(ipv4.ipv4(src=src_ip, dst=dst_ip, proto=6))
+        pkt.add_protocol(tcp.tcp(src_port=src_port, dst_port=dst_port,
+                                 bits=tcp.TCP_SYN))
+    elif proto == 'udp':
+        pkt.add_protocol(ipv4.ipv4(src=src_ip, dst=dst_ip, proto=17))
+        pkt.add_protocol(udp.udp(src_port=src_port, dst_port=dst_port))
+    else:
+        pkt.add_protocol(ipv4.ipv4(src=src_ip, dst=dst_ip, proto=1))
+        pkt.add_protocol(icmp.icmp(data=icmp.echo(id_=1, seq=1)))
+    pkt.add_protocol(payload)
+    pkt.serialize()
+    return bytes(pkt.data)
+
+
+def build_arp(src_mac, src_ip, dst_ip, opcode=arp.ARP_REQUEST,
+              dst_mac='ff:ff:ff:ff:ff:ff'):
+    pkt = packet.Packet()
+    pkt.add_protocol(ethernet.ethernet(dst=dst_mac, src=src_mac,
+                                       ethertype=ether_types.ETH_TYPE_ARP))
+    target_mac = '00:00:00:00:00:00' if opcode == arp.ARP_REQUEST else dst_mac
+    pkt.add_protocol(arp.arp(opcode=opcode, src_mac=src_mac, src_ip=src_ip,
+                             dst_mac=target_mac, dst_ip=dst_ip))
+    pkt.serialize()
+    return bytes(pkt.data)
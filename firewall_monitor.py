@@ -13,44 +13,247 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+
 from ryu.base import app_manager
 from ryu.controller import ofp_event
 from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER
+from ryu.controller.handler import DEAD_DISPATCHER
 from ryu.controller.handler import set_ev_cls
 from ryu.ofproto import ofproto_v1_3
-from ryu.lib.packet import packet
-from ryu.lib.packet import ethernet
+from ryu.app.wsgi import WSGIApplication
+from ryu.lib import hub
 from ryu.lib.packet import ether_types
-from ryu.lib.packet import icmp
-from ryu.lib.packet import ipv4
+
+from firewall_rules import Rule, RuleSet, load_rules, rule_from_match
+from flow_monitor import STATS_INSTANCE, StatsController, StatsMonitor
+from flow_pipeline import FlowProgrammer, FlowProgrammerEvents
+from flow_sync import FlowReconciler, learn_from_flow, output_port
+from host_tracker import HostTracker
+from instrument import Instrumentation
+from packet_buffer import PacketBuffering
+from packet_in_guard import PacketInGuard
+from state_store import StateStore, flat_table, nest_table
 
 
-class SimpleSwitch13(app_manager.RyuApp):
+class SimpleSwitch13(FlowProgrammerEvents, app_manager.RyuApp):
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
+    _CONTEXTS = {'wsgi': WSGIApplication}
+
+    # drop rules, see firewall_rules for the format. The file is watched
+    # and changes are pushed to the switches without a restart.
+    rules_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'firewall_rules.json')
+    rules_poll_interval = 2
+
+    # drop flows must win over everything the switch learns
+    firewall_priority = 100
+    firewall_cookie = 0xf1
+
+    # seconds between flow/port stats polls, see flow_monitor
+    stats_interval = 10
+
+    # PacketIns/sec a switch may send, enforced by a meter where the switch
+    # has them; single sources are policed by the controller, see
+    # packet_in_guard. 0 leaves the switches unmetered.
+    packet_in_rate = 1000
+    # bytes of a table-miss frame sent up while the switch buffers the
+    # rest, None for whole frames, see packet_buffer
+    miss_send_len = 128
+    # path prefix of the learned tables and the policy in force, saved
+    # every state_interval seconds and restored on start while under
+    # state_max_age seconds old, see state_store; None starts empty. Either
+    # way the flows a switch kept are reconciled with them when it
+    # connects, see flow_sync.
+    state_file = None
+    state_interval = 5
+    state_max_age = 300
+    # timing histograms of the event handlers and PacketIn stages, written
+    # to instrument_file every instrument_interval seconds if set, and one
+    # PacketIn in log_every logged, see instrument. SIGUSR1 and SIGUSR2
+    # profile the running controller.
+    instrument_file = None
+    instrument_interval = 10
+    log_every = 100
 
     def __init__(self, *args, **kwargs):
         super(SimpleSwitch13, self).__init__(*args, **kwargs)
         self.mac_to_port = {}
-        self.countPackets = 0
+        self.datapaths = {}
+        self.flow_programmer = FlowProgrammer()
+        self.hosts = HostTracker()
+        self.guard = PacketInGuard(self, self.packet_in_rate)
+        self.buffering = PacketBuffering(self, self.miss_send_len)
+        self.monitor = StatsMonitor(self.datapaths, self.stats_interval)
+        wsgi = kwargs.get('wsgi')
+        if wsgi is not None:
+            wsgi.register(StatsController, {STATS_INSTANCE: self.monitor})
+        self.monitor.start()
+        self.reconciler = FlowReconciler(self)
+        self.instr = Instrumentation(self, self.instrument_file,
+                                     self.instrument_interval, self.log_every)
+        self.instr.instrument(self)
+        self.instr.start()
+        self.rules = RuleSet()
+        self.rules_mtime = None
+        self.store = None
+        if self.state_file is not None:
+            self.store = StateStore(self, self.state_file, self.state_interval,
+                                    max_age=self.state_max_age)
+            self.restore_state(self.store.load())
+            self.store.start()
+        self.reload_rules()
+        self.rules_thread = hub.spawn(self._rules_watcher)
+
+    @set_ev_cls(ofp_event.EventOFPStateChange,
+                [MAIN_DISPATCHER, DEAD_DISPATCHER])
+    def _state_change_handler(self, ev):
+        datapath = ev.datapath
+        if ev.state == MAIN_DISPATCHER:
+            self.datapaths[datapath.id] = datapath
+        elif ev.state == DEAD_DISPATCHER:
+            self.datapaths.pop(datapath.id, None)
+            self.monitor.forget(datapath.id)
+
+    @set_ev_cls(ofp_event.EventOFPFlowStatsReply,
+                [CONFIG_DISPATCHER, MAIN_DISPATCHER])
+    def _flow_stats_reply_handler(self, ev):
+        if not self.reconciler.flow_stats_reply(ev.msg):
+            self.monitor.flow_stats_reply(ev.msg)
+
+    @set_ev_cls(ofp_event.EventOFPPortStatsReply, MAIN_DISPATCHER)
+    def _port_stats_reply_handler(self, ev):
+        self.monitor.port_stats_reply(ev.msg)
 
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
     def switch_features_handler(self, ev):
         datapath = ev.msg.datapath
+        self.instr.watch(datapath)
+        ofproto = datapath.ofproto
+
+        self.flow_programmer.reset(datapath)
+        self.reconciler.switch_connected(datapath)
+        self.guard.switch_connected(datapath)
+        self.buffering.switch_features(ev.msg)
+        self._install_table_miss(datapath)
+
+        # push the whole policy so blocked traffic never reaches us
+        for rule in self.rules.rules:
+            self._firewall_flow(datapath, rule, ofproto.OFPFC_ADD)
+
+    def reconcile(self, datapath, stats):
+        parser = datapath.ofproto_parser
+        mac_to_port = self.mac_to_port.setdefault(datapath.id, {})
+        # both sides rebuilt the same way, a flow the policy installs is
+        # never deleted for how the switch spells its match
+        policy = set(rule_from_match(rule.match(parser))
+                     for rule in self.rules.rules)
+        stale = []
+        for stat in stats:
+            match = stat.match
+            if stat.cookie == self.firewall_cookie:
+                # rules dropped while we were away
+                if stat.priority != self.firewall_priority or \
+                        rule_from_match(match) not in policy:
+                    stale.append(stat)
+            elif stat.priority == 1 and 'eth_src' in match:
+                if not learn_from_flow(mac_to_port,
+                                       [(match['eth_src'], match['in_port']),
+                                        (match['eth_dst'],
+                                         output_port(stat))]):
+                    stale.append(stat)
+        return stale
+
+    def dump_state(self):
+        return {'mac_to_port': flat_table(self.mac_to_port),
+                'hosts': self.hosts.dump(),
+                'rules': dict((rule, True) for rule in self.rules.rules)}
+
+    def restore_state(self, tables):
+        nest_table(tables.get('mac_to_port', {}), self.mac_to_port)
+        self.hosts.restore(tables.get('hosts', {}))
+        # enforced until the rules file loads, and after if it is broken
+        self.rules = RuleSet(Rule(*rule) for rule in tables.get('rules', {}))
+
+    def stop(self):
+        self.instr.close()
+        if self.store is not None:
+            self.store.close()
+        super(SimpleSwitch13, self).stop()
+
+    def _install_table_miss(self, datapath):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
 
         # install table-miss flow entry
         #
-        # We specify NO BUFFER to max_len of the output action due to
-        # OVS bug. At this moment, if we specify a lesser number, e.g.,
-        # 128, OVS will send Packet-In with invalid buffer_id and
-        # truncated packet data. In that case, we cannot output packets
-        # correctly.  The bug has been fixed in OVS v2.1.0.
+        # OVS before v2.1.0 sends Packet-In with invalid buffer_id and
+        # truncated packet data if max_len is less than NO BUFFER; the
+        # first such PacketIn makes us ask that switch for whole frames,
+        # see packet_buffer.
         match = parser.OFPMatch()
         actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,
-                                          ofproto.OFPCML_NO_BUFFER)]
+                                          self.buffering.max_len(datapath))]
         self.add_flow(datapath, 0, match, actions)
 
+    def _firewall_flow(self, datapath, rule, command):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        # no instructions: matching packets are dropped by the switch
+        mod = parser.OFPFlowMod(datapath=datapath, command=command,
+                                cookie=self.firewall_cookie,
+                                priority=self.firewall_priority,
+                                out_port=ofproto.OFPP_ANY,
+                                out_group=ofproto.OFPG_ANY,
+                                match=rule.match(parser), instructions=[])
+        self.flow_programmer.submit(datapath, mod)
+
+    def _apply_policy(self, rules, command):
+        for datapath in self.datapaths.values():
+            for rule in rules:
+                self._firewall_flow(datapath, rule, command)
+
+    def set_policy(self, rules):
+        """Replace the policy, only touching flows that changed."""
+        new = RuleSet(rules)
+        old = self.rules
+        self.rules = new
+        self._apply_policy(old.rules - new.rules,
+                           ofproto_v1_3.OFPFC_DELETE_STRICT)
+        self._apply_policy(new.rules - old.rules, ofproto_v1_3.OFPFC_ADD)
+
+    def block(self, rules):
+        self.set_policy(self.rules.rules | set(rules))
+
+    def unblock(self, rules):
+        self.set_policy(self.rules.rules - set(rules))
+
+    def reload_rules(self):
+        try:
+            mtime = os.stat(self.rules_file).st_mtime
+        except OSError as e:
+            self.logger.error("firewall rules unavailable: %s", e)
+            return
+        if mtime == self.rules_mtime:
+            return
+        self.rules_mtime = mtime
+        try:
+            rules = load_rules(self.rules_file)
+        except (OSError, ValueError) as e:
+            # keep enforcing the previous policy
+            self.logger.error("bad firewall rules in %s: %s",
+                              self.rules_file, e)
+            return
+        self.set_policy(rules)
+        self.logger.info("loaded %d firewall rules from %s",
+                         len(self.rules), self.rules_file)
+
+    def _rules_watcher(self):
+        while True:
+            hub.sleep(self.rules_poll_interval)
+            self.reload_rules()
+
     def add_flow(self, datapath, priority, match, actions, buffer_id=None):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
@@ -64,7 +267,12 @@ class SimpleSwitch13(app_manager.RyuApp):
         else:
             mod = parser.OFPFlowMod(datapath=datapath, priority=priority,
                                     match=match, instructions=inst)
-        datapath.send_msg(mod)
+        self.flow_programmer.submit(datapath, self.guard.meter(datapath, mod))
+
+    @set_ev_cls(ofp_event.EventOFPMeterFeaturesStatsReply,
+                [CONFIG_DISPATCHER, MAIN_DISPATCHER])
+    def _meter_features_reply_handler(self, ev):
+        self.guard.meter_features_reply(ev.msg)
 
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def _packet_in_handler(self, ev):
@@ -79,56 +287,40 @@ class SimpleSwitch13(app_manager.RyuApp):
         parser = datapath.ofproto_parser
         in_port = msg.match['in_port']
 
-        pkt = packet.Packet(msg.data)
-        eth = pkt.get_protocols(ethernet.ethernet)[0]
+        eth = self.instr.parse(msg.data)
 
-        if eth.ethertype == ether_types.ETH_TYPE_LLDP:
+        if eth is None or eth.ethertype == ether_types.ETH_TYPE_LLDP:
             # ignore lldp packet
             return
+        if not self.guard.admit(datapath, in_port, eth.src):
+            return
+        if not self.buffering.complete(msg):
+            self._install_table_miss(datapath)
+            return
         dst = eth.dst
         src = eth.src
 
         dpid = datapath.id
         self.mac_to_port.setdefault(dpid, {})
 
-        self.logger.info("packet in %s %s %s %s", dpid, src, dst, in_port)
+        self.instr.log_sampled(self.logger, "packet in %s %s %s %s",
+                               dpid, src, dst, in_port)
 
         # learn a mac address to avoid FLOOD next time.
         self.mac_to_port[dpid][src] = in_port
 
-        ip1 = '10.0.0.1'
-        ip2 = '10.0.0.2'
-        ip3 = '10.0.0.3'
-        ip4 = '10.0.0.4'
-        ip5 = '10.0.0.5'
-
-        mac1 = '00:00:00:00:00:01'
-        mac2 = '00:00:00:00:00:02'
-        mac3 = '00:00:00:00:00:03'
-        mac4 = '00:00:00:00:00:04'
-        mac5 = '00:00:00:00:00:05'
-
-        pair_tuple = ((ip1, ip4), (ip4, ip1), (ip2, ip5),
-                      (ip5, ip2), (ip3, ip5), (ip5, ip3))
-        
-        mac_pair_tuple = ((mac1, mac4), (mac4, mac1), (mac2, mac5),
-                      (mac5, mac2), (mac3, mac5), (mac5, mac3))
-        
-
-        ip = pkt.get_protocol(ipv4.ipv4)
+        # the switch drops blocked traffic, this only catches packets that
+        # were already queued before the drop flows went in
+        if self.rules.lookup(eth) is not None:
+            self.buffering.release(datapath, msg)
+            return
 
-        if ip:
-            sc = ip.src
-            dest = ip.dst
-            if (sc, dest) in pair_tuple:
-                return
-        elif (src,dst) in mac_pair_tuple:
+        # answer ARP requests for known hosts instead of flooding them
+        self.hosts.learn(dpid, in_port, eth)
+        if self.hosts.arp_proxy(datapath, in_port, eth,
+                                self.rules.lookup_mac):
+            self.buffering.release(datapath, msg)
             return
-            
-        if dpid == 1:
-            if in_port == 4:
-                self.countPackets +=1
-                print("Count of packets from H3 on switch 1: ",self.countPackets)
 
         if dst in self.mac_to_port[dpid]:
             out_port = self.mac_to_port[dpid][dst]
@@ -153,4 +345,4 @@ class SimpleSwitch13(app_manager.RyuApp):
 
         out = parser.OFPPacketOut(datapath=datapath, buffer_id=msg.buffer_id,
                                   in_port=in_port, actions=actions, data=data)
-        datapath.send_msg(out)
+        self.flow_programmer.send(datapath, out)
@@ -0,0 +1,286 @@
+"""Firewall rule loading and indexing for firewall_monitor.
+
+A rules file is JSON with a list of drop rules:
+
+    {"rules": [
+        {"src": "10.0.0.1", "dst": "10.0.0.4"},
+        {"src": "10.1.0.0/16", "proto": "tcp", "dst_port": 22},
+        {"eth_src": "00:00:00:00:00:01", "eth_dst": "00:00:00:00:00:04"}
+    ]}
+
+Missing fields are wildcards. src/dst take an address or a CIDR prefix,
+proto is tcp, udp, icmp or an IP protocol number (0-255), and ports need
+a tcp or udp proto. MACs are six colon-separated hex octets, compared as
+lowercase two-digit octets whatever their spelling in the file.
+
+RuleSet compiles the rules once into an index so a lookup costs the same
+whatever the number of rules: host-to-host rules live in an exact-match
+dict, anything with a prefix in a src trie whose nodes hold dst tries, and
+both end in a dict keyed on (proto, src_port, dst_port).
+"""
+
+import collections
+import ipaddress
+import json
+import re
+import socket
+import struct
+
+from ryu.lib.packet import ether_types
+
+_PROTOS = {'icmp': 1, 'tcp': 6, 'udp': 17}
+_PORT_FIELDS = {6: ('tcp_src', 'tcp_dst'), 17: ('udp_src', 'udp_dst')}
+_ADDR = struct.Struct('!I')
+_MAC = re.compile(r'[0-9a-fA-F]{1,2}(:[0-9a-fA-F]{1,2}){5}')
+
+
+class RuleError(ValueError):
+    pass
+
+
+class Rule(collections.namedtuple('Rule', [
+        'eth_src', 'eth_dst', 'ipv4_src', 'ipv4_dst', 'ip_proto',
+        'src_port', 'dst_port'])):
+    __slots__ = ()
+
+    def match(self, parser):
+        fields = {}
+        if self.eth_src:
+            fields['eth_src'] = self.eth_src
+        if self.eth_dst:
+            fields['eth_dst'] = self.eth_dst
+        if self.ipv4_src or self.ipv4_dst or self.ip_proto is not None:
+            fields['eth_type'] = ether_types.ETH_TYPE_IP
+        for name, net in (('ipv4_src', self.ipv4_src),
+                          ('ipv4_dst', self.ipv4_dst)):
+            if net is None:
+                continue
+            net = ipaddress.ip_network(net)
+            if net.prefixlen == 32:
+                fields[name] = str(net.network_address)
+            else:
+                fields[name] = (str(net.network_address), str(net.netmask))
+        if self.ip_proto is not None:
+            fields['ip_proto'] = self.ip_proto
+        if self.src_port is not None:
+            fields[_PORT_FIELDS[self.ip_proto][0]] = self.src_port
+        if self.dst_port is not None:
+            fields[_PORT_FIELDS[self.ip_proto][1]] = self.dst_port
+        return parser.OFPMatch(**fields)
+
+
+def _network(value):
+    if value in (None, '', 'any', '*'):
+        return None
+    try:
+        return str(ipaddress.IPv4Network(value, strict=False))
+    except (TypeError, ValueError) as e:
+        raise RuleError(str(e))
+
+
+def _port(value):
+    if value is None:
+        return None
+    try:
+        port = int(value)
+    except (TypeError, ValueError):
+        raise RuleError('bad port %r' % (value,))
+    if not 0 <= port <= 0xffff:
+        raise RuleError('bad port %s' % value)
+    return port
+
+
+def _mac(value):
+    if value in (None, '', 'any', '*'):
+        return None
+    if not isinstance(value, str) or _MAC.fullmatch(value) is None:
+        raise RuleError('bad MAC address %r' % (value,))
+    # as packets are parsed: lowercase, two digits an octet
+    return ':'.join('%02x' % int(octet, 16) for octet in value.split(':'))
+
+
+def parse_rule(entry):
+    if not isinstance(entry, dict):
+        raise RuleError('rule is not an object: %r' % (entry,))
+    proto = entry.get('proto')
+    if proto is not None:
+        proto = _PROTOS.get(str(proto).lower())
+        if proto is None:
+            try:
+                proto = int(entry['proto'])
+            except (TypeError, ValueError):
+                raise RuleError('bad proto %r' % (entry['proto'],))
+            if not 0 <= proto <= 0xff:
+                raise RuleError('bad proto %s' % proto)
+    rule = Rule(eth_src=_mac(entry.get('eth_src')),
+                eth_dst=_mac(entry.get('eth_dst')),
+                ipv4_src=_network(entry.get('src')),
+                ipv4_dst=_network(entry.get('dst')),
+                ip_proto=proto,
+                src_port=_port(entry.get('src_port')),
+                dst_port=_port(entry.get('dst_port')))
+    if (rule.src_port is not None or rule.dst_port is not None) and \
+            proto not in _PORT_FIELDS:
+        raise RuleError('ports need proto tcp or udp: %r' % (entry,))
+    if (rule.eth_src or rule.eth_dst) and \
+            (rule.ipv4_src or rule.ipv4_dst or proto is not None):
+        raise RuleError('mix of MAC and IP fields: %r' % (entry,))
+    if rule == Rule(None, None, None, None, None, None, None):
+        raise RuleError('rule matches everything: %r' % (entry,))
+    return rule
+
+
+def rule_from_match(match):
+    """The Rule whose drop flow has match, None if no Rule has it.
+
+    Switches report matches in their own spelling (MAC case, masks for
+    prefixes), rebuilding the Rule lets them be compared with the policy.
+    """
+    fields = dict(match.items())
+    eth_type = fields.pop('eth_type', None)
+    proto = fields.pop('ip_proto', None)
+    ports = [None, None]
+    if proto in _PORT_FIELDS:
+        ports = [fields.pop(name, None) for name in _PORT_FIELDS[proto]]
+    nets = []
+    for name in ('ipv4_src', 'ipv4_dst'):
+        value = fields.pop(name, None)
+        if isinstance(value, tuple):
+            value = '%s/%s' % value
+        nets.append(value)
+    try:
+        rule = Rule(eth_src=_mac(fields.pop('eth_src', None)),
+                    eth_dst=_mac(fields.pop('eth_dst', None)),
+                    ipv4_src=_network(nets[0]), ipv4_dst=_network(nets[1]),
+                    ip_proto=proto, src_port=_port(ports[0]),
+                    dst_port=_port(ports[1]))
+    except RuleError:
+        return None
+    ip = rule.ipv4_src or rule.ipv4_dst or proto is not None
+    if fields or eth_type != (ether_types.ETH_TYPE_IP if ip else None):
+        return None
+    return rule
+
+
+def load_rules(path):
+    with open(path) as f:
+        doc = json.load(f)
+    if not isinstance(doc, dict):
+        raise RuleError('not a JSON object with a "rules" list')
+    entries = doc.get('rules', [])
+    if not isinstance(entries, list):
+        raise RuleError('"rules" is not a list')
+    return [parse_rule(entry) for entry in entries]
+
+
+def _addr(ip):
+    return _ADDR.unpack(socket.inet_aton(ip))[0]
+
+
+class _Node(object):
+    __slots__ = ('children', 'value')
+
+    def __init__(self):
+        self.children = [None, None]
+        self.value = None
+
+
+class PrefixTrie(object):
+    """Binary trie over IPv4 prefixes, one node per prefix bit."""
+
+    def __init__(self):
+        self.root = _Node()
+
+    def setdefault(self, network, factory):
+        net = ipaddress.IPv4Network(network)
+        addr = int(net.network_address)
+        node = self.root
+        for i in range(net.prefixlen):
+            bit = (addr >> (31 - i)) & 1
+            if node.children[bit] is None:
+                node.children[bit] = _Node()
+            node = node.children[bit]
+        if node.value is None:
+            node.value = factory()
+        return node.value
+
+    def matches(self, addr):
+        """Yield the values of every prefix containing addr."""
+        node = self.root
+        for i in range(33):
+            if node.value is not None:
+                yield node.value
+            if i == 32:
+                return
+            node = node.children[(addr >> (31 - i)) & 1]
+            if node is None:
+                return
+
+
+_ANY = '0.0.0.0/0'
+
+
+class RuleSet(object):
+    def __init__(self, rules=()):
+        self.rules = frozenset(rules)
+        self.mac_rules = {}
+        self.exact = {}
+        self.trie = PrefixTrie()
+        for rule in self.rules:
+            self._index(rule)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def _index(self, rule):
+        if rule.eth_src or rule.eth_dst:
+            self.mac_rules.setdefault((rule.eth_src, rule.eth_dst), rule)
+            return
+        src = rule.ipv4_src or _ANY
+        dst = rule.ipv4_dst or _ANY
+        if src.endswith('/32') and dst.endswith('/32'):
+            key = (_addr(src[:-3]), _addr(dst[:-3]))
+            ports = self.exact.setdefault(key, {})
+        else:
+            dst_trie = self.trie.setdefault(src, PrefixTrie)
+            ports = dst_trie.setdefault(dst, dict)
+        ports.setdefault((rule.ip_proto, rule.src_port, rule.dst_port), rule)
+
+    @staticmethod
+    def _ports_lookup(ports, proto, src_port, dst_port):
+        for key in ((proto, src_port, dst_port), (proto, None, dst_port),
+                    (proto, src_port, None), (proto, None, None),
+                    (None, None, None)):
+            rule = ports.get(key)
+            if rule is not None:
+                return rule
+        return None
+
+    def lookup_ip(self, src, dst, proto=None, src_port=None, dst_port=None):
+        """Return a rule dropping this IPv4 packet, or None."""
+        s = _addr(src)
+        d = _addr(dst)
+        ports = self.exact.get((s, d))
+        if ports is not None:
+            rule = self._ports_lookup(ports, proto, src_port, dst_port)
+            if rule is not None:
+                return rule
+        for dst_trie in self.trie.matches(s):
+            for ports in dst_trie.matches(d):
+                rule = self._ports_lookup(ports, proto, src_port, dst_port)
+                if rule is not None:
+                    return rule
+        return None
+
+    def lookup_mac(self, src, dst):
+        get = self.mac_rules.get
+        return get((src, dst)) or get((src, None)) or get((None, dst))
+
+    def lookup(self, hdr):
+        """Return the rule dropping a pkt_headers.Headers, or None."""
+        if hdr.ipv4_src is not None:
+            rule = self.lookup_ip(hdr.ipv4_src, hdr.ipv4_dst, hdr.ip_proto,
+                                  hdr.src_port, hdr.dst_port)
+            if rule is not None:
+                return rule
+        return self.lookup_mac(hdr.src, hdr.dst)
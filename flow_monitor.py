@@ -0,0 +1,269 @@
+"""Flow and port statistics collected from the switches.
+
+StatsMonitor polls every connected datapath with OFPFlowStatsRequest and
+OFPPortStatsRequest from a hub thread and keeps byte/packet counters and
+rates per port, per flow and per host (a host's tx/rx are the flows
+matching its eth_src/eth_dst). The owning app forwards the stats replies
+to it.
+
+StatsController publishes the counters on ryu's WSGI server (ryu-manager
+--wsapi-port, 8080 by default):
+
+    GET /stats          everything as JSON
+    GET /stats/hosts    per-host counters
+    GET /stats/ports    per-port counters
+    GET /stats/flows    per-flow counters
+    GET /metrics        Prometheus text format
+"""
+
+import collections
+import json
+import time
+
+from ryu.app.wsgi import ControllerBase, Response, route
+from ryu.lib import hub
+
+STATS_INSTANCE = 'stats_monitor'
+
+# Prometheus metric families: name, type, help
+_METRICS = [
+    ('sdn_port_packets_total', 'counter', 'Packets through a switch port.'),
+    ('sdn_port_bytes_total', 'counter', 'Bytes through a switch port.'),
+    ('sdn_port_bytes_rate', 'gauge',
+     'Bytes/sec through a switch port over the last poll.'),
+    ('sdn_host_packets_total', 'counter',
+     'Packets of the flows matching a host, summed over the switches.'),
+    ('sdn_host_bytes_total', 'counter',
+     'Bytes of the flows matching a host, summed over the switches.'),
+    ('sdn_host_bytes_rate', 'gauge',
+     'Bytes/sec of the flows matching a host over the last poll.'),
+    ('sdn_flow_packets_total', 'counter', 'Packets matched by a flow.'),
+    ('sdn_flow_bytes_total', 'counter', 'Bytes matched by a flow.'),
+]
+
+
+def _match_key(match):
+    return ','.join('%s=%s' % (k, v) for k, v in sorted(match.items()))
+
+
+class _Counter(object):
+    __slots__ = ('packets', 'bytes', 'packet_rate', 'byte_rate', 'stamp')
+
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.packet_rate = 0.0
+        self.byte_rate = 0.0
+        self.stamp = None
+
+    def update(self, packets, nbytes, now):
+        if self.stamp is not None and now > self.stamp and \
+                packets >= self.packets:
+            elapsed = now - self.stamp
+            self.packet_rate = (packets - self.packets) / elapsed
+            self.byte_rate = (nbytes - self.bytes) / elapsed
+        elif packets < self.packets:
+            # the flows behind it were replaced, no rate to tell
+            self.packet_rate = self.byte_rate = 0.0
+        self.packets = packets
+        self.bytes = nbytes
+        self.stamp = now
+
+    def to_dict(self):
+        return {'packets': self.packets, 'bytes': self.bytes,
+                'packet_rate': self.packet_rate, 'byte_rate': self.byte_rate}
+
+
+class StatsMonitor(object):
+    def __init__(self, datapaths, interval=10):
+        self.datapaths = datapaths
+        self.interval = interval
+        self.thread = None
+        # (dpid, port_no) -> {'rx': _Counter, 'tx': _Counter}
+        self.ports = {}
+        # (dpid, table_id, priority, match) -> _Counter
+        self.flows = {}
+        # mac -> {'tx': _Counter, 'rx': _Counter}
+        self.hosts = {}
+        # dpid -> {(mac, direction): [packets, bytes]} from the last reply
+        self._host_parts = {}
+        # multipart flow replies are collected until the last part
+        self._flow_parts = {}
+
+    def start(self):
+        if self.thread is None:
+            self.thread = hub.spawn(self._poll)
+
+    def _poll(self):
+        while True:
+            for datapath in list(self.datapaths.values()):
+                self.request_stats(datapath)
+            hub.sleep(self.interval)
+
+    def request_stats(self, datapath):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        req = parser.OFPFlowStatsRequest(datapath)
+        datapath.send_msg(req)
+
+        req = parser.OFPPortStatsRequest(datapath, 0, ofproto.OFPP_ANY)
+        datapath.send_msg(req)
+
+    def port_stats_reply(self, msg):
+        dpid = msg.datapath.id
+        now = time.time()
+        for stat in msg.body:
+            counters = self.ports.setdefault(
+                (dpid, stat.port_no), {'rx': _Counter(), 'tx': _Counter()})
+            counters['rx'].update(stat.rx_packets, stat.rx_bytes, now)
+            counters['tx'].update(stat.tx_packets, stat.tx_bytes, now)
+
+    def flow_stats_reply(self, msg):
+        dpid = msg.datapath.id
+        parts = self._flow_parts.setdefault(dpid, [])
+        parts.extend(msg.body)
+        if msg.flags & msg.datapath.ofproto.OFPMPF_REPLY_MORE:
+            return
+        del self._flow_parts[dpid]
+
+        now = time.time()
+        seen = set()
+        host_totals = {}
+        for stat in parts:
+            key = (dpid, stat.table_id, stat.priority, _match_key(stat.match))
+            seen.add(key)
+            self.flows.setdefault(key, _Counter()).update(
+                stat.packet_count, stat.byte_count, now)
+            for field, direction in (('eth_src', 'tx'), ('eth_dst', 'rx')):
+                mac = stat.match.get(field)
+                if isinstance(mac, str):
+                    total = host_totals.setdefault((mac, direction), [0, 0])
+                    total[0] += stat.packet_count
+                    total[1] += stat.byte_count
+
+        # flows that went away take their counters with them
+        for key in [k for k in self.flows if k[0] == dpid and k not in seen]:
+            del self.flows[key]
+
+        self._update_hosts(dpid, host_totals, now)
+
+    def _update_hosts(self, dpid, totals, now):
+        self._host_parts[dpid] = totals
+        self._combine_hosts(now)
+
+    def _combine_hosts(self, now):
+        # host counters add up the flows of every switch
+        combined = {}
+        for per_dp in self._host_parts.values():
+            for (mac, direction), (packets, nbytes) in per_dp.items():
+                total = combined.setdefault(mac, {}).setdefault(direction,
+                                                                [0, 0])
+                total[0] += packets
+                total[1] += nbytes
+        # hosts whose flows are all gone are dropped, not left at their
+        # last value
+        for mac in [m for m in self.hosts if m not in combined]:
+            del self.hosts[mac]
+        for mac, directions in combined.items():
+            counters = self.hosts.setdefault(
+                mac, {'tx': _Counter(), 'rx': _Counter()})
+            for direction, c in counters.items():
+                packets, nbytes = directions.get(direction, (0, 0))
+                c.update(packets, nbytes, now)
+
+    def forget(self, dpid):
+        for table in (self.ports, self.flows):
+            for key in [k for k in table if k[0] == dpid]:
+                del table[key]
+        self._flow_parts.pop(dpid, None)
+        if self._host_parts.pop(dpid, None) is not None:
+            self._combine_hosts(time.time())
+
+    def host_stats(self):
+        return dict((mac, dict((d, c.to_dict()) for d, c in counters.items()))
+                    for mac, counters in self.hosts.items())
+
+    def port_stats(self):
+        return [dict(dpid=dpid, port=port,
+                     rx=counters['rx'].to_dict(), tx=counters['tx'].to_dict())
+                for (dpid, port), counters in sorted(self.ports.items())]
+
+    def flow_stats(self):
+        result = []
+        for (dpid, table_id, priority, match), c in sorted(self.flows.items()):
+            entry = dict(dpid=dpid, table_id=table_id, priority=priority,
+                         match=match)
+            entry.update(c.to_dict())
+            result.append(entry)
+        return result
+
+    def to_dict(self):
+        return {'interval': self.interval, 'hosts': self.host_stats(),
+                'ports': self.port_stats(), 'flows': self.flow_stats()}
+
+    def prometheus(self):
+        # name -> (type, help, samples); each family is written as one block
+        families = collections.OrderedDict(
+            (name, (kind, text, [])) for name, kind, text in _METRICS)
+
+        def add(name, labels, value):
+            families[name][2].append('%s{%s} %s' % (name, labels, value))
+
+        for (dpid, port), counters in sorted(self.ports.items()):
+            for direction, c in sorted(counters.items()):
+                labels = 'dpid="%s",port="%s",direction="%s"' % (
+                    dpid, port, direction)
+                add('sdn_port_packets_total', labels, '%d' % c.packets)
+                add('sdn_port_bytes_total', labels, '%d' % c.bytes)
+                add('sdn_port_bytes_rate', labels, '%f' % c.byte_rate)
+        for mac, counters in sorted(self.hosts.items()):
+            for direction, c in sorted(counters.items()):
+                labels = 'mac="%s",direction="%s"' % (mac, direction)
+                add('sdn_host_packets_total', labels, '%d' % c.packets)
+                add('sdn_host_bytes_total', labels, '%d' % c.bytes)
+                add('sdn_host_bytes_rate', labels, '%f' % c.byte_rate)
+        for (dpid, table_id, priority, match), c in sorted(self.flows.items()):
+            labels = 'dpid="%s",table="%s",priority="%s",match="%s"' % (
+                dpid, table_id, priority, match)
+            add('sdn_flow_packets_total', labels, '%d' % c.packets)
+            add('sdn_flow_bytes_total', labels, '%d' % c.bytes)
+
+        lines = []
+        for name, (kind, text, samples) in families.items():
+            lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+
+class StatsController(ControllerBase):
+    def __init__(self, req, link, data, **config):
+        super(StatsController, self).__init__(req, link, data, **config)
+        self.monitor = data[STATS_INSTANCE]
+
+    @staticmethod
+    def _json(body):
+        return Response(content_type='application/json',
+                        body=json.dumps(body).encode('utf-8'))
+
+    @route('stats', '/stats', methods=['GET'])
+    def all_stats(self, req, **kwargs):
+        return self._json(self.monitor.to_dict())
+
+    @route('stats', '/stats/hosts', methods=['GET'])
+    def hosts(self, req, **kwargs):
+        return self._json(self.monitor.host_stats())
+
+    @route('stats', '/stats/ports', methods=['GET'])
+    def ports(self, req, **kwargs):
+        return self._json(self.monitor.port_stats())
+
+    @route('stats', '/stats/flows', methods=['GET'])
+    def flows(self, req, **kwargs):
+        return self._json(self.monitor.flow_stats())
+
+    @route('stats', '/metrics', methods=['GET'])
+    def metrics(self, req, **kwargs):
+        return Response(content_type='text/plain',
+                        body=self.monitor.prometheus().encode('utf-8'))
@@ -0,0 +1,276 @@
+"""Batched FlowMod programming shared by the apps.
+
+Apps hand their FlowMods to FlowProgrammer.submit() instead of calling
+datapath.send_msg(). Per datapath, the programmer
+
+  * queues the FlowMods and sends them as one batch followed by an
+    OFPBarrierRequest, either when batch_size mods are pending or on the
+    next turn of the event loop, so everything one event handler queues
+    goes out together;
+  * coalesces mods for the same (table, priority, match): only the last
+    one is sent, e.g. a strict delete followed by an add is just the add,
+    unless the earlier one releases a buffered packet;
+  * drops adds for flows it already installed with identical
+    instructions, as long as the switch can't have expired them silently
+    (no timeouts, or OFPFF_SEND_FLOW_REM set so flow_removed() is told);
+  * calls completion callbacks with (datapath, ok) once the barrier reply
+    for their batch arrives, ok being False if the switch rejected any
+    mod in the batch.
+
+PacketOuts and GroupMods go through send(): while FlowMods are queued
+for the datapath they are queued behind them, so a packet never leaves
+before the flows that should handle what it triggers, and mods
+submitted after them are not coalesced into the earlier ones.
+
+Apps mix in FlowProgrammerEvents to forward EventOFPBarrierReply and
+EventOFPErrorMsg to barrier_reply() and error(); they forward
+EventOFPFlowRemoved to flow_removed() and call reset() when a switch
+(re)connects.
+"""
+
+import itertools
+
+from ryu.controller import ofp_event
+from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER
+from ryu.controller.handler import set_ev_cls
+from ryu.lib import hub
+
+
+def _flow_key(mod):
+    return (mod.table_id, mod.priority, tuple(sorted(mod.match.items())))
+
+
+class _Batch(object):
+    def __init__(self):
+        self.xids = set()
+        self.keys = {}
+        self.callbacks = []
+        self.ok = True
+
+
+class _DatapathQueue(object):
+    def __init__(self, datapath):
+        self.datapath = datapath
+        # key -> (mod, callback), in send order
+        self.pending = {}
+        # keys pending ahead of a queued message, not to be coalesced
+        self.fenced = set()
+        self.flush_scheduled = False
+        # pending non-strict deletes/modifies may touch any installed flow
+        self.wildcard_pending = False
+        # key -> signature of flows known to be in the switch
+        self.installed = {}
+        # barrier xid -> _Batch, and mod xid -> _Batch until the barrier
+        self.barriers = {}
+        self.inflight = {}
+
+
+class FlowProgrammer(object):
+    def __init__(self, batch_size=64):
+        self.batch_size = batch_size
+        self.queues = {}
+        self._unique = itertools.count()
+        self.stats = {'submitted': 0, 'coalesced': 0, 'redundant': 0,
+                      'sent': 0, 'batches': 0, 'errors': 0}
+
+    def _queue(self, datapath):
+        queue = self.queues.get(datapath.id)
+        if queue is None or queue.datapath is not datapath:
+            queue = self.queues[datapath.id] = _DatapathQueue(datapath)
+        return queue
+
+    def reset(self, datapath):
+        """Forget what we believe is installed, e.g. on reconnect."""
+        self.queues.pop(datapath.id, None)
+
+    @staticmethod
+    def _signature(mod):
+        return (mod.cookie, mod.idle_timeout, mod.hard_timeout, mod.flags,
+                str(mod.instructions))
+
+    @staticmethod
+    def _buffered(mod):
+        return mod.buffer_id not in (None, mod.datapath.ofproto.OFP_NO_BUFFER)
+
+    def _cacheable(self, mod):
+        ofproto = mod.datapath.ofproto
+        return (mod.idle_timeout == 0 and mod.hard_timeout == 0) or \
+            bool(mod.flags & ofproto.OFPFF_SEND_FLOW_REM)
+
+    def submit(self, datapath, mod, callback=None):
+        ofproto = datapath.ofproto
+        queue = self._queue(datapath)
+        self.stats['submitted'] += 1
+
+        strict = mod.command in (ofproto.OFPFC_ADD,
+                                 ofproto.OFPFC_MODIFY_STRICT,
+                                 ofproto.OFPFC_DELETE_STRICT)
+        if strict:
+            key = _flow_key(mod)
+        else:
+            # non-strict mods can't be merged with anything else
+            key = ('wildcard', next(self._unique))
+            queue.wildcard_pending = True
+            self._forget_matching(queue, mod)
+
+        if mod.command == ofproto.OFPFC_ADD and key not in queue.pending and \
+                not queue.wildcard_pending and not self._buffered(mod) and \
+                queue.installed.get(key) == self._signature(mod):
+            self.stats['redundant'] += 1
+            if callback is not None:
+                callback(datapath, True)
+            return
+
+        if key in queue.fenced:
+            # a message queued since must still go out after the earlier mod
+            queue.pending[('fenced', next(self._unique), key)] = \
+                (mod, callback)
+        else:
+            previous = queue.pending.pop(key, None)
+            if previous is not None and self._buffered(previous[0]):
+                # the switch only releases its frame when this one is sent
+                queue.pending[('buffered', next(self._unique), key)] = \
+                    previous
+            elif previous is not None:
+                self.stats['coalesced'] += 1
+                if previous[1] is not None:
+                    callback = self._chain(previous[1], callback)
+            # re-inserted at the end so it still follows earlier wildcard
+            # mods
+            queue.pending[key] = (mod, callback)
+        self._schedule(queue)
+
+    def send(self, datapath, msg):
+        """Send a PacketOut, GroupMod... after the FlowMods queued so far."""
+        queue = self.queues.get(datapath.id)
+        if queue is None or queue.datapath is not datapath or \
+                not queue.pending:
+            datapath.send_msg(msg)
+            return
+        queue.fenced.update(queue.pending)
+        queue.pending[('msg', next(self._unique))] = (msg, None)
+        self._schedule(queue)
+
+    def _schedule(self, queue):
+        if len(queue.pending) >= self.batch_size:
+            self.flush(queue.datapath)
+        elif not queue.flush_scheduled:
+            queue.flush_scheduled = True
+            hub.spawn(self._deferred_flush, queue)
+
+    @staticmethod
+    def _chain(first, second):
+        if second is None:
+            return first
+
+        def both(datapath, ok):
+            first(datapath, ok)
+            second(datapath, ok)
+        return both
+
+    def _forget_matching(self, queue, mod):
+        ofproto = mod.datapath.ofproto
+        want = dict(mod.match.items())
+        for key in list(queue.installed):
+            table_id, _priority, items = key
+            if mod.table_id != ofproto.OFPTT_ALL and table_id != mod.table_id:
+                continue
+            have = dict(items)
+            if all(have.get(k) == v for k, v in want.items()):
+                del queue.installed[key]
+
+    def _deferred_flush(self, queue):
+        if self.queues.get(queue.datapath.id) is queue:
+            self.flush(queue.datapath)
+
+    def flush(self, datapath):
+        queue = self.queues.get(datapath.id)
+        if queue is None:
+            return
+        queue.flush_scheduled = False
+        if not queue.pending:
+            return
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        pending = queue.pending
+        queue.pending = {}
+        queue.fenced = set()
+        queue.wildcard_pending = False
+
+        batch = _Batch()
+        mods = 0
+        for key, (mod, callback) in pending.items():
+            if key[0] == 'msg':
+                datapath.send_msg(mod)
+                continue
+            if key[0] in ('buffered', 'fenced'):
+                key = key[2]
+            mods += 1
+            # serializing fills in lengths, take the signature before
+            signature = self._signature(mod)
+            datapath.set_xid(mod)
+            batch.xids.add(mod.xid)
+            batch.keys[mod.xid] = key
+            queue.inflight[mod.xid] = batch
+            if callback is not None:
+                batch.callbacks.append(callback)
+            if mod.command == ofproto.OFPFC_ADD and self._cacheable(mod):
+                queue.installed[key] = signature
+            elif mod.command != ofproto.OFPFC_ADD:
+                queue.installed.pop(key, None)
+            datapath.send_msg(mod)
+
+        barrier = parser.OFPBarrierRequest(datapath)
+        datapath.set_xid(barrier)
+        queue.barriers[barrier.xid] = batch
+        datapath.send_msg(barrier)
+        self.stats['sent'] += mods
+        self.stats['batches'] += 1
+
+    def flush_all(self):
+        for queue in list(self.queues.values()):
+            self.flush(queue.datapath)
+
+    def barrier_reply(self, msg):
+        queue = self.queues.get(msg.datapath.id)
+        if queue is None:
+            return
+        batch = queue.barriers.pop(msg.xid, None)
+        if batch is None:
+            return
+        for xid in batch.xids:
+            queue.inflight.pop(xid, None)
+        for callback in batch.callbacks:
+            callback(msg.datapath, batch.ok)
+
+    def error(self, msg):
+        """Mark the batch of a rejected mod as failed."""
+        queue = self.queues.get(msg.datapath.id)
+        if queue is None:
+            return
+        batch = queue.inflight.get(msg.xid)
+        if batch is None:
+            return
+        self.stats['errors'] += 1
+        batch.ok = False
+        queue.installed.pop(batch.keys.get(msg.xid), None)
+
+    def flow_removed(self, msg):
+        queue = self.queues.get(msg.datapath.id)
+        if queue is not None:
+            queue.installed.pop((msg.table_id, msg.priority,
+                                 tuple(sorted(msg.match.items()))), None)
+
+
+class FlowProgrammerEvents(object):
+    """Barrier and error handlers of an app's flow_programmer."""
+
+    @set_ev_cls(ofp_event.EventOFPBarrierReply,
+                [CONFIG_DISPATCHER, MAIN_DISPATCHER])
+    def _barrier_reply_handler(self, ev):
+        self.flow_programmer.barrier_reply(ev.msg)
+
+    @set_ev_cls(ofp_event.EventOFPErrorMsg,
+                [CONFIG_DISPATCHER, MAIN_DISPATCHER])
+    def _error_msg_handler(self, ev):
+        self.flow_programmer.error(ev.msg)
@@ -0,0 +1,396 @@
+"""Flow-installation strategies for the learning switch.
+
+ExactMatchStrategy is the original behaviour: one (in_port, eth_src,
+eth_dst) entry per host pair, installed after the controller has forwarded
+the packet.
+
+DestinationMatchStrategy keeps two tables per datapath so the table only
+grows with the number of hosts:
+
+    table 0  eth_src=X, in_port=P -> goto 1     (one per learned host)
+             table-miss           -> CONTROLLER, goto 1
+    table 1  eth_dst=X            -> output P   (one per learned host)
+             table-miss           -> FLOOD
+
+A PacketIn is only a notification that a new source showed up; the switch
+forwards the frame itself through table 1. ARP requests are the exception:
+a priority-2 entry in table 0 sends them to the controller only, so the
+app's ARP proxy (see host_tracker) can answer them instead of the switch
+flooding them, and packet_in() floods the ones it could not answer. ARP
+replies are copied to the controller so it learns the answering hosts.
+Source entries carry idle/hard timeouts and are installed with
+OFPFF_SEND_FLOW_REM, so when one ages out the controller forgets the host
+and removes its destination entry.
+"""
+
+from ryu.lib.packet import arp
+from ryu.lib.packet import ether_types
+
+from flow_sync import learn_from_flow, output_port
+
+
+class ExactMatchStrategy(object):
+    name = 'exact'
+    # only needs per-datapath state, see packet_workers
+    shardable = True
+
+    def __init__(self, app, priority=1, idle_timeout=0, hard_timeout=0):
+        self.app = app
+        self.priority = priority
+        self.idle_timeout = idle_timeout
+        self.hard_timeout = hard_timeout
+
+    def switch_connected(self, datapath):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        # frames are forwarded from this switch, they may stay buffered
+        match = parser.OFPMatch()
+        max_len = self.app.buffering.max_len(datapath)
+        actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER, max_len)]
+        self.app.add_flow(datapath, 0, match, actions)
+
+    def host_seen(self, datapath, src, in_port):
+        self.app.mac_to_port[datapath.id][src] = in_port
+
+    def packet_in(self, msg, in_port, src, dst):
+        datapath = msg.datapath
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        mac_to_port = self.app.mac_to_port[datapath.id]
+
+        self.host_seen(datapath, src, in_port)
+
+        if dst in mac_to_port:
+            out_port = mac_to_port[dst]
+        else:
+            out_port = ofproto.OFPP_FLOOD
+
+        actions = [parser.OFPActionOutput(out_port)]
+
+        # install a flow to avoid packet_in next time
+        if out_port != ofproto.OFPP_FLOOD:
+            match = parser.OFPMatch(in_port=in_port, eth_dst=dst, eth_src=src)
+            # verify if we have a valid buffer_id, if yes avoid to send both
+            # flow_mod & packet_out
+            if msg.buffer_id != ofproto.OFP_NO_BUFFER:
+                self.app.add_flow(datapath, self.priority, match, actions,
+                                  msg.buffer_id,
+                                  idle_timeout=self.idle_timeout,
+                                  hard_timeout=self.hard_timeout)
+                return
+            self.app.add_flow(datapath, self.priority, match, actions,
+                              idle_timeout=self.idle_timeout,
+                              hard_timeout=self.hard_timeout)
+
+        data = None
+        if msg.buffer_id == ofproto.OFP_NO_BUFFER:
+            data = msg.data
+
+        out = parser.OFPPacketOut(datapath=datapath, buffer_id=msg.buffer_id,
+                                  in_port=in_port, actions=actions, data=data)
+        self.app.flow_programmer.send(datapath, out)
+
+    def flow_removed(self, msg):
+        pass
+
+    def reconcile(self, datapath, stats):
+        mac_to_port = self.app.mac_to_port.setdefault(datapath.id, {})
+        stale = []
+        for stat in stats:
+            match = stat.match
+            if stat.table_id != 0 or stat.priority != self.priority or \
+                    'eth_src' not in match:
+                continue
+            if not learn_from_flow(mac_to_port,
+                                   [(match['eth_src'], match['in_port']),
+                                    (match['eth_dst'], output_port(stat))]):
+                stale.append(stat)
+        return stale
+
+    def dump(self):
+        return {}
+
+    def restore(self, tables):
+        pass
+
+
+class DestinationMatchStrategy(object):
+    name = 'dst'
+    shardable = True
+
+    src_table = 0
+    dst_table = 1
+    # marks PacketIns of ARP requests the switch did not forward
+    arp_cookie = 0xa1
+
+    def __init__(self, app, priority=1, idle_timeout=60, hard_timeout=600):
+        self.app = app
+        self.priority = priority
+        self.idle_timeout = idle_timeout
+        self.hard_timeout = hard_timeout
+
+    def switch_connected(self, datapath):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        # unknown sources are copied to the controller and still forwarded
+        match = parser.OFPMatch()
+        actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,
+                                          ofproto.OFPCML_NO_BUFFER)]
+        self.app.add_flow(datapath, 0, match, actions,
+                          table_id=self.src_table, goto_table=self.dst_table)
+
+        # unknown destinations are flooded by the switch
+        actions = [parser.OFPActionOutput(ofproto.OFPP_FLOOD)]
+        self.app.add_flow(datapath, 0, match, actions,
+                          table_id=self.dst_table)
+
+        # ARP requests are answered or flooded by the controller
+        match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_ARP,
+                                arp_op=arp.ARP_REQUEST)
+        actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,
+                                          ofproto.OFPCML_NO_BUFFER)]
+        self.app.add_flow(datapath, 2, match, actions,
+                          table_id=self.src_table, cookie=self.arp_cookie)
+
+        match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_ARP,
+                                arp_op=arp.ARP_REPLY)
+        self.app.add_flow(datapath, 2, match, actions,
+                          table_id=self.src_table, goto_table=self.dst_table)
+
+    def host_seen(self, datapath, src, in_port):
+        mac_to_port = self.app.mac_to_port[datapath.id]
+
+        # several PacketIns can race the first install, only act once
+        if mac_to_port.get(src) == in_port:
+            return
+        mac_to_port[src] = in_port
+        self.learn(datapath, src, in_port)
+
+    def packet_in(self, msg, in_port, src, dst):
+        datapath = msg.datapath
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        self.host_seen(datapath, src, in_port)
+
+        if msg.cookie == self.arp_cookie:
+            # last resort for ARP requests the proxy could not answer
+            actions = [parser.OFPActionOutput(ofproto.OFPP_FLOOD)]
+            out = parser.OFPPacketOut(datapath=datapath,
+                                      buffer_id=ofproto.OFP_NO_BUFFER,
+                                      in_port=in_port, actions=actions,
+                                      data=msg.data)
+            self.app.flow_programmer.send(datapath, out)
+
+    def learn(self, datapath, mac, port):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        # the destination entry goes first so the source entry never
+        # diverts traffic into a table that cannot forward it yet
+        match = parser.OFPMatch(eth_dst=mac)
+        actions = [parser.OFPActionOutput(port)]
+        self.app.add_flow(datapath, self.priority, match, actions,
+                          table_id=self.dst_table)
+
+        match = parser.OFPMatch(in_port=port, eth_src=mac)
+        self.app.add_flow(datapath, self.priority, match, [],
+                          table_id=self.src_table, goto_table=self.dst_table,
+                          idle_timeout=self.idle_timeout,
+                          hard_timeout=self.hard_timeout,
+                          flags=ofproto.OFPFF_SEND_FLOW_REM)
+
+    def flow_removed(self, msg):
+        datapath = msg.datapath
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        if msg.table_id != self.src_table or 'eth_src' not in msg.match:
+            return
+        mac = msg.match['eth_src']
+        port = msg.match['in_port']
+        mac_to_port = self.app.mac_to_port.get(datapath.id, {})
+        # the host may have been re-learned on another port meanwhile
+        if mac_to_port.get(mac) != port:
+            return
+        del mac_to_port[mac]
+
+        match = parser.OFPMatch(eth_dst=mac)
+        mod = parser.OFPFlowMod(datapath=datapath, table_id=self.dst_table,
+                                command=ofproto.OFPFC_DELETE,
+                                out_port=ofproto.OFPP_ANY,
+                                out_group=ofproto.OFPG_ANY, match=match)
+        self.app.flow_programmer.submit(datapath, mod)
+
+    def reconcile(self, datapath, stats):
+        mac_to_port = self.app.mac_to_port.setdefault(datapath.id, {})
+        stale = []
+        sources = {}
+        for stat in stats:
+            if stat.table_id != self.src_table or \
+                    stat.priority != self.priority or \
+                    'eth_src' not in stat.match:
+                continue
+            mac = stat.match['eth_src']
+            port = stat.match['in_port']
+            if mac_to_port.get(mac, port) != port:
+                stale.append(stat)
+            else:
+                sources[mac] = port
+        for stat in stats:
+            if stat.table_id != self.dst_table or \
+                    stat.priority != self.priority or \
+                    'eth_dst' not in stat.match:
+                continue
+            # flow_removed() only cleans up after hosts with a source entry
+            if sources.get(stat.match['eth_dst']) != output_port(stat):
+                stale.append(stat)
+        # a host without its source entry would never be learned again
+        mac_to_port.clear()
+        mac_to_port.update(sources)
+        return stale
+
+    def dump(self):
+        return {}
+
+    def restore(self, tables):
+        pass
+
+
+class ShortestPathStrategy(object):
+    name = 'path'
+    shardable = False
+
+    cookie = 0xa2
+
+    def __init__(self, app, priority=1, idle_timeout=60, hard_timeout=600):
+        self.app = app
+        self.priority = priority
+        self.idle_timeout = idle_timeout
+        self.hard_timeout = hard_timeout
+        # mac -> (dpid, port) of hosts that have paths installed to them
+        self.routed = {}
+        app.topology.link_listeners.append(self.link_changed)
+
+    def switch_connected(self, datapath):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        match = parser.OFPMatch()
+        actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,
+                                          ofproto.OFPCML_NO_BUFFER)]
+        self.app.add_flow(datapath, 0, match, actions)
+
+    def host_seen(self, datapath, src, in_port):
+        self.app.mac_to_port[datapath.id][src] = in_port
+        location = self.routed.get(src)
+        if location is not None and \
+                location != self.app.hosts.location(src):
+            # the host moved, the old paths lead to where it was
+            self.unroute(src)
+
+    def packet_in(self, msg, in_port, src, dst):
+        datapath = msg.datapath
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        topology = self.app.topology
+
+        self.host_seen(datapath, src, in_port)
+
+        location = self.app.hosts.location(dst)
+        hops = None
+        if location is not None:
+            hops = topology.path(datapath.id, location[0])
+        if hops is None:
+            self.flood(datapath, in_port, msg.data)
+            return
+        dst_dpid, dst_port = location
+        if (dst_dpid, dst_port) == (datapath.id, in_port):
+            return
+
+        # the destination's switch first, so the packet never meets a
+        # switch on the path that does not know where to send it
+        match = parser.OFPMatch(eth_dst=dst)
+        for dpid, out_port in reversed(hops):
+            if out_port is None:
+                out_port = dst_port
+            self.app.add_flow(topology.datapaths[dpid], self.priority, match,
+                              [parser.OFPActionOutput(out_port)],
+                              idle_timeout=self.idle_timeout,
+                              hard_timeout=self.hard_timeout,
+                              cookie=self.cookie)
+        self.routed[dst] = location
+
+        egress = topology.datapaths[dst_dpid]
+        actions = [parser.OFPActionOutput(dst_port)]
+        out = parser.OFPPacketOut(datapath=egress,
+                                  buffer_id=ofproto.OFP_NO_BUFFER,
+                                  in_port=ofproto.OFPP_CONTROLLER,
+                                  actions=actions, data=msg.data)
+        self.app.flow_programmer.send(egress, out)
+
+    def flood(self, datapath, in_port, data):
+        topology = self.app.topology
+        for dp in list(topology.datapaths.values()):
+            ofproto = dp.ofproto
+            parser = dp.ofproto_parser
+            ports = [p for p in topology.edge_ports(dp.id)
+                     if (dp.id, p) != (datapath.id, in_port)]
+            if not ports:
+                continue
+            actions = [parser.OFPActionOutput(p) for p in ports]
+            out = parser.OFPPacketOut(datapath=dp,
+                                      buffer_id=ofproto.OFP_NO_BUFFER,
+                                      in_port=ofproto.OFPP_CONTROLLER,
+                                      actions=actions, data=data)
+            self.app.flow_programmer.send(dp, out)
+
+    def unroute(self, mac):
+        self.routed.pop(mac, None)
+        for datapath in list(self.app.topology.datapaths.values()):
+            ofproto = datapath.ofproto
+            parser = datapath.ofproto_parser
+            mod = parser.OFPFlowMod(datapath=datapath, cookie=self.cookie,
+                                    cookie_mask=0xffffffffffffffff,
+                                    command=ofproto.OFPFC_DELETE,
+                                    out_port=ofproto.OFPP_ANY,
+                                    out_group=ofproto.OFPG_ANY,
+                                    match=parser.OFPMatch(eth_dst=mac))
+            self.app.flow_programmer.submit(datapath, mod)
+
+    def link_changed(self, link, up, stale):
+        stale = set(stale)
+        for mac, (dpid, _port) in list(self.routed.items()):
+            if dpid in stale:
+                self.unroute(mac)
+
+    def flow_removed(self, msg):
+        pass
+
+    def reconcile(self, datapath, stats):
+        hosts = self.app.hosts
+        stale = []
+        for stat in stats:
+            if stat.cookie != self.cookie:
+                continue
+            mac = stat.match.get('eth_dst')
+            location = self.routed.get(mac)
+            # paths are only known to be right while the host stays put
+            if location is None or location != hosts.location(mac):
+                stale.append(stat)
+        return stale
+
+    def dump(self):
+        return {'routed': self.routed}
+
+    def restore(self, tables):
+        self.routed.update(tables.get('routed', {}))
+
+
+STRATEGIES = {
+    ExactMatchStrategy.name: ExactMatchStrategy,
+    DestinationMatchStrategy.name: DestinationMatchStrategy,
+    ShortestPathStrategy.name: ShortestPathStrategy,
+}
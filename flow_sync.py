@@ -0,0 +1,96 @@
+"""Reconciling a switch's flows with the app's state on (re)connect.
+
+A switch keeps its flows while the controller restarts or its connection
+drops. Instead of leaving them alone, or wiping them and relearning every
+host, the apps read them back: switch_connected() sends an
+OFPFlowStatsRequest for all tables and, once the last part of the reply is
+in, hands the flows to the app's reconcile(datapath, stats). That diffs
+them against the app's state, learned while connected or restored by
+state_store:
+
+  * a flow that contradicts the state, e.g. forwarding to a host on a port
+    it is no longer known on, is returned and deleted here;
+  * a flow the state knows nothing about teaches the app what it can,
+    e.g. where its hosts are, and stays;
+  * state the switch has no flow for is dropped where the app relies on
+    the flow being there, so it is learned, and installed, again.
+
+Flows the app did not install itself (table-miss, punts, meters' and the
+guard's drop flows) are left to the app's usual connect-time handling.
+
+The owning app forwards EventOFPFlowStatsReply to flow_stats_reply(),
+which tells whether the reply belonged to a reconciliation.
+"""
+
+
+def output_port(stat):
+    """The port a flow's apply-actions output to, None if not exactly one."""
+    ports = [action.port for inst in stat.instructions
+             for action in getattr(inst, 'actions', [])
+             if hasattr(action, 'port')]
+    if len(ports) != 1:
+        return None
+    return ports[0]
+
+
+def learn_from_flow(mac_to_port, locations):
+    """Whether a flow installed for these (mac, port) locations agrees
+    with mac_to_port; if it does, the ones missing there are learned."""
+    for mac, port in locations:
+        if port is None or mac_to_port.get(mac, port) != port:
+            return False
+    for mac, port in locations:
+        mac_to_port.setdefault(mac, port)
+    return True
+
+
+class FlowReconciler(object):
+    def __init__(self, app):
+        self.app = app
+        # (dpid, xid) -> flow stats collected until the last part
+        self.pending = {}
+        self.stats = {'switches': 0, 'kept': 0, 'deleted': 0}
+
+    def switch_connected(self, datapath):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        for key in [k for k in self.pending if k[0] == datapath.id]:
+            del self.pending[key]
+
+        req = parser.OFPFlowStatsRequest(datapath,
+                                         table_id=ofproto.OFPTT_ALL)
+        datapath.set_xid(req)
+        self.pending[(datapath.id, req.xid)] = []
+        datapath.send_msg(req)
+
+    def flow_stats_reply(self, msg):
+        """False if the reply was not for a reconciliation."""
+        datapath = msg.datapath
+        parts = self.pending.get((datapath.id, msg.xid))
+        if parts is None:
+            return False
+        parts.extend(msg.body)
+        if msg.flags & datapath.ofproto.OFPMPF_REPLY_MORE:
+            return True
+        del self.pending[(datapath.id, msg.xid)]
+        self._reconcile(datapath, parts)
+        return True
+
+    def _reconcile(self, datapath, stats):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        stale = self.app.reconcile(datapath, stats)
+        for stat in stale:
+            mod = parser.OFPFlowMod(datapath=datapath, table_id=stat.table_id,
+                                    command=ofproto.OFPFC_DELETE_STRICT,
+                                    priority=stat.priority,
+                                    out_port=ofproto.OFPP_ANY,
+                                    out_group=ofproto.OFPG_ANY,
+                                    match=stat.match)
+            self.app.flow_programmer.submit(datapath, mod)
+        self.stats['switches'] += 1
+        self.stats['kept'] += len(stats) - len(stale)
+        self.stats['deleted'] += len(stale)
+        self.app.logger.info("switch %s reconciled: %d flows, %d stale "
+                             "deleted", datapath.id, len(stats), len(stale))
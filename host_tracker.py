@@ -0,0 +1,165 @@
+"""Controller-wide host tracker and ARP proxy.
+
+HostTracker learns MAC -> (dpid, port) from the source of every PacketIn
+and IP -> MAC from ARP senders, across all switches. arp_proxy() answers
+an ARP request for a known IP with a reply built by the controller and
+sent back out of the port the request came in on, so the request does not
+have to be flooded; only requests for unknown hosts still are.
+
+IPs are only learned from ARP, not from IPv4 sources: a router forwards
+packets for many IPs from its own MAC and must not end up answering for
+all of them.
+
+A host keeps the first switch port it was seen on. Copies of flooded
+frames reach the other switches over the inter-switch links and must not
+relocate it; it only moves when seen on another port of the same switch,
+on an edge port the caller vouches for (see topology), or once its entry
+is older than host_timeout.
+"""
+
+import time
+
+from ryu.lib.packet import packet
+from ryu.lib.packet import ethernet
+from ryu.lib.packet import ether_types
+from ryu.lib.packet import arp
+
+_UNSPECIFIED_IP = '0.0.0.0'
+
+
+class Host(object):
+    __slots__ = ('mac', 'ip', 'dpid', 'port', 'last_seen')
+
+    def __init__(self, mac, dpid, port):
+        self.mac = mac
+        self.ip = None
+        self.dpid = dpid
+        self.port = port
+        self.last_seen = time.monotonic()
+
+
+class HostTracker(object):
+    def __init__(self, host_timeout=600):
+        self.host_timeout = host_timeout
+        self.hosts = {}
+        self.ip_to_mac = {}
+        self.stats = {'arp_replied': 0, 'arp_unknown': 0, 'arp_blocked': 0}
+
+    def _expired(self, host, now):
+        return self.host_timeout and \
+            now - host.last_seen > self.host_timeout
+
+    def learn(self, dpid, port, hdr, edge=False):
+        # group addresses are never a host's source
+        if int(hdr.src[:2], 16) & 1:
+            return None
+        now = time.monotonic()
+        host = self.hosts.get(hdr.src)
+        if host is None or self._expired(host, now):
+            if host is not None and host.ip is not None:
+                self.ip_to_mac.pop(host.ip, None)
+            host = self.hosts[hdr.src] = Host(hdr.src, dpid, port)
+        elif (host.dpid, host.port) != (dpid, port) and \
+                (edge or host.dpid == dpid):
+            host.dpid = dpid
+            host.port = port
+        host.last_seen = now
+
+        ip = hdr.arp_src_ip
+        if hdr.arp_opcode is not None and ip != _UNSPECIFIED_IP and \
+                ip != host.ip:
+            if host.ip is not None and \
+                    self.ip_to_mac.get(host.ip) == host.mac:
+                del self.ip_to_mac[host.ip]
+            previous = self.hosts.get(self.ip_to_mac.get(ip))
+            if previous is not None:
+                # the address was handed over to another host
+                previous.ip = None
+            host.ip = ip
+            self.ip_to_mac[ip] = host.mac
+        return host
+
+    def host(self, mac):
+        host = self.hosts.get(mac)
+        if host is None or self._expired(host, time.monotonic()):
+            return None
+        return host
+
+    def lookup_ip(self, ip):
+        return self.host(self.ip_to_mac.get(ip))
+
+    def location(self, mac):
+        host = self.host(mac)
+        if host is None:
+            return None
+        return host.dpid, host.port
+
+    def forget_switch(self, dpid):
+        for mac, host in list(self.hosts.items()):
+            if host.dpid == dpid:
+                del self.hosts[mac]
+                if host.ip is not None and \
+                        self.ip_to_mac.get(host.ip) == mac:
+                    del self.ip_to_mac[host.ip]
+
+    def dump(self):
+        """mac -> (dpid, port, ip, last seen in wall-clock seconds)."""
+        age = time.time() - time.monotonic()
+        return dict((mac, (host.dpid, host.port, host.ip,
+                           int(host.last_seen + age)))
+                    for mac, host in self.hosts.items())
+
+    def restore(self, entries):
+        now = time.monotonic()
+        age = time.time() - now
+        for mac, (dpid, port, ip, last_seen) in entries.items():
+            host = Host(mac, dpid, port)
+            host.ip = ip
+            host.last_seen = last_seen - age
+            if self._expired(host, now):
+                continue
+            self.hosts[mac] = host
+            if ip is not None:
+                self.ip_to_mac[ip] = mac
+
+    def arp_proxy(self, datapath, in_port, hdr, blocked=None):
+        """Answer an ARP request from the cache.
+
+        Returns True if a reply was sent and the request must not be
+        forwarded, False if the caller has to deliver it as usual.
+        blocked(src, dst) is true for MAC pairs a firewall drops; no reply
+        is made up for a host whose own reply would be dropped.
+        """
+        if hdr.arp_opcode != arp.ARP_REQUEST:
+            return False
+        # gratuitous ARP and address probes announce, they are not asking
+        if hdr.arp_src_ip in (hdr.arp_dst_ip, _UNSPECIFIED_IP):
+            return False
+        host = self.lookup_ip(hdr.arp_dst_ip)
+        if host is None or host.mac == hdr.arp_src_mac:
+            self.stats['arp_unknown'] += 1
+            return False
+        if blocked is not None and blocked(host.mac, hdr.arp_src_mac):
+            self.stats['arp_blocked'] += 1
+            return False
+
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        pkt = packet.Packet()
+        pkt.add_protocol(ethernet.ethernet(
+            dst=hdr.arp_src_mac, src=host.mac,
+            ethertype=ether_types.ETH_TYPE_ARP))
+        pkt.add_protocol(arp.arp(
+            opcode=arp.ARP_REPLY, src_mac=host.mac, src_ip=host.ip,
+            dst_mac=hdr.arp_src_mac, dst_ip=hdr.arp_src_ip))
+        pkt.serialize()
+
+        actions = [parser.OFPActionOutput(in_port)]
+        out = parser.OFPPacketOut(datapath=datapath,
+                                  buffer_id=ofproto.OFP_NO_BUFFER,
+                                  in_port=ofproto.OFPP_CONTROLLER,
+                                  actions=actions, data=pkt.data)
+        datapath.send_msg(out)
+        self.stats['arp_replied'] += 1
+        return True
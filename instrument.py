@@ -0,0 +1,312 @@
+"""Timing histograms, sampled logging and profiling for the apps.
+
+Instrumentation.instrument(app) times every ryu event handler of an app
+and the stages a PacketIn goes through:
+
+    parse        pkt_headers.parse, called as instr.parse()
+    flow_install the app's add_flow
+    packet_out   datapath.send_msg of OFPPacketOuts, for datapaths passed
+                 to watch() on connect
+    lookup       what is left of the PacketIn handler: learning, table and
+                 policy lookups, decisions
+
+A Histogram keeps counts in power-of-two microsecond buckets, so
+observing costs a clock read, a frexp and an increment whatever the rate.
+to_dict() has every histogram's count, sum, p50/p99/max and buckets; with
+a path it is also written there as JSON every interval seconds and on
+close(), for comparing runs under load.
+
+log_sampled() logs one call in log_every instead of each PacketIn.
+
+On demand, while the controller runs:
+
+    kill -USR1 <pid>   cProfile for profile_seconds, stats written to
+                       <profile_dir>/<app>-<time>.prof (pstats format)
+    kill -USR2 <pid>   stack sampler for profile_seconds, every
+                       sample_interval seconds, folded stacks written to
+                       <profile_dir>/<app>-<time>.folded (flamegraph.pl)
+
+The sampler runs in an OS thread and only reads the event loop's stack,
+so the handlers pay nothing for it. Signals are only taken if nothing
+else in the process has claimed them.
+"""
+
+import cProfile
+import functools
+import inspect
+import json
+import math
+import os
+import signal
+import sys
+import time
+import types
+
+from eventlet import patcher
+
+from ryu.lib import hub
+
+import pkt_headers
+
+_BUCKETS = 32
+_clock = time.perf_counter
+_real_threading = patcher.original('threading')
+_real_time = patcher.original('time')
+
+
+class Histogram(object):
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        # counts[i]: observations under 2**i microseconds
+        self.counts = [0] * _BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[min(math.frexp(seconds * 1e6)[1], _BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q quantile, in us."""
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return float(2 ** i)
+        return 0.0
+
+    def to_dict(self):
+        return {'count': self.count,
+                'sum_us': self.total * 1e6,
+                'p50_us': self.percentile(0.50),
+                'p99_us': self.percentile(0.99),
+                'max_us': self.max * 1e6,
+                'buckets_us': dict((str(2 ** i), n)
+                                   for i, n in enumerate(self.counts) if n)}
+
+
+class Instrumentation(object):
+    def __init__(self, app, path=None, interval=10, log_every=100,
+                 profile_dir='.', profile_seconds=10, sample_interval=0.005):
+        self.app = app
+        self.path = path
+        self.interval = interval
+        self.log_every = log_every
+        self.profile_dir = profile_dir
+        self.profile_seconds = profile_seconds
+        self.sample_interval = sample_interval
+        self.histograms = {}
+        # time spent in timed stages during the running handler
+        self.inside = 0.0
+        self.logged = 0
+        self.profiling = False
+        self.thread = None
+
+    def _histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        return histogram
+
+    def observe(self, name, seconds):
+        self._histogram(name).observe(seconds)
+
+    def timed(self, name, func):
+        """func, timed as stage name."""
+        histogram = self._histogram('stage.' + name)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # stages timed inside this one are part of its time already
+            outer = self.inside
+            t0 = _clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                took = _clock() - t0
+                histogram.observe(took)
+                self.inside = outer + took
+        return wrapper
+
+    def _handler(self, name, method):
+        histogram = self._histogram('handler.' + name)
+        # whatever the PacketIn handler does outside the timed stages
+        own = self._histogram('stage.lookup') \
+            if name == '_packet_in_handler' else None
+        func = method.__func__
+
+        # keeps set_ev_cls' callers, so ryu registers the wrapper
+        @functools.wraps(func)
+        def wrapper(app, ev):
+            outer = self.inside
+            self.inside = 0.0
+            t0 = _clock()
+            try:
+                return func(app, ev)
+            finally:
+                took = _clock() - t0
+                histogram.observe(took)
+                if own is not None:
+                    own.observe(max(took - self.inside, 0.0))
+                self.inside = outer
+        return types.MethodType(wrapper, method.__self__)
+
+    def instrument(self, app):
+        """Time app's event handlers and its add_flow."""
+        for name, method in inspect.getmembers(app, inspect.ismethod):
+            if hasattr(method, 'callers'):
+                setattr(app, name, self._handler(name, method))
+        if hasattr(app, 'add_flow'):
+            app.add_flow = self.timed('flow_install', app.add_flow)
+
+    def wrap(self, obj, name, stage=None):
+        """Time obj's method name as a stage of its own."""
+        setattr(obj, name, self.timed(stage or name, getattr(obj, name)))
+
+    def watch(self, datapath):
+        """Time the PacketOuts sent to datapath."""
+        send_msg = datapath.send_msg
+        if getattr(send_msg, 'instrumented', False):
+            return
+        histogram = self._histogram('stage.packet_out')
+        packet_out = datapath.ofproto_parser.OFPPacketOut
+
+        def wrapper(msg, *args, **kwargs):
+            if not isinstance(msg, packet_out):
+                return send_msg(msg, *args, **kwargs)
+            t0 = _clock()
+            try:
+                return send_msg(msg, *args, **kwargs)
+            finally:
+                took = _clock() - t0
+                histogram.observe(took)
+                self.inside += took
+        wrapper.instrumented = True
+        datapath.send_msg = wrapper
+
+    def parse(self, data):
+        t0 = _clock()
+        try:
+            return pkt_headers.parse(data)
+        finally:
+            took = _clock() - t0
+            self._histogram('stage.parse').observe(took)
+            self.inside += took
+
+    def log_sampled(self, logger, msg, *args):
+        """logger.info for the first call and every log_every-th after."""
+        self.logged += 1
+        if self.log_every and (self.logged - 1) % self.log_every == 0:
+            logger.info(msg + ' (1 in %d)', *(args + (self.log_every,)))
+
+    def to_dict(self):
+        return {'app': self.app.__class__.__module__,
+                'time': time.time(),
+                'histograms': dict((name, h.to_dict()) for name, h in
+                                   sorted(self.histograms.items()))}
+
+    def start(self):
+        if self.path is not None and self.thread is None:
+            self.thread = hub.spawn(self._writer)
+        for signum, handler in ((signal.SIGUSR1, self._profile_signal),
+                                (signal.SIGUSR2, self._sample_signal)):
+            try:
+                if signal.getsignal(signum) == signal.SIG_DFL:
+                    signal.signal(signum, handler)
+            except ValueError:
+                # not the main thread, no signals
+                pass
+
+    def _writer(self):
+        while True:
+            hub.sleep(self.interval)
+            try:
+                self.write()
+            except OSError as e:
+                self.app.logger.error("writing timings to %s failed: %s",
+                                      self.path, e)
+
+    def write(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+        os.replace(tmp, self.path)
+
+    def close(self):
+        if self.thread is not None:
+            hub.kill(self.thread)
+            self.thread = None
+        if self.path is not None:
+            self.write()
+
+    def _output(self, suffix):
+        return os.path.join(self.profile_dir, '%s-%d.%s' % (
+            self.app.__class__.__module__, time.time(), suffix))
+
+    def _profile_signal(self, signum, frame):
+        hub.spawn(self.profile)
+
+    def _sample_signal(self, signum, frame):
+        hub.spawn(self.sample)
+
+    def profile(self, seconds=None):
+        """cProfile the event loop for seconds, returns the stats file."""
+        if self.profiling:
+            return None
+        self.profiling = True
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            hub.sleep(seconds or self.profile_seconds)
+        finally:
+            profiler.disable()
+            self.profiling = False
+        path = self._output('prof')
+        profiler.dump_stats(path)
+        self.app.logger.info("cProfile stats written to %s", path)
+        return path
+
+    def sample(self, seconds=None):
+        """Sample the event loop's stack for seconds, returns the file."""
+        if self.profiling:
+            return None
+        self.profiling = True
+        stacks = {}
+        target = _real_threading.get_ident()
+        thread = _real_threading.Thread(
+            target=self._sampler,
+            args=(target, seconds or self.profile_seconds, stacks))
+        thread.daemon = True
+        thread.start()
+        # the event loop keeps running while the sampler looks at it
+        while thread.is_alive():
+            hub.sleep(0.1)
+        self.profiling = False
+        path = self._output('folded')
+        with open(path, 'w') as f:
+            for stack, n in sorted(stacks.items(), key=lambda x: -x[1]):
+                f.write('%s %d\n' % (stack, n))
+        self.app.logger.info("%d stack samples written to %s",
+                             sum(stacks.values()), path)
+        return path
+
+    def _sampler(self, target, seconds, stacks):
+        end = _real_time.time() + seconds
+        while _real_time.time() < end:
+            frame = sys._current_frames().get(target)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append('%s:%s' % (
+                    os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if names:
+                stack = ';'.join(reversed(names))
+                stacks[stack] = stacks.get(stack, 0) + 1
+            _real_time.sleep(self.sample_interval)
@@ -0,0 +1,241 @@
+"""Per-connection state for load_balancer's reactive mode.
+
+Connections are keyed by the client's 5-tuple (client ip, VIP, ip_proto,
+client port, service port) and stay on the back-end picked when they were
+first seen, so changing the pool only affects connections that start
+afterwards. The load balancer installs one pair of rewrite flows per
+connection and reports what happens to them:
+
+    open       first packet seen, flows installed
+    closing    a FIN went one way (TCP)
+    closed     FINs both ways or a RST; flows removed, the entry lingers
+               for time_wait so stray segments reach the same back-end
+    idle       the flows idled out; the entry lingers for linger seconds
+               so a connection that resumes keeps its back-end
+
+With sticky_timeout set, new connections from a client go to the back-end
+its previous connection used while that was less than sticky_timeout
+seconds ago and the back-end is still in the pool.
+"""
+
+import time
+
+TCP_FIN = 0x01
+TCP_RST = 0x04
+
+OPEN = 'open'
+CLOSING = 'closing'
+CLOSED = 'closed'
+IDLE = 'idle'
+
+
+class Connection(object):
+    __slots__ = ('key', 'backend', 'dpid', 'client_port', 'client_mac',
+                 'state', 'fins', 'counted', 'last_seen')
+
+    def __init__(self, key, backend, dpid, client_port, client_mac):
+        self.key = key
+        self.backend = backend
+        self.dpid = dpid
+        self.client_port = client_port
+        self.client_mac = client_mac
+        self.state = OPEN
+        # directions a FIN was seen in, True for the client's
+        self.fins = set()
+        # whether the scheduler counts it as an open connection
+        self.counted = False
+        self.last_seen = time.monotonic()
+
+
+class ConnectionTable(object):
+    def __init__(self, sched, linger=300, time_wait=10, sticky_timeout=0):
+        self.sched = sched
+        self.linger = linger
+        self.time_wait = time_wait
+        self.sticky_timeout = sticky_timeout
+        self.connections = {}
+        # client ip -> (backend, last used)
+        self.affinity = {}
+        self.stats = {'opened': 0, 'resumed': 0, 'sticky': 0, 'closed': 0,
+                      'expired': 0}
+
+    def __len__(self):
+        return len(self.connections)
+
+    def _lifetime(self, conn):
+        if conn.state == CLOSED:
+            return self.time_wait
+        if conn.state == IDLE:
+            return self.linger
+        # flows are installed, the switch tells us when they go
+        return None
+
+    def lookup(self, key):
+        conn = self.connections.get(key)
+        if conn is None:
+            return None
+        lifetime = self._lifetime(conn)
+        if lifetime is not None and \
+                time.monotonic() - conn.last_seen > lifetime:
+            self._drop(conn)
+            self.stats['expired'] += 1
+            return None
+        return conn
+
+    def open(self, key, dpid, client_port, client_mac, allowed=None):
+        """Connection for a packet without FIN/RST, None if no back-end.
+
+        The bool returned with it tells whether its flows must be
+        installed. allowed, if given, is a predicate the back-end must
+        satisfy, see Scheduler.pick.
+        """
+        now = time.monotonic()
+        conn = self.lookup(key)
+        if conn is not None and conn.backend in self.sched.backends and \
+                (allowed is None or allowed(conn.backend)):
+            conn.last_seen = now
+            if conn.state != IDLE:
+                # raced its own flows, or a stray segment after the close
+                return conn, False
+            conn.state = OPEN
+            self._count(conn)
+            self.stats['resumed'] += 1
+            return conn, True
+        if conn is not None:
+            self._drop(conn)
+
+        backend = None
+        sticky = self.affinity.get(key[0])
+        if sticky is not None and self.sticky_timeout and \
+                now - sticky[1] <= self.sticky_timeout and \
+                sticky[0] in self.sched.backends and \
+                (allowed is None or allowed(sticky[0])):
+            backend = sticky[0]
+            self.stats['sticky'] += 1
+        if backend is None:
+            backend = self.sched.pick(key, allowed)
+            if backend is None:
+                return None, False
+        conn = self.connections[key] = Connection(key, backend, dpid,
+                                                  client_port, client_mac)
+        self._count(conn)
+        if self.sticky_timeout:
+            self.affinity[key[0]] = (backend, now)
+        self.stats['opened'] += 1
+        return conn, True
+
+    def tcp_flags(self, conn, flags, from_client):
+        """Track FIN/RST, True once the connection is closed."""
+        conn.last_seen = time.monotonic()
+        if conn.state == CLOSED:
+            return False
+        if flags & TCP_RST:
+            self._close(conn)
+            return True
+        if flags & TCP_FIN:
+            conn.fins.add(from_client)
+            if len(conn.fins) == 2:
+                self._close(conn)
+                return True
+            conn.state = CLOSING
+        return False
+
+    def idle(self, key):
+        """The connection's flows were removed by the switch."""
+        conn = self.connections.get(key)
+        if conn is None or conn.state == CLOSED:
+            return
+        conn.state = IDLE
+        conn.last_seen = time.monotonic()
+        self._uncount(conn)
+
+    def adopt(self, key, backend, dpid, client_port, client_mac):
+        """A connection whose flows were found in the switch."""
+        conn = self.connections[key] = Connection(key, backend, dpid,
+                                                  client_port, client_mac)
+        self._count(conn)
+        return conn
+
+    def switch_reset(self, dpid, installed=()):
+        """The switch lost its flows, reinstall on the next packet.
+
+        Connections whose keys are in installed still have theirs.
+        """
+        for conn in self.connections.values():
+            if conn.dpid == dpid and conn.state in (OPEN, CLOSING) and \
+                    conn.key not in installed:
+                conn.state = IDLE
+                conn.last_seen = time.monotonic()
+                self._uncount(conn)
+
+    def backend_removed(self, backend):
+        """Forget the back-end's connections, they will be re-mapped."""
+        for conn in list(self.connections.values()):
+            if conn.backend is backend:
+                self._drop(conn)
+        for client, (sticky, _last) in list(self.affinity.items()):
+            if sticky is backend:
+                del self.affinity[client]
+
+    def expire(self):
+        now = time.monotonic()
+        for conn in list(self.connections.values()):
+            lifetime = self._lifetime(conn)
+            if lifetime is not None and now - conn.last_seen > lifetime:
+                self._drop(conn)
+                self.stats['expired'] += 1
+        if self.sticky_timeout:
+            for client, (_backend, last) in list(self.affinity.items()):
+                if now - last > self.sticky_timeout:
+                    del self.affinity[client]
+
+    def dump(self):
+        """The 'connections' and 'affinity' tables for state_store."""
+        age = time.time() - time.monotonic()
+        connections = dict(
+            (key, (conn.backend.name, conn.dpid, conn.client_port,
+                   conn.client_mac, conn.state, tuple(sorted(conn.fins)),
+                   int(conn.last_seen + age)))
+            for key, conn in self.connections.items())
+        affinity = dict((client, (backend.name, int(last + age)))
+                        for client, (backend, last) in self.affinity.items())
+        return {'connections': connections, 'affinity': affinity}
+
+    def restore(self, tables, backends):
+        """Reload dump()'s tables, backends maps names to Backends."""
+        age = time.time() - time.monotonic()
+        for key, entry in tables.get('connections', {}).items():
+            name, dpid, client_port, client_mac, state, fins, last = entry
+            backend = backends.get(name)
+            if backend is None:
+                continue
+            conn = Connection(key, backend, dpid, client_port, client_mac)
+            conn.state = state
+            conn.fins = set(fins)
+            conn.last_seen = last - age
+            self.connections[key] = conn
+            if state in (OPEN, CLOSING):
+                self._count(conn)
+        for client, (name, last) in tables.get('affinity', {}).items():
+            if name in backends:
+                self.affinity[client] = (backends[name], last - age)
+        self.expire()
+
+    def _close(self, conn):
+        conn.state = CLOSED
+        self._uncount(conn)
+        self.stats['closed'] += 1
+
+    def _drop(self, conn):
+        self._uncount(conn)
+        self.connections.pop(conn.key, None)
+
+    def _count(self, conn):
+        if not conn.counted:
+            conn.counted = True
+            self.sched.connection_opened(conn.backend)
+
+    def _uncount(self, conn):
+        if conn.counted:
+            conn.counted = False
+            self.sched.connection_closed(conn.backend)
@@ -0,0 +1,96 @@
+"""Active health checking for load_balancer back-ends.
+
+HealthChecker sends an ARP request for every back-end's IP, sourced from
+the VIP, out of every switch each interval. Replies come back through the
+load balancer's PacketIn handler. A back-end that misses max_missed probes
+in a row, or whose switch port goes down, is reported to the app as down;
+the next reply brings it back.
+"""
+
+import time
+
+from ryu.lib import hub
+from ryu.lib.packet import packet
+from ryu.lib.packet import ethernet
+from ryu.lib.packet import ether_types
+from ryu.lib.packet import arp
+
+
+class HealthChecker(object):
+    def __init__(self, app, interval=0.2, max_missed=3):
+        self.app = app
+        self.interval = interval
+        self.max_missed = max_missed
+        self.thread = None
+        self.ips = set(b.ip for b in app.pool)
+        # back-ends get one full detection window from their first probe
+        # before being judged, however long the switches take to connect
+        self.last_seen = {}
+        self.down = set()
+
+    def start(self):
+        if self.thread is None:
+            self.thread = hub.spawn(self._run)
+
+    def _run(self):
+        while True:
+            for datapath in list(self.app.datapaths.values()):
+                for backend in self.app.pool:
+                    self.probe(datapath, backend)
+            hub.sleep(self.interval)
+            self.check()
+
+    def probe(self, datapath, backend):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        pkt = packet.Packet()
+        pkt.add_protocol(ethernet.ethernet(
+            dst=backend.mac, src=self.app.virtual_mac,
+            ethertype=ether_types.ETH_TYPE_ARP))
+        pkt.add_protocol(arp.arp(
+            opcode=arp.ARP_REQUEST, src_mac=self.app.virtual_mac,
+            src_ip=self.app.virtual_ip, dst_mac='00:00:00:00:00:00',
+            dst_ip=backend.ip))
+        pkt.serialize()
+
+        actions = [parser.OFPActionOutput(
+            self.app._backend_port(datapath, backend))]
+        out = parser.OFPPacketOut(datapath=datapath,
+                                  buffer_id=ofproto.OFP_NO_BUFFER,
+                                  in_port=ofproto.OFPP_CONTROLLER,
+                                  actions=actions, data=pkt.data)
+        datapath.send_msg(out)
+        self.last_seen.setdefault(backend.ip, time.monotonic())
+
+    def check(self):
+        deadline = time.monotonic() - self.interval * self.max_missed
+        for backend in self.app.pool:
+            if backend.ip not in self.down and \
+                    self.last_seen.get(backend.ip, deadline) < deadline:
+                self._mark_down(backend, 'missed %d probes' % self.max_missed)
+
+    def reply_received(self, ip):
+        if ip not in self.ips:
+            return
+        self.last_seen[ip] = time.monotonic()
+        if ip in self.down:
+            self.down.discard(ip)
+            backend = [b for b in self.app.pool if b.ip == ip][0]
+            self.app.logger.info("back-end %s is up", backend.name)
+            self.app.backend_up(backend)
+
+    def port_down(self, datapath, port_no):
+        # only where a back-end has been seen, not its configured port
+        learned = self.app.mac_to_port.get(datapath.id, {})
+        for backend in self.app.pool:
+            if backend.ip not in self.down and \
+                    learned.get(backend.mac) == port_no:
+                self._mark_down(backend, 'port %s of switch %s down' % (
+                    port_no, datapath.id))
+
+    def _mark_down(self, backend, reason):
+        self.down.add(backend.ip)
+        self.app.logger.warning("back-end %s is down: %s", backend.name,
+                                reason)
+        self.app.backend_down(backend)
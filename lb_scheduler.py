@@ -0,0 +1,169 @@
+"""Back-end pool and scheduling algorithms for load_balancer.
+
+A scheduler picks a Backend for a new client flow given its 5-tuple
+(src_ip, dst_ip, ip_proto, src_port, dst_port). The load balancer tells it
+when connections open and close and, for least-connections, feeds it the
+byte rate of each back-end's flows taken from flow stats.
+"""
+
+import bisect
+import hashlib
+
+
+class Backend(object):
+    def __init__(self, name, ip, mac, port, weight=1):
+        self.name = name
+        self.ip = ip
+        self.mac = mac
+        self.port = port
+        self.weight = weight
+        # open client flows and bytes/sec through them
+        self.connections = 0
+        self.byte_rate = 0.0
+
+    def __repr__(self):
+        return 'Backend(%s, %s, %s, port=%s, weight=%s)' % (
+            self.name, self.ip, self.mac, self.port, self.weight)
+
+
+class Scheduler(object):
+    name = None
+
+    def __init__(self, backends=()):
+        self.backends = []
+        for backend in backends:
+            self.add(backend)
+
+    def add(self, backend):
+        if backend not in self.backends:
+            self.backends.append(backend)
+            self._rebuild()
+
+    def remove(self, backend):
+        if backend in self.backends:
+            self.backends.remove(backend)
+            self._rebuild()
+
+    def _rebuild(self):
+        pass
+
+    def pick(self, key, allowed=None):
+        """Back-end for a new connection, None if there is none.
+
+        allowed, if given, is a predicate the back-end must satisfy.
+        """
+        raise NotImplementedError
+
+    def _candidates(self, allowed):
+        if allowed is None:
+            return self.backends
+        return [b for b in self.backends if allowed(b)]
+
+    def connection_opened(self, backend):
+        backend.connections += 1
+
+    def connection_closed(self, backend):
+        backend.connections = max(0, backend.connections - 1)
+
+    def update_load(self, backend, byte_rate):
+        backend.byte_rate = byte_rate
+
+
+class RoundRobin(Scheduler):
+    name = 'round_robin'
+
+    def __init__(self, backends=()):
+        self.next = 0
+        super(RoundRobin, self).__init__(backends)
+
+    def pick(self, key, allowed=None):
+        for i in range(len(self.backends)):
+            backend = self.backends[(self.next + i) % len(self.backends)]
+            if allowed is None or allowed(backend):
+                self.next += i + 1
+                return backend
+        return None
+
+
+class WeightedRoundRobin(Scheduler):
+    """Smooth weighted round-robin, spreads heavy back-ends out evenly."""
+    name = 'weighted_round_robin'
+
+    def _rebuild(self):
+        self.current = dict((b.name, 0) for b in self.backends)
+
+    def pick(self, key, allowed=None):
+        candidates = self._candidates(allowed)
+        if not candidates:
+            return None
+        # excluded back-ends neither gain credit nor count in the total
+        total = 0
+        best = None
+        for b in candidates:
+            self.current[b.name] += b.weight
+            total += b.weight
+            if best is None or self.current[b.name] > self.current[best.name]:
+                best = b
+        self.current[best.name] -= total
+        return best
+
+
+class LeastConnections(Scheduler):
+    """Pick the back-end with the least load per unit of weight.
+
+    A back-end's load is its measured byte rate plus, for each open
+    connection, the pool's average bytes/sec per connection. The rate only
+    changes when flow stats are polled, the connections with every pick,
+    so new connections spread out between polls; the rate makes back-ends
+    with heavy connections count for more.
+    """
+    name = 'least_connections'
+
+    def pick(self, key, allowed=None):
+        candidates = self._candidates(allowed)
+        if not candidates:
+            return None
+        connections = sum(b.connections for b in self.backends)
+        per_connection = 0.0
+        if connections:
+            per_connection = sum(b.byte_rate for b in self.backends) / \
+                connections
+        return min(candidates,
+                   key=lambda b: ((b.byte_rate +
+                                   b.connections * per_connection) / b.weight,
+                                  float(b.connections) / b.weight))
+
+
+class ConsistentHash(Scheduler):
+    """Hash ring on the 5-tuple, only remaps a share of flows on change."""
+    name = 'consistent_hash'
+
+    replicas = 100
+
+    @staticmethod
+    def _hash(value):
+        return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:8], 16)
+
+    def _rebuild(self):
+        ring = []
+        for b in self.backends:
+            for i in range(self.replicas * b.weight):
+                ring.append((self._hash('%s#%d' % (b.name, i)), b))
+        ring.sort(key=lambda x: x[0])
+        self.ring_keys = [h for h, _ in ring]
+        self.ring = [b for _, b in ring]
+
+    def pick(self, key, allowed=None):
+        if not self._candidates(allowed):
+            return None
+        h = self._hash('|'.join(str(k) for k in key))
+        i = bisect.bisect(self.ring_keys, h)
+        # the next allowed one along the ring
+        for j in range(len(self.ring)):
+            backend = self.ring[(i + j) % len(self.ring)]
+            if allowed is None or allowed(backend):
+                return backend
+
+
+SCHEDULERS = dict((cls.name, cls) for cls in (
+    RoundRobin, WeightedRoundRobin, LeastConnections, ConsistentHash))
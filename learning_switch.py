@@ -1,46 +1,205 @@
+import functools
+import logging
+
 from ryu.base import app_manager
 from ryu.controller import ofp_event
 from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER
+from ryu.controller.handler import DEAD_DISPATCHER
 from ryu.controller.handler import set_ev_cls
 from ryu.ofproto import ofproto_v1_3
-from ryu.lib.packet import packet
-from ryu.lib.packet import ethernet
 from ryu.lib.packet import ether_types
-from ryu.lib.packet import icmp
+
+import pkt_headers
+from flow_pipeline import FlowProgrammer, FlowProgrammerEvents
+from flow_strategy import STRATEGIES
+from flow_sync import FlowReconciler
+from host_tracker import HostTracker
+from instrument import Instrumentation
+from packet_buffer import PacketBuffering
+from packet_in_guard import PacketInGuard
+from packet_workers import DirectProgrammer, ShardPool
+from state_store import StateStore, flat_table, nest_table
+from topology import Topology
 
 
-class SimpleSwitch13(app_manager.RyuApp):
+class SimpleSwitch13(FlowProgrammerEvents, app_manager.RyuApp):
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
 
+    # 'path' installs whole shortest paths across switches, 'dst' learns
+    # eth_dst entries switch by switch (see flow_strategy), 'exact'
+    # installs the original (in_port, eth_src, eth_dst) entries.
+    flow_strategy = 'path'
+    # seconds, 0 disables the timeout
+    idle_timeout = 60
+    hard_timeout = 600
+    # seconds between LLDP probes on every port
+    lldp_interval = 1.0
+    # None handles PacketIns on the event loop, a number shards them by
+    # datapath over that many worker processes (see packet_workers). Only
+    # 'dst' and 'exact' shard: 'path' flows span switches, so with the
+    # default strategy this is ignored, with a warning at start.
+    packet_workers = None
+    # PacketIns/sec a switch may send, enforced by a meter where the switch
+    # has them; single sources and edge ports are policed by the controller,
+    # see packet_in_guard. 0 leaves the switches unmetered.
+    packet_in_rate = 1000
+    # bytes of a table-miss frame sent up while the switch buffers the
+    # rest, None for whole frames, see packet_buffer. Only 'exact' uses it:
+    # 'dst' and 'path' may need the whole frame on another switch.
+    miss_send_len = 128
+    # path prefix of the learned tables saved every state_interval seconds
+    # and restored on start while under state_max_age seconds old, see
+    # state_store; None starts empty. Either way the flows a switch kept
+    # are reconciled with the tables when it connects, see flow_sync.
+    state_file = None
+    state_interval = 5
+    state_max_age = 300
+    # timing histograms of the event handlers and PacketIn stages, written
+    # to instrument_file every instrument_interval seconds if set, and one
+    # PacketIn in log_every logged, see instrument. SIGUSR1 and SIGUSR2
+    # profile the running controller.
+    instrument_file = None
+    instrument_interval = 10
+    log_every = 100
+
     def __init__(self, *args, **kwargs):
         super(SimpleSwitch13, self).__init__(*args, **kwargs)
         self.mac_to_port = {}
+        self.flow_programmer = FlowProgrammer()
+        self.hosts = HostTracker()
+        self.topology = Topology(self, self.lldp_interval)
+        # ports LLDP found links on are never blocked as a whole
+        self.guard = PacketInGuard(self, self.packet_in_rate,
+                                   is_edge=self.topology.is_edge)
+        self.buffering = PacketBuffering(self, self.miss_send_len)
+        self.strategy = STRATEGIES[self.flow_strategy](
+            self, idle_timeout=self.idle_timeout,
+            hard_timeout=self.hard_timeout)
+        self.topology.start()
+        self.reconciler = FlowReconciler(self)
+        self.instr = Instrumentation(self, self.instrument_file,
+                                     self.instrument_interval, self.log_every)
+        self.instr.instrument(self)
+        self.instr.start()
+        self.store = None
+        if self.state_file is not None:
+            self.store = StateStore(self, self.state_file, self.state_interval,
+                                    max_age=self.state_max_age)
+            self.restore_state(self.store.load())
+            self.store.start()
+        self.shards = None
+        if self.packet_workers is not None:
+            if self.strategy.shardable:
+                self.shards = ShardPool(
+                    functools.partial(SwitchShard, self.flow_strategy,
+                                      self.idle_timeout, self.hard_timeout,
+                                      self.log_every),
+                    self.packet_workers)
+                self.shards.start()
+            else:
+                self.logger.warning("'%s' flows span switches, PacketIns "
+                                    "are not sharded", self.flow_strategy)
 
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
     def switch_features_handler(self, ev):
         datapath = ev.msg.datapath
-        ofproto = datapath.ofproto
-        parser = datapath.ofproto_parser
+        self.instr.watch(datapath)
+
+        # what the switch kept is checked against mac_to_port once it has
+        # reported its flows
+        self.mac_to_port.setdefault(datapath.id, {})
+        self.flow_programmer.reset(datapath)
+        self.reconciler.switch_connected(datapath)
+        self.guard.switch_connected(datapath)
+        self.buffering.switch_features(ev.msg)
+        self.topology.switch_connected(datapath)
+        if self.shards is not None:
+            self.shards.switch_connected(datapath)
+        else:
+            self.strategy.switch_connected(datapath)
+
+    @set_ev_cls(ofp_event.EventOFPStateChange, DEAD_DISPATCHER)
+    def _state_change_handler(self, ev):
+        datapath = ev.datapath
+        if datapath.id is not None and \
+                self.topology.datapaths.get(datapath.id) is datapath:
+            self.topology.switch_disconnected(datapath.id)
+            self.hosts.forget_switch(datapath.id)
+
+    @set_ev_cls(ofp_event.EventOFPPortDescStatsReply, MAIN_DISPATCHER)
+    def _port_desc_stats_reply_handler(self, ev):
+        self.topology.port_desc_reply(ev.msg)
+
+    @set_ev_cls(ofp_event.EventOFPPortStatus, MAIN_DISPATCHER)
+    def _port_status_handler(self, ev):
+        self.topology.port_status(ev.msg)
+
+    @set_ev_cls(ofp_event.EventOFPMeterFeaturesStatsReply,
+                [CONFIG_DISPATCHER, MAIN_DISPATCHER])
+    def _meter_features_reply_handler(self, ev):
+        self.guard.meter_features_reply(ev.msg)
+
+    @set_ev_cls(ofp_event.EventOFPFlowStatsReply,
+                [CONFIG_DISPATCHER, MAIN_DISPATCHER])
+    def _flow_stats_reply_handler(self, ev):
+        self.reconciler.flow_stats_reply(ev.msg)
 
-        match = parser.OFPMatch()
-        actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,
-                                          ofproto.OFPCML_NO_BUFFER)]
-        self.add_flow(datapath, 0, match, actions)
+    def reconcile(self, datapath, stats):
+        if self.shards is not None:
+            # the workers own the tables, their flows are left as they are
+            return []
+        return self.strategy.reconcile(datapath, stats)
 
-    def add_flow(self, datapath, priority, match, actions, buffer_id=None):
+    def dump_state(self):
+        tables = {'mac_to_port': flat_table(self.mac_to_port),
+                  'hosts': self.hosts.dump()}
+        tables.update(self.strategy.dump())
+        return tables
+
+    def restore_state(self, tables):
+        nest_table(tables.get('mac_to_port', {}), self.mac_to_port)
+        self.hosts.restore(tables.get('hosts', {}))
+        self.strategy.restore(tables)
+
+    def stop(self):
+        self.instr.close()
+        if self.store is not None:
+            self.store.close()
+        super(SimpleSwitch13, self).stop()
+
+    def add_flow(self, datapath, priority, match, actions, buffer_id=None,
+                 table_id=0, goto_table=None, idle_timeout=0, hard_timeout=0,
+                 flags=0, cookie=0):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
 
         inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,
                                              actions)]
+        if goto_table is not None:
+            inst.append(parser.OFPInstructionGotoTable(goto_table))
         if buffer_id:
             mod = parser.OFPFlowMod(datapath=datapath, buffer_id=buffer_id,
+                                    table_id=table_id, priority=priority,
+                                    match=match, instructions=inst,
+                                    idle_timeout=idle_timeout,
+                                    hard_timeout=hard_timeout, flags=flags,
+                                    cookie=cookie)
+        else:
+            mod = parser.OFPFlowMod(datapath=datapath, table_id=table_id,
                                     priority=priority, match=match,
-                                    instructions=inst)
+                                    instructions=inst,
+                                    idle_timeout=idle_timeout,
+                                    hard_timeout=hard_timeout, flags=flags,
+                                    cookie=cookie)
+        self.flow_programmer.submit(datapath, self.guard.meter(datapath, mod))
+
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def _flow_removed_handler(self, ev):
+        self.flow_programmer.flow_removed(ev.msg)
+        if self.shards is not None:
+            self.shards.flow_removed(ev.msg)
         else:
-            mod = parser.OFPFlowMod(datapath=datapath, priority=priority,
-                                    match=match, instructions=inst)
-        datapath.send_msg(mod)
+            self.strategy.flow_removed(ev.msg)
 
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def _packet_in_handler(self, ev):
@@ -50,47 +209,92 @@ class SimpleSwitch13(app_manager.RyuApp):
                               ev.msg.msg_len, ev.msg.total_len)
         msg = ev.msg
         datapath = msg.datapath
-        ofproto = datapath.ofproto
-        parser = datapath.ofproto_parser
         in_port = msg.match['in_port']
 
-        pkt = packet.Packet(msg.data)
-        eth = pkt.get_protocols(ethernet.ethernet)[0]
+        eth = self.instr.parse(msg.data)
 
+        if eth is None:
+            return
         if eth.ethertype == ether_types.ETH_TYPE_LLDP:
+            self.topology.packet_in(msg, in_port)
             return
-        
+        if not self.guard.admit(datapath, in_port, eth.src):
+            return
+        if not self.buffering.complete(msg):
+            # reinstalls the table-miss flow, now asking for whole frames
+            self.strategy.switch_connected(datapath)
+            return
+        if self.shards is not None:
+            self.shards.packet_in(msg)
+            return
+
         dst = eth.dst
         src = eth.src
 
         dpid = datapath.id
         self.mac_to_port.setdefault(dpid, {})
 
-        self.logger.info("packet in %s %s %s %s", dpid, src, dst, in_port)
+        self.instr.log_sampled(self.logger, "packet in %s %s %s %s",
+                               dpid, src, dst, in_port)
 
-        self.mac_to_port[dpid][src] = in_port
+        # hosts are only located where they attach, not on trunk ports
+        if self.topology.is_edge(dpid, in_port):
+            self.hosts.learn(dpid, in_port, eth, edge=True)
+        if self.hosts.arp_proxy(datapath, in_port, eth):
+            self.buffering.release(datapath, msg)
+            self.strategy.host_seen(datapath, src, in_port)
+            return
 
-        if dst in self.mac_to_port[dpid]:
-            out_port = self.mac_to_port[dpid][dst]
-        else:
-            out_port = ofproto.OFPP_FLOOD
-        
-        actions = [parser.OFPActionOutput(out_port)]
-
-        # install a flow to avoid packet_in next time
-        if out_port != ofproto.OFPP_FLOOD:
-            match = parser.OFPMatch(in_port=in_port, eth_dst=dst, eth_src=src)
-            # verify if we have a valid buffer_id, if yes avoid to send both
-            # flow_mod & packet_out
-            if msg.buffer_id != ofproto.OFP_NO_BUFFER:
-                self.add_flow(datapath, 1, match, actions, msg.buffer_id)
-                return
-            else:
-                self.add_flow(datapath, 1, match, actions)
-        data = None
-        if msg.buffer_id == ofproto.OFP_NO_BUFFER:
-            data = msg.data
-
-        out = parser.OFPPacketOut(datapath=datapath, buffer_id=msg.buffer_id,
-                                  in_port=in_port, actions=actions, data=data)
-        datapath.send_msg(out)
+        self.strategy.packet_in(msg, in_port, src, dst)
+
+
+class SwitchShard(object):
+    """PacketIn handling of SimpleSwitch13 for one packet worker.
+
+    Owns mac_to_port and the host cache of the datapaths sharded to it.
+    PacketIns are policed before they are sharded; the flows installed
+    here are not metered, the guard only sees the parent's FlowMods.
+    """
+
+    add_flow = SimpleSwitch13.add_flow
+
+    def __init__(self, flow_strategy, idle_timeout, hard_timeout,
+                 log_every=100):
+        self.logger = logging.getLogger(__name__)
+        # only for log_sampled, the worker's timings are not collected
+        self.instr = Instrumentation(self, log_every=log_every)
+        self.mac_to_port = {}
+        self.flow_programmer = DirectProgrammer()
+        self.guard = PacketInGuard(self, meter_rate=0)
+        # workers don't see the features reply, they take whole frames
+        self.buffering = PacketBuffering(self, None)
+        self.hosts = HostTracker()
+        self.strategy = STRATEGIES[flow_strategy](
+            self, idle_timeout=idle_timeout, hard_timeout=hard_timeout)
+
+    def switch_connected(self, datapath):
+        self.mac_to_port[datapath.id] = {}
+        self.strategy.switch_connected(datapath)
+
+    def flow_removed(self, msg):
+        self.strategy.flow_removed(msg)
+
+    def packet_in(self, msg):
+        datapath = msg.datapath
+        in_port = msg.match['in_port']
+
+        eth = pkt_headers.parse(msg.data)
+        if eth is None:
+            return
+        dpid = datapath.id
+        self.mac_to_port.setdefault(dpid, {})
+
+        self.instr.log_sampled(self.logger, "packet in %s %s %s %s",
+                               dpid, eth.src, eth.dst, in_port)
+
+        self.hosts.learn(dpid, in_port, eth)
+        if self.hosts.arp_proxy(datapath, in_port, eth):
+            self.strategy.host_seen(datapath, eth.src, in_port)
+            return
+
+        self.strategy.packet_in(msg, in_port, eth.src, eth.dst)
@@ -1,57 +1,475 @@
 from ryu.base import app_manager
 from ryu.controller import ofp_event
 from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER
+from ryu.controller.handler import DEAD_DISPATCHER
 from ryu.controller.handler import set_ev_cls
 from ryu.ofproto import ofproto_v1_3
+from ryu.lib import hub
 from ryu.lib.packet import packet
 from ryu.lib.packet import ether_types
-from ryu.lib.packet import ipv4
-from ryu.lib.mac import haddr_to_int
 from ryu.lib.packet.ether_types import ETH_TYPE_IP
 from ryu.lib.packet import arp
 from ryu.lib.packet import ethernet
 
+from flow_pipeline import FlowProgrammer, FlowProgrammerEvents
+from flow_sync import FlowReconciler, learn_from_flow, output_port
+from instrument import Instrumentation
+from lb_conntrack import CLOSING, OPEN, ConnectionTable, TCP_FIN, TCP_RST
+from lb_health import HealthChecker
+from lb_scheduler import Backend, SCHEDULERS
+from packet_buffer import PacketBuffering
+from packet_in_guard import PacketInGuard
+from state_store import StateStore, flat_table, nest_table
 
-class SimpleSwitch13(app_manager.RyuApp):
+_IP_PROTOS = {'tcp': 6, 'udp': 17}
+_IP_PROTO_NAMES = dict((v, k) for k, v in _IP_PROTOS.items())
+
+
+class SimpleSwitch13(FlowProgrammerEvents, app_manager.RyuApp):
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
 
     virtual_ip = '10.0.0.42'  # The virtual server IP
-
-    h4_ip = '10.0.0.4'
-    h4_mac = '00:00:00:00:00:04'
-    switch_port = 1
-    h5_ip = '10.0.0.5'
-    h5_mac = '00:00:00:00:00:05'
+    # answered for virtual_ip in ARP replies, rewritten to the back-end's
+    # MAC on the way in and back to this on the way out
+    virtual_mac = '02:00:00:00:00:42'
+
+    # port is where the back-end is reached from the load-balancing switch
+    # until its MAC has been learned there
+    backends = [
+        dict(name='h4', ip='10.0.0.4', mac='00:00:00:00:00:04', port=1),
+        dict(name='h5', ip='10.0.0.5', mac='00:00:00:00:00:05', port=1),
+    ]
+    # round_robin, weighted_round_robin, least_connections or
+    # consistent_hash, see lb_scheduler
+    scheduler = 'round_robin'
+
+    # 'reactive' installs rewrite flows per connection from the PacketIn
+    # path.
+    # 'group' programs an OFPGT_SELECT group with one weighted bucket per
+    # back-end and a single VIP flow pointing at it, so the switch spreads
+    # new connections itself. Replies from the back-ends are rewritten in
+    # lb_table and L2 forwarding moves to l2_table. The switch keeps no
+    # per-connection state, so a reply is told apart by its source alone:
+    # only lb_services, (proto, port) pairs, are balanced, other traffic
+    # for the VIP is dropped, and anything a back-end sends from a service
+    # port is rewritten to come from the VIP, even to a client that reached
+    # it on its own address. Reach the back-ends directly on other ports.
+    lb_mode = 'reactive'
+    lb_services = [('tcp', 80)]
+    lb_group_id = 42
+    lb_table = 0
+    l2_table = 1
+
+    # connection flows expire after this many idle seconds; that, a RST or
+    # FINs both ways is when least_connections considers it closed
+    flow_idle_timeout = 30
+    # reactive mode keeps a connection's back-end for conn_linger seconds
+    # after its flows idled out and conn_time_wait seconds after it closed,
+    # and sends a client's new connections to the back-end of its last one
+    # for sticky_timeout seconds (0 disables), see lb_conntrack
+    conn_linger = 300
+    conn_time_wait = 10
+    sticky_timeout = 0
+    # seconds between flow stats polls feeding least_connections
+    load_poll_interval = 5
+    # low 16 bits hold the back-end's index in the pool
+    lb_cookie = 0x1b0000
+    lb_cookie_mask = 0xffff0000
+
+    # back-ends are probed every health_interval seconds and taken out of
+    # the pool after health_max_missed unanswered probes, see lb_health
+    health_interval = 0.2
+    health_max_missed = 3
+
+    # PacketIns/sec a switch may send, enforced by a meter where the switch
+    # has them; single sources are policed by the controller, see
+    # packet_in_guard. 0 leaves the switches unmetered.
+    packet_in_rate = 1000
+    # bytes of a table-miss frame sent up while the switch buffers the
+    # rest, None for whole frames, see packet_buffer
+    miss_send_len = 128
+    # path prefix of mac_to_port and the connection and affinity tables,
+    # saved every state_interval seconds and restored on start while under
+    # state_max_age seconds old, see state_store; None starts empty. Either
+    # way the flows a switch kept are reconciled with them when it
+    # connects, and connections with flows we don't know are adopted, see
+    # flow_sync.
+    state_file = None
+    state_interval = 5
+    state_max_age = 300
+    # timing histograms of the event handlers and PacketIn stages, written
+    # to instrument_file every instrument_interval seconds if set, and one
+    # PacketIn in log_every logged, see instrument. SIGUSR1 and SIGUSR2
+    # profile the running controller.
+    instrument_file = None
+    instrument_interval = 10
+    log_every = 100
 
     def __init__(self, *args, **kwargs):
         super(SimpleSwitch13, self).__init__(*args, **kwargs)
         self.mac_to_port = {}
+        self.datapaths = {}
+        self.flow_programmer = FlowProgrammer()
+        self.guard = PacketInGuard(self, self.packet_in_rate)
+        self.buffering = PacketBuffering(self, self.miss_send_len)
+        self.pool = [Backend(**b) for b in self.backends]
+        self.sched = SCHEDULERS[self.scheduler](self.pool)
+        self.conns = ConnectionTable(self.sched, self.conn_linger,
+                                     self.conn_time_wait, self.sticky_timeout)
+        # dpid -> flow stats parts so far, back-end name -> bytes/sec
+        self.load_parts = {}
+        self.load = {}
+        self.reconciler = FlowReconciler(self)
+        self.instr = Instrumentation(self, self.instrument_file,
+                                     self.instrument_interval, self.log_every)
+        self.instr.instrument(self)
+        self.instr.wrap(self, 'handle_packets')
+        self.instr.start()
+        self.store = None
+        if self.state_file is not None:
+            self.store = StateStore(self, self.state_file, self.state_interval,
+                                    max_age=self.state_max_age)
+            self.restore_state(self.store.load())
+            self.store.start()
+        self.load_thread = hub.spawn(self._load_poller)
+        if self.lb_mode != 'group':
+            self.l2_table = self.lb_table
+        self.health = HealthChecker(self, self.health_interval,
+                                    self.health_max_missed)
+        self.health.start()
+
+    @set_ev_cls(ofp_event.EventOFPStateChange,
+                [MAIN_DISPATCHER, DEAD_DISPATCHER])
+    def _state_change_handler(self, ev):
+        datapath = ev.datapath
+        if ev.state == MAIN_DISPATCHER:
+            self.datapaths[datapath.id] = datapath
+        elif ev.state == DEAD_DISPATCHER and datapath.id is not None and \
+                self.datapaths.get(datapath.id) is datapath:
+            del self.datapaths[datapath.id]
+            # its connections idle out, and expire unless it comes back
+            self.conns.switch_reset(datapath.id)
 
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
     def switch_features_handler(self, ev):
         datapath = ev.msg.datapath
+        self.instr.watch(datapath)
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
 
-        match = parser.OFPMatch()
+        self.mac_to_port.setdefault(datapath.id, {})
+        self.flow_programmer.reset(datapath)
+        self.reconciler.switch_connected(datapath)
+        self.guard.switch_connected(datapath)
+        self.buffering.switch_features(ev.msg)
+        self._install_table_miss(datapath)
+
+        # ARP for the VIP, including health probe replies, must never be
+        # switched by a learned L2 flow
+        match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_ARP,
+                                arp_tpa=self.virtual_ip)
         actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,
                                           ofproto.OFPCML_NO_BUFFER)]
-        self.add_flow(datapath, 0, match, actions)
+        self.add_flow(datapath, 30, match, actions, table_id=self.lb_table)
+
+        if self.lb_mode == 'group':
+            self._install_group(datapath, ofproto.OFPGC_ADD)
+            self._install_vip_flows(datapath)
+        else:
+            # connections without their flows any more are found once the
+            # switch has reported them
+            self._install_close_flows(datapath)
+
+    def reconcile(self, datapath, stats):
+        mac_to_port = self.mac_to_port.setdefault(datapath.id, {})
+        stale = []
+        # connection key -> [client-side flow, back-end-side flow]
+        conn_flows = {}
+        for stat in stats:
+            match = stat.match
+            if stat.table_id == self.l2_table and stat.priority == 10 and \
+                    'eth_src' in match:
+                if not learn_from_flow(mac_to_port,
+                                       [(match['eth_src'], match['in_port']),
+                                        (match['eth_dst'],
+                                         output_port(stat))]):
+                    stale.append(stat)
+            elif stat.table_id == self.lb_table and stat.priority == 20 and \
+                    'in_port' in match and \
+                    self._cookie_backend(stat.cookie) is not None:
+                key = self._match_key(match)
+                if key[1] == self.virtual_ip:
+                    conn_flows.setdefault(key, [None, None])[0] = stat
+                else:
+                    key = (key[1], self.virtual_ip, key[2], key[4], key[3])
+                    conn_flows.setdefault(key, [None, None])[1] = stat
 
-    def add_flow(self, datapath, priority, match, actions, buffer_id=None):
+        installed = set()
+        for key, (forward, reverse) in conn_flows.items():
+            if self._conn_installed(datapath, key, forward, reverse):
+                installed.add(key)
+            else:
+                stale += [stat for stat in (forward, reverse)
+                          if stat is not None]
+        self.conns.switch_reset(datapath.id, installed)
+        return stale
+
+    def _conn_installed(self, datapath, key, forward, reverse):
+        """Whether a connection's flows in the switch can stay; one we
+        don't know is adopted."""
+        if forward is None or reverse is None or \
+                forward.cookie != reverse.cookie:
+            return False
+        backend = self._cookie_backend(forward.cookie)
+        if backend not in self.sched.backends:
+            return False
+        conn = self.conns.lookup(key)
+        if conn is None:
+            self.conns.adopt(key, backend, datapath.id,
+                             forward.match['in_port'],
+                             reverse.match['eth_dst'])
+            return True
+        return conn.backend is backend and conn.dpid == datapath.id and \
+            conn.state in (OPEN, CLOSING)
+
+    def dump_state(self):
+        tables = {'mac_to_port': flat_table(self.mac_to_port)}
+        tables.update(self.conns.dump())
+        return tables
+
+    def restore_state(self, tables):
+        nest_table(tables.get('mac_to_port', {}), self.mac_to_port)
+        self.conns.restore(tables, dict((b.name, b) for b in self.pool))
+
+    def stop(self):
+        self.instr.close()
+        if self.store is not None:
+            self.store.close()
+        super(SimpleSwitch13, self).stop()
+
+    def _install_table_miss(self, datapath):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        match = parser.OFPMatch()
+        actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,
+                                          self.buffering.max_len(datapath))]
+        self.add_flow(datapath, 0, match, actions, table_id=self.l2_table)
+
+    def _install_close_flows(self, datapath):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        # FIN and RST segments of tracked connections come up in both
+        # directions, ahead of the connection's rewrite flows
+        actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,
+                                          ofproto.OFPCML_NO_BUFFER)]
+        ends = [dict(ipv4_dst=self.virtual_ip)]
+        ends += [dict(ipv4_src=backend.ip) for backend in self.pool]
+        for end in ends:
+            for flag in (TCP_FIN, TCP_RST):
+                match = parser.OFPMatch(eth_type=ETH_TYPE_IP, ip_proto=6,
+                                        tcp_flags=(flag, flag), **end)
+                self.add_flow(datapath, 30, match, actions,
+                              table_id=self.lb_table)
+
+    def add_flow(self, datapath, priority, match, actions, buffer_id=None,
+                 cookie=0, idle_timeout=0, flags=0, table_id=0,
+                 goto_table=None, hard_timeout=0):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
 
         inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,
                                              actions)]
+        if goto_table is not None:
+            inst.append(parser.OFPInstructionGotoTable(goto_table))
         if buffer_id:
             mod = parser.OFPFlowMod(datapath=datapath, buffer_id=buffer_id,
+                                    cookie=cookie, table_id=table_id,
                                     priority=priority, match=match,
-                                    instructions=inst)
+                                    instructions=inst,
+                                    idle_timeout=idle_timeout,
+                                    hard_timeout=hard_timeout, flags=flags)
         else:
-            mod = parser.OFPFlowMod(datapath=datapath, priority=priority,
-                                    match=match, instructions=inst)
-        datapath.send_msg(mod)
+            mod = parser.OFPFlowMod(datapath=datapath, cookie=cookie,
+                                    table_id=table_id, priority=priority,
+                                    match=match, instructions=inst,
+                                    idle_timeout=idle_timeout,
+                                    hard_timeout=hard_timeout, flags=flags)
+        self.flow_programmer.submit(datapath, self.guard.meter(datapath, mod))
+
+    @set_ev_cls(ofp_event.EventOFPMeterFeaturesStatsReply,
+                [CONFIG_DISPATCHER, MAIN_DISPATCHER])
+    def _meter_features_reply_handler(self, ev):
+        self.guard.meter_features_reply(ev.msg)
+
+    def _group_buckets(self, datapath):
+        parser = datapath.ofproto_parser
+        ofproto = datapath.ofproto
+
+        buckets = []
+        for backend in self.sched.backends:
+            actions = [parser.OFPActionSetField(eth_dst=backend.mac),
+                       parser.OFPActionSetField(ipv4_dst=backend.ip),
+                       parser.OFPActionOutput(
+                           self._backend_port(datapath, backend))]
+            buckets.append(parser.OFPBucket(weight=backend.weight,
+                                            watch_port=ofproto.OFPP_ANY,
+                                            watch_group=ofproto.OFPG_ANY,
+                                            actions=actions))
+        return buckets
+
+    def _install_group(self, datapath, command):
+        parser = datapath.ofproto_parser
+        ofproto = datapath.ofproto
+
+        if command == ofproto.OFPGC_ADD:
+            # the group survives a controller restart, start from scratch
+            mod = parser.OFPGroupMod(datapath, ofproto.OFPGC_DELETE,
+                                     ofproto.OFPGT_SELECT, self.lb_group_id)
+            self.flow_programmer.send(datapath, mod)
+        mod = parser.OFPGroupMod(datapath, command, ofproto.OFPGT_SELECT,
+                                 self.lb_group_id,
+                                 self._group_buckets(datapath))
+        self.flow_programmer.send(datapath, mod)
+
+    def update_groups(self):
+        """Push the current pool and back-end ports to every switch."""
+        if self.lb_mode != 'group':
+            return
+        for datapath in self.datapaths.values():
+            self._install_group(datapath, datapath.ofproto.OFPGC_MODIFY)
+
+    def backend_down(self, backend):
+        self.sched.remove(backend)
+        if self.lb_mode == 'group':
+            self.update_groups()
+            return
+        # its connections get rescheduled on their next packet
+        self.conns.backend_removed(backend)
+        for datapath in self.datapaths.values():
+            ofproto = datapath.ofproto
+            parser = datapath.ofproto_parser
+            mod = parser.OFPFlowMod(datapath=datapath,
+                                    command=ofproto.OFPFC_DELETE,
+                                    table_id=ofproto.OFPTT_ALL,
+                                    cookie=self._backend_cookie(backend),
+                                    cookie_mask=0xffffffffffffffff,
+                                    out_port=ofproto.OFPP_ANY,
+                                    out_group=ofproto.OFPG_ANY,
+                                    match=parser.OFPMatch())
+            self.flow_programmer.submit(datapath, mod)
+
+    def backend_up(self, backend):
+        self.sched.add(backend)
+        self.update_groups()
+
+    @set_ev_cls(ofp_event.EventOFPPortStatus, MAIN_DISPATCHER)
+    def _port_status_handler(self, ev):
+        msg = ev.msg
+        ofproto = msg.datapath.ofproto
+        if msg.reason == ofproto.OFPPR_DELETE or \
+                msg.desc.state & ofproto.OFPPS_LINK_DOWN:
+            self.health.port_down(msg.datapath, msg.desc.port_no)
+
+    def _services(self, end):
+        """Match fields of each service, for end 'dst' or 'src' port."""
+        return [{'ip_proto': _IP_PROTOS[proto], '%s_%s' % (proto, end): port}
+                for proto, port in self.lb_services]
+
+    def _install_vip_flows(self, datapath):
+        parser = datapath.ofproto_parser
+
+        actions = [parser.OFPActionGroup(self.lb_group_id)]
+        # an index no back-end has, so its stats are not counted as one
+        cookie = self.lb_cookie | ~self.lb_cookie_mask & 0xffff
+        for service in self._services('dst'):
+            match = parser.OFPMatch(eth_type=ETH_TYPE_IP,
+                                    ipv4_dst=self.virtual_ip, **service)
+            self.add_flow(datapath, 20, match, actions,
+                          table_id=self.lb_table, cookie=cookie)
+        match = parser.OFPMatch(eth_type=ETH_TYPE_IP, ipv4_dst=self.virtual_ip)
+        self.add_flow(datapath, 10, match, [], table_id=self.lb_table)
+
+        # replies from any back-end look like they come from the VIP, then
+        # take the normal L2 path to the client
+        for backend in self.pool:
+            for service in self._services('src'):
+                match = parser.OFPMatch(eth_type=ETH_TYPE_IP,
+                                        ipv4_src=backend.ip, **service)
+                actions = [parser.OFPActionSetField(eth_src=self.virtual_mac),
+                           parser.OFPActionSetField(ipv4_src=self.virtual_ip)]
+                self.add_flow(datapath, 20, match, actions,
+                              table_id=self.lb_table,
+                              cookie=self._backend_cookie(backend),
+                              goto_table=self.l2_table)
+
+        match = parser.OFPMatch()
+        self.add_flow(datapath, 0, match, [], table_id=self.lb_table,
+                      goto_table=self.l2_table)
+
+    def _backend_cookie(self, backend):
+        return self.lb_cookie | self.pool.index(backend)
+
+    def _cookie_backend(self, cookie):
+        if cookie & self.lb_cookie_mask != self.lb_cookie:
+            return None
+        index = cookie & ~self.lb_cookie_mask
+        if index < len(self.pool):
+            return self.pool[index]
+        return None
+
+    def _backend_port(self, datapath, backend):
+        return self.mac_to_port.get(datapath.id, {}).get(backend.mac,
+                                                         backend.port)
+
+    def _load_poller(self):
+        while True:
+            hub.sleep(self.load_poll_interval)
+            self.conns.expire()
+            for datapath in list(self.datapaths.values()):
+                parser = datapath.ofproto_parser
+                req = parser.OFPFlowStatsRequest(
+                    datapath, cookie=self.lb_cookie,
+                    cookie_mask=self.lb_cookie_mask)
+                datapath.send_msg(req)
+
+    @set_ev_cls(ofp_event.EventOFPFlowStatsReply,
+                [CONFIG_DISPATCHER, MAIN_DISPATCHER])
+    def _flow_stats_reply_handler(self, ev):
+        msg = ev.msg
+        if self.reconciler.flow_stats_reply(msg):
+            return
+        # a reply can come in several parts, rates are over all of them
+        dpid = msg.datapath.id
+        parts = self.load_parts.setdefault(dpid, [])
+        parts.extend(msg.body)
+        if msg.flags & msg.datapath.ofproto.OFPMPF_REPLY_MORE:
+            return
+        del self.load_parts[dpid]
+        rates = dict((b.name, 0.0) for b in self.pool)
+        for stat in parts:
+            backend = self._cookie_backend(stat.cookie)
+            if backend is None:
+                continue
+            # average rate over the flow's lifetime is enough to rank
+            duration = stat.duration_sec + stat.duration_nsec / 1e9
+            rates[backend.name] += stat.byte_count / max(duration, 1.0)
+        # and a back-end's load adds up the connected switches
+        self.load[dpid] = rates
+        for backend in self.pool:
+            self.sched.update_load(backend, sum(
+                self.load[d][backend.name] for d in self.load
+                if d in self.datapaths))
+
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def _flow_removed_handler(self, ev):
+        msg = ev.msg
+        self.flow_programmer.flow_removed(msg)
+        # only the client side of a connection reports its removal
+        if self._cookie_backend(msg.cookie) is not None and \
+                msg.match.get('ipv4_dst') == self.virtual_ip:
+            self.conns.idle(self._match_key(msg.match))
 
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def _packet_in_handler(self, ev):
@@ -66,23 +484,36 @@ class SimpleSwitch13(app_manager.RyuApp):
         parser = datapath.ofproto_parser
         in_port = msg.match['in_port']
 
-        pkt = packet.Packet(msg.data)
-        eth = pkt.get_protocols(ethernet.ethernet)[0]
+        eth = self.instr.parse(msg.data)
 
-        if eth.ethertype == ether_types.ETH_TYPE_LLDP:
+        if eth is None or eth.ethertype == ether_types.ETH_TYPE_LLDP:
             # ignore lldp packet
             return
+        if not self.guard.admit(datapath, in_port, eth.src):
+            return
+        if not self.buffering.complete(msg):
+            self._install_table_miss(datapath)
+            return
         dst_mac = eth.dst
         src_mac = eth.src
 
         dpid = datapath.id
         self.mac_to_port.setdefault(dpid, {})
 
-        self.logger.info("packet in %s %s %s %s", dpid,
-                         src_mac, dst_mac, in_port)
+        self.instr.log_sampled(self.logger, "packet in %s %s %s %s",
+                               dpid, src_mac, dst_mac, in_port)
 
         # learn a mac address to avoid FLOOD next time.
+        moved = self.mac_to_port[dpid].get(src_mac) != in_port
         self.mac_to_port[dpid][src_mac] = in_port
+        if moved and self.lb_mode == 'group' and \
+                any(b.mac == src_mac for b in self.pool):
+            # buckets follow the back-end's learned location
+            self._install_group(datapath, ofproto.OFPGC_MODIFY)
+
+        # traffic for the VIP never gets plain L2 flows
+        if self.handle_packets(eth.ethertype, datapath, eth, in_port, parser, dst_mac, src_mac, msg):
+            return
 
         if dst_mac in self.mac_to_port[dpid]:
             out_port = self.mac_to_port[dpid][dst_mac]
@@ -98,13 +529,12 @@ class SimpleSwitch13(app_manager.RyuApp):
             # verify if we have a valid buffer_id, if yes avoid to send both
             # flow_mod & packet_out
             if msg.buffer_id != ofproto.OFP_NO_BUFFER:
-                self.add_flow(datapath, 10, match, actions, msg.buffer_id)
+                self.add_flow(datapath, 10, match, actions, msg.buffer_id,
+                              table_id=self.l2_table)
                 return
             else:
-                self.add_flow(datapath, 10, match, actions)
-
-        if self.handle_packets(eth.ethertype, datapath, pkt, in_port, parser, dst_mac, src_mac):
-            return
+                self.add_flow(datapath, 10, match, actions,
+                              table_id=self.l2_table)
 
         data = None
         if msg.buffer_id == ofproto.OFP_NO_BUFFER:
@@ -112,57 +542,45 @@ class SimpleSwitch13(app_manager.RyuApp):
 
         out = parser.OFPPacketOut(datapath=datapath, buffer_id=msg.buffer_id,
                                   in_port=in_port, actions=actions, data=data)
-        datapath.send_msg(out)
+        self.flow_programmer.send(datapath, out)
 
-    def handle_packets(self, ethtype, datapath, pkt, in_port, parser, dst_mac, src_mac):
+    def handle_packets(self, ethtype, datapath, hdr, in_port, parser, dst_mac, src_mac, msg):
         handle = False
         if ethtype == ETH_TYPE_IP:
-            ip = pkt.get_protocol(ipv4.ipv4)
-            if ip.dst == self.virtual_ip:
+            if hdr.ipv4_dst == self.virtual_ip and self.lb_mode == 'group':
                 handle = True
-                if dst_mac == self.h4_mac:
-                    server_dst_ip = self.h4_ip
-                    server_out_port = self.switch_port
-                else:
-                    server_dst_ip = self.h5_ip
-                    server_out_port = self.switch_port
-
-                # Route to server
-                match = parser.OFPMatch(in_port=in_port, eth_type=ETH_TYPE_IP, ip_proto=ip.proto,
-                                        ipv4_dst=self.virtual_ip)
-
-                actions = [parser.OFPActionSetField(ipv4_dst=server_dst_ip),
-                           parser.OFPActionOutput(server_out_port)]
-
-                self.add_flow(datapath, 20, match, actions)
-
-                # Reverse route from server
-                match = parser.OFPMatch(in_port=server_out_port, eth_type=ETH_TYPE_IP,
-                                        ip_proto=ip.proto,
-                                        ipv4_src=server_dst_ip,
-                                        eth_dst=src_mac)
-                actions = [parser.OFPActionSetField(ipv4_src=self.virtual_ip),
-                           parser.OFPActionOutput(in_port)]
-
-                self.add_flow(datapath, 20, match, actions)
+                if (_IP_PROTO_NAMES.get(hdr.ip_proto), hdr.dst_port) not in \
+                        self.lb_services:
+                    return handle
+                # raced the VIP flow, let the group pick the back-end
+                data = None
+                if msg.buffer_id == datapath.ofproto.OFP_NO_BUFFER:
+                    data = msg.data
+                actions = [parser.OFPActionGroup(self.lb_group_id)]
+                out = parser.OFPPacketOut(datapath=datapath, buffer_id=msg.buffer_id,
+                                          in_port=in_port, actions=actions, data=data)
+                self.flow_programmer.send(datapath, out)
+            elif hdr.ipv4_dst == self.virtual_ip:
+                handle = True
+                self._client_packet(datapath, hdr, in_port, src_mac, msg)
+            elif self.lb_mode != 'group' and \
+                    any(b.ip == hdr.ipv4_src for b in self.pool):
+                handle = self._server_packet(datapath, hdr, msg)
 
         elif ethtype == ether_types.ETH_TYPE_ARP:
-            arp_obj = pkt.get_protocol(arp.arp)
-
-            if arp_obj.dst_ip == self.virtual_ip and arp_obj.opcode == arp.ARP_REQUEST:
-                arp_target_ip = arp_obj.src_ip
-                arp_target_mac = arp_obj.src_mac
+            if hdr.arp_dst_ip == self.virtual_ip and hdr.arp_opcode == arp.ARP_REPLY:
+                self.health.reply_received(hdr.arp_src_ip)
+                handle = True
+            elif hdr.arp_dst_ip == self.virtual_ip and hdr.arp_opcode == arp.ARP_REQUEST:
+                arp_target_ip = hdr.arp_src_ip
+                arp_target_mac = hdr.arp_src_mac
                 src_ip = self.virtual_ip
-
-                if haddr_to_int(arp_target_mac) % 2 == 1:
-                    src_mac = self.h4_mac
-                else:
-                    src_mac = self.h5_mac
+                src_mac = self.virtual_mac
 
                 replypkt = packet.Packet()
                 replypkt.add_protocol(
                     ethernet.ethernet(
-                        dst=dst_mac, src=src_mac, ethertype=ether_types.ETH_TYPE_ARP)
+                        dst=arp_target_mac, src=src_mac, ethertype=ether_types.ETH_TYPE_ARP)
                 )
                 replypkt.add_protocol(
                     arp.arp(opcode=arp.ARP_REPLY, src_mac=src_mac, src_ip=src_ip,
@@ -177,3 +595,144 @@ class SimpleSwitch13(app_manager.RyuApp):
                 handle = True
 
         return handle
+
+    @staticmethod
+    def _match_key(match):
+        proto = match['ip_proto']
+        l4 = {6: 'tcp', 17: 'udp'}.get(proto)
+        if l4 is None:
+            return (match['ipv4_src'], match['ipv4_dst'], proto, None, None)
+        return (match['ipv4_src'], match['ipv4_dst'], proto,
+                match[l4 + '_src'], match[l4 + '_dst'])
+
+    def _conn_flows(self, parser, conn):
+        """(match, actions) of the client-side and back-end-side flows."""
+        client_ip, vip, proto, client_port, service_port = conn.key
+        backend = conn.backend
+        datapath = self.datapaths.get(conn.dpid)
+        server_port = self._backend_port(datapath, backend) \
+            if datapath is not None else backend.port
+        l4 = {6: 'tcp', 17: 'udp'}.get(proto)
+        inbound = {}
+        outbound = {}
+        if l4 is not None:
+            inbound = {l4 + '_src': client_port, l4 + '_dst': service_port}
+            outbound = {l4 + '_src': service_port, l4 + '_dst': client_port}
+
+        match = parser.OFPMatch(in_port=conn.client_port,
+                                eth_type=ETH_TYPE_IP, ip_proto=proto,
+                                ipv4_src=client_ip, ipv4_dst=vip, **inbound)
+        actions = [parser.OFPActionSetField(eth_dst=backend.mac),
+                   parser.OFPActionSetField(ipv4_dst=backend.ip),
+                   parser.OFPActionOutput(server_port)]
+        forward = (match, actions)
+
+        match = parser.OFPMatch(in_port=server_port, eth_type=ETH_TYPE_IP,
+                                ip_proto=proto, ipv4_src=backend.ip,
+                                ipv4_dst=client_ip, eth_dst=conn.client_mac,
+                                **outbound)
+        actions = [parser.OFPActionSetField(eth_src=self.virtual_mac),
+                   parser.OFPActionSetField(ipv4_src=vip),
+                   parser.OFPActionOutput(conn.client_port)]
+        return forward, (match, actions)
+
+    def _client_packet(self, datapath, hdr, in_port, src_mac, msg):
+        parser = datapath.ofproto_parser
+        key = (hdr.ipv4_src, hdr.ipv4_dst, hdr.ip_proto,
+               hdr.src_port, hdr.dst_port)
+        flags = hdr.tcp_flags or 0
+
+        if flags & (TCP_FIN | TCP_RST):
+            conn = self.conns.lookup(key)
+            if conn is None:
+                # e.g. tracked before a restart: a back-end still answers it
+                self._unknown_close(datapath, hdr, in_port, key, msg)
+                return
+            self._packet_out(datapath, msg, in_port,
+                             self._conn_flows(parser, conn)[0][1])
+            if self.conns.tcp_flags(conn, flags, True):
+                self._remove_conn_flows(datapath, conn)
+            return
+
+        conn, install = self.conns.open(key, datapath.id, in_port, src_mac)
+        if conn is None:
+            self.logger.warning("no back-end for %s", key)
+            self.buffering.release(datapath, msg)
+            return
+        forward, reverse = self._conn_flows(parser, conn)
+        if not install:
+            self._packet_out(datapath, msg, in_port, forward[1])
+            return
+        cookie = self._backend_cookie(conn.backend)
+        self.add_flow(datapath, 20, reverse[0], reverse[1],
+                      cookie=cookie, idle_timeout=self.flow_idle_timeout,
+                      table_id=self.lb_table)
+        # the packet that brought us here goes out with the same rewrite,
+        # straight from the switch's buffer if it has one
+        buffered = msg.buffer_id != datapath.ofproto.OFP_NO_BUFFER
+        self.add_flow(datapath, 20, forward[0], forward[1],
+                      buffer_id=msg.buffer_id if buffered else None,
+                      cookie=cookie, idle_timeout=self.flow_idle_timeout,
+                      flags=datapath.ofproto.OFPFF_SEND_FLOW_REM,
+                      table_id=self.lb_table)
+        if not buffered:
+            self._packet_out(datapath, msg, in_port, forward[1])
+
+    def _unknown_close(self, datapath, hdr, in_port, key, msg):
+        """Send a FIN/RST we have no connection for to a back-end."""
+        parser = datapath.ofproto_parser
+        backend = self.sched.pick(key)
+        if backend is None:
+            self.buffering.release(datapath, msg)
+            return
+        self.logger.debug("FIN/RST for unknown connection %s to %s", key,
+                          backend.name)
+        self._packet_out(datapath, msg, in_port, [
+            parser.OFPActionSetField(eth_dst=backend.mac),
+            parser.OFPActionSetField(ipv4_dst=backend.ip),
+            parser.OFPActionOutput(self._backend_port(datapath, backend))])
+
+    def _server_packet(self, datapath, hdr, msg):
+        """A back-end's segment the connection's flows did not take: a
+        FIN/RST, or one after the close while the entry lingers."""
+        key = (hdr.ipv4_dst, self.virtual_ip, hdr.ip_proto,
+               hdr.dst_port, hdr.src_port)
+        conn = self.conns.lookup(key)
+        if conn is None or conn.backend.ip != hdr.ipv4_src or \
+                conn.dpid != datapath.id:
+            # not load-balanced traffic, or not yet at the switch that
+            # rewrites it: switch it normally
+            return False
+        parser = datapath.ofproto_parser
+        self._packet_out(datapath, msg, msg.match['in_port'],
+                         self._conn_flows(parser, conn)[1][1])
+        flags = hdr.tcp_flags or 0
+        if flags & (TCP_FIN | TCP_RST) and \
+                self.conns.tcp_flags(conn, flags, False):
+            self._remove_conn_flows(datapath, conn)
+        return True
+
+    def _remove_conn_flows(self, datapath, conn):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        forward, reverse = self._conn_flows(parser, conn)
+        mod = parser.OFPFlowMod(datapath=datapath, table_id=self.lb_table,
+                                command=ofproto.OFPFC_DELETE_STRICT,
+                                priority=20, out_port=ofproto.OFPP_ANY,
+                                out_group=ofproto.OFPG_ANY, match=forward[0])
+        self.flow_programmer.submit(datapath, mod)
+        # the back-end's last segments still have to look like the VIP's,
+        # whatever L2 flows there are for the pair
+        self.add_flow(datapath, 20, reverse[0], reverse[1],
+                      cookie=self._backend_cookie(conn.backend),
+                      hard_timeout=self.conn_time_wait,
+                      table_id=self.lb_table)
+
+    def _packet_out(self, datapath, msg, in_port, actions):
+        parser = datapath.ofproto_parser
+        data = None
+        if msg.buffer_id == datapath.ofproto.OFP_NO_BUFFER:
+            data = msg.data
+        out = parser.OFPPacketOut(datapath=datapath, buffer_id=msg.buffer_id,
+                                  in_port=in_port, actions=actions, data=data)
+        self.flow_programmer.send(datapath, out)
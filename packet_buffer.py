@@ -0,0 +1,64 @@
+"""Buffered, truncated table-miss PacketIns.
+
+With miss_send_len set, the apps' table-miss flows ask the switch to keep
+the frame in a buffer and send only its first miss_send_len bytes, enough
+for every header the apps look at. The app forwards the frame by its
+buffer_id, in the FlowMod it installs or in a PacketOut, so only the
+headers of a large frame cross the control channel, once, instead of the
+whole frame twice.
+
+Buffering is optional in OpenFlow: switches that report no buffers in
+their features reply (Open vSwitch since 2.7) get whole frames as before.
+A switch that truncates a frame without buffering it (older Open vSwitch
+did) leaves the app nothing to forward; complete() tells the app so and
+max_len() asks that switch for whole frames from then on, once the app
+has reinstalled its table-miss flows.
+"""
+
+
+class PacketBuffering(object):
+    def __init__(self, app, miss_send_len=128):
+        self.app = app
+        # None sends whole frames to the controller
+        self.miss_send_len = miss_send_len
+        # dpid -> whether table-miss frames are buffered
+        self.buffered = {}
+        self.stats = {'buffered': 0, 'whole': 0, 'truncated': 0}
+
+    def switch_features(self, msg):
+        self.buffered[msg.datapath.id] = \
+            bool(self.miss_send_len) and msg.n_buffers > 0
+
+    def max_len(self, datapath):
+        """max_len for the CONTROLLER output of a table-miss flow."""
+        if self.buffered.get(datapath.id):
+            return self.miss_send_len
+        return datapath.ofproto.OFPCML_NO_BUFFER
+
+    def complete(self, msg):
+        """False if the PacketIn can't be forwarded: truncated, no buffer."""
+        ofproto = msg.datapath.ofproto
+        if msg.buffer_id != ofproto.OFP_NO_BUFFER:
+            self.stats['buffered'] += 1
+            return True
+        if len(msg.data) >= msg.total_len:
+            self.stats['whole'] += 1
+            return True
+        self.stats['truncated'] += 1
+        if self.buffered.get(msg.datapath.id):
+            self.app.logger.warning("switch %s truncates PacketIns without "
+                                    "buffering them, asking for whole frames",
+                                    msg.datapath.id)
+            self.buffered[msg.datapath.id] = False
+        return False
+
+    @staticmethod
+    def release(datapath, msg):
+        """Drop the frame the switch buffered for a PacketIn we answered."""
+        ofproto = datapath.ofproto
+        if msg.buffer_id == ofproto.OFP_NO_BUFFER:
+            return
+        parser = datapath.ofproto_parser
+        datapath.send_msg(parser.OFPPacketOut(
+            datapath=datapath, buffer_id=msg.buffer_id,
+            in_port=msg.match['in_port'], actions=[]))
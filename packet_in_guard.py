@@ -0,0 +1,192 @@
+"""PacketIn admission control shared by the apps.
+
+Two layers keep a storm on one port from starving the controller:
+
+- In the switch, flows whose only action is sending to the controller
+  (the table-miss entries, ARP punts) go through an OpenFlow meter that
+  drops what exceeds meter_rate PacketIns/sec per switch. Meters are
+  optional in OpenFlow 1.3, so the guard asks for the switch's meter
+  features first and the flows only get the meter instruction once the
+  meter is installed; flows installed before that are re-added with it.
+- In the controller, PacketIns are counted per (switch, port, source MAC)
+  and per (switch, port) over one-second windows. A source over src_rate
+  or a port over port_rate gets a drop flow for block_time seconds and
+  its PacketIns are discarded until then. A port block drops everything
+  arriving on the port, like storm control on a hardware switch; it sits
+  below the LLDP punt, which is not metered either, so links on the port
+  stay known. Only edge ports are blocked: an inter-switch link carries
+  many hosts' traffic and blocking it would cut the network in two, so
+  there only single sources are. Apps that know their links pass
+  is_edge(dpid, port); without it the guard knows no edge ports and
+  blocks sources only.
+
+Apps pass every FlowMod to meter() before submitting it and call admit()
+for every PacketIn before acting on it.
+"""
+
+import time
+
+from ryu.lib.packet import ether_types
+
+_WINDOW = 1.0
+
+
+class PacketInGuard(object):
+    meter_id = 1
+    # under topology's LLDP flow, over everything the apps install
+    block_priority = 0xff00
+    block_cookie = 0xd0
+
+    def __init__(self, app, meter_rate=1000, meter_burst=None, src_rate=100,
+                 port_rate=500, block_time=10, is_edge=None):
+        self.app = app
+        self.is_edge = is_edge
+        # PacketIns/sec per switch, 0 leaves the switch unmetered
+        self.meter_rate = meter_rate
+        self.meter_burst = meter_burst or max(meter_rate // 5, 1)
+        self.src_rate = src_rate
+        self.port_rate = port_rate
+        self.block_time = block_time
+        # dpid -> True once the meter is installed
+        self.metered = {}
+        # dpid -> {flow key: FlowMod} of controller flows without a meter
+        self.unmetered = {}
+        self.window_start = time.monotonic()
+        self.src_counts = {}
+        self.port_counts = {}
+        # (dpid, port) or (dpid, port, mac) -> unblock time
+        self.blocked = {}
+        self.stats = {'admitted': 0, 'dropped': 0, 'blocked_sources': 0,
+                      'blocked_ports': 0}
+
+    def switch_connected(self, datapath):
+        dpid = datapath.id
+        self.metered[dpid] = False
+        self.unmetered[dpid] = {}
+        for key in [k for k in self.blocked if k[0] == dpid]:
+            # the switch lost its drop flows
+            del self.blocked[key]
+        if self.meter_rate:
+            parser = datapath.ofproto_parser
+            datapath.send_msg(parser.OFPMeterFeaturesStatsRequest(datapath))
+
+    def meter_features_reply(self, msg):
+        datapath = msg.datapath
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        features = msg.body[0] if msg.body else None
+        if features is None or features.max_meter < self.meter_id or \
+                not features.band_types & (1 << ofproto.OFPMBT_DROP):
+            self.app.logger.info("switch %s has no drop meters, PacketIns "
+                                 "are only policed by the controller",
+                                 datapath.id)
+            self.unmetered.pop(datapath.id, None)
+            return
+
+        # replaces whatever a previous controller left behind
+        datapath.send_msg(parser.OFPMeterMod(
+            datapath, command=ofproto.OFPMC_DELETE, meter_id=self.meter_id))
+        bands = [parser.OFPMeterBandDrop(rate=self.meter_rate,
+                                         burst_size=self.meter_burst)]
+        datapath.send_msg(parser.OFPMeterMod(
+            datapath, command=ofproto.OFPMC_ADD,
+            flags=ofproto.OFPMF_PKTPS | ofproto.OFPMF_BURST,
+            meter_id=self.meter_id, bands=bands))
+        self.metered[datapath.id] = True
+        for mod in self.unmetered.pop(datapath.id, {}).values():
+            self.app.flow_programmer.submit(datapath,
+                                            self._with_meter(datapath, mod))
+
+    def meter(self, datapath, mod):
+        """mod, with the meter instruction if it only feeds the controller."""
+        if not self.meter_rate or not self._to_controller(datapath, mod):
+            return mod
+        if self.metered.get(datapath.id):
+            return self._with_meter(datapath, mod)
+        pending = self.unmetered.get(datapath.id)
+        if pending is not None and \
+                mod.command == datapath.ofproto.OFPFC_ADD:
+            pending[(mod.table_id, mod.priority, str(mod.match))] = mod
+        return mod
+
+    def _to_controller(self, datapath, mod):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        if mod.match.get('eth_type') == ether_types.ETH_TYPE_LLDP:
+            return False
+        ports = []
+        for inst in mod.instructions:
+            if isinstance(inst, parser.OFPInstructionActions):
+                ports += [a.port for a in inst.actions
+                          if isinstance(a, parser.OFPActionOutput)]
+            else:
+                # a goto (or a meter already) means it is not just a punt
+                return False
+        return bool(ports) and \
+            all(port == ofproto.OFPP_CONTROLLER for port in ports)
+
+    def _with_meter(self, datapath, mod):
+        parser = datapath.ofproto_parser
+        return parser.OFPFlowMod(
+            datapath=datapath, cookie=mod.cookie,
+            cookie_mask=mod.cookie_mask, table_id=mod.table_id,
+            command=mod.command, idle_timeout=mod.idle_timeout,
+            hard_timeout=mod.hard_timeout, priority=mod.priority,
+            buffer_id=mod.buffer_id, out_port=mod.out_port,
+            out_group=mod.out_group, flags=mod.flags, match=mod.match,
+            instructions=[parser.OFPInstructionMeter(self.meter_id)] +
+            list(mod.instructions))
+
+    def admit(self, datapath, in_port, src):
+        """False if the PacketIn must be dropped without acting on it."""
+        now = time.monotonic()
+        dpid = datapath.id
+        port_key = (dpid, in_port)
+        src_key = (dpid, in_port, src)
+        if self.blocked and (self._blocked(port_key, now) or
+                             self._blocked(src_key, now)):
+            self.stats['dropped'] += 1
+            return False
+
+        if now - self.window_start >= _WINDOW:
+            self.window_start = now
+            self.src_counts.clear()
+            self.port_counts.clear()
+        sources = self.src_counts[src_key] = \
+            self.src_counts.get(src_key, 0) + 1
+        port = self.port_counts[port_key] = \
+            self.port_counts.get(port_key, 0) + 1
+
+        if port > self.port_rate and self.is_edge is not None and \
+                self.is_edge(dpid, in_port):
+            self._block(datapath, port_key, now, in_port=in_port)
+            self.stats['blocked_ports'] += 1
+        elif sources > self.src_rate:
+            self._block(datapath, src_key, now, in_port=in_port, eth_src=src)
+            self.stats['blocked_sources'] += 1
+        else:
+            self.stats['admitted'] += 1
+            return True
+        self.stats['dropped'] += 1
+        return False
+
+    def _blocked(self, key, now):
+        until = self.blocked.get(key)
+        if until is None:
+            return False
+        if now < until:
+            return True
+        del self.blocked[key]
+        return False
+
+    def _block(self, datapath, key, now, **fields):
+        self.blocked[key] = now + self.block_time
+        self.app.logger.warning("blocking %s for %ss, over its PacketIn rate",
+                                key, self.block_time)
+        parser = datapath.ofproto_parser
+        mod = parser.OFPFlowMod(datapath=datapath, cookie=self.block_cookie,
+                                priority=self.block_priority,
+                                hard_timeout=self.block_time,
+                                match=parser.OFPMatch(**fields),
+                                instructions=[])
+        self.app.flow_programmer.submit(datapath, mod)
@@ -0,0 +1,230 @@
+"""Shard PacketIn processing across worker processes by datapath id.
+
+ShardPool runs one handler per worker process; every event of a datapath
+goes to worker dpid % workers, so state keyed by datapath (mac_to_port,
+learned hosts) lives in exactly one worker and needs no locking. Events
+cross the pipe as plain tuples in batches and the worker rebuilds the ryu
+message around a ShardDatapath, which collects what the handler sends as
+serialized OpenFlow messages. The pool writes those bytes to the real
+datapath as they come back, so a busy switch only delays the switches
+that share its worker.
+
+Handlers are built in the worker by handler_factory() and provide
+switch_connected(datapath), packet_in(msg) and flow_removed(msg). There
+are no barrier replies in a worker, so handlers program flows through a
+DirectProgrammer instead of a flow_pipeline.FlowProgrammer.
+
+Workers are forked, so the factory and the modules it needs don't have
+to be importable by name. workers=0 runs the handlers inline on the event
+loop, through the same serialization, which is handy for debugging and as
+the baseline in bench_workers.py.
+"""
+
+import multiprocessing
+
+from eventlet.hubs import trampoline
+from ryu.lib import hub
+from ryu.ofproto import ofproto_v1_3
+from ryu.ofproto import ofproto_v1_3_parser
+
+
+class DirectProgrammer(object):
+    """FlowProgrammer stand-in that sends every FlowMod right away."""
+
+    def submit(self, datapath, mod, callback=None):
+        datapath.send_msg(mod)
+        if callback is not None:
+            callback(datapath, True)
+
+    def send(self, datapath, msg):
+        datapath.send_msg(msg)
+
+
+class ShardDatapath(object):
+    """Stands in for a Datapath inside a worker."""
+
+    def __init__(self, dpid, xid_base):
+        self.id = dpid
+        self.ofproto = ofproto_v1_3
+        self.ofproto_parser = ofproto_v1_3_parser
+        # workers get disjoint xid ranges, errors can still be matched up
+        self.xid = xid_base
+        self.out = []
+
+    def set_xid(self, msg):
+        self.xid += 1
+        msg.set_xid(self.xid)
+        return self.xid
+
+    def send_msg(self, msg):
+        if msg.xid is None:
+            self.set_xid(msg)
+        msg.serialize()
+        self.out.append(bytes(msg.buf))
+        return True
+
+
+class _Shard(object):
+    """Handler plus datapath stand-ins of one worker."""
+
+    def __init__(self, handler_factory, index):
+        self.handler = handler_factory()
+        self.xid_base = 0x80000000 | (index & 0x7f) << 24
+        self.datapaths = {}
+
+    def handle(self, batch):
+        results = []
+        for event in batch:
+            kind, dpid = event[0], event[1]
+            datapath = self.datapaths.get(dpid)
+            if datapath is None:
+                datapath = self.datapaths[dpid] = ShardDatapath(
+                    dpid, self.xid_base)
+            parser = datapath.ofproto_parser
+            if kind == 'features':
+                self.handler.switch_connected(datapath)
+            elif kind == 'packet_in':
+                (_kind, _dpid, in_port, buffer_id, total_len, reason,
+                 table_id, cookie, data) = event
+                msg = parser.OFPPacketIn(
+                    datapath, buffer_id=buffer_id, total_len=total_len,
+                    reason=reason, table_id=table_id, cookie=cookie,
+                    match=parser.OFPMatch(in_port=in_port), data=data)
+                msg.msg_len = datapath.ofproto.OFP_PACKET_IN_SIZE + len(data)
+                self.handler.packet_in(msg)
+            elif kind == 'flow_removed':
+                (_kind, _dpid, cookie, priority, reason, table_id,
+                 match) = event
+                msg = parser.OFPFlowRemoved(
+                    datapath, cookie=cookie, priority=priority,
+                    reason=reason, table_id=table_id,
+                    match=parser.OFPMatch(**dict(match)))
+                self.handler.flow_removed(msg)
+            if datapath.out:
+                results.append((dpid, datapath.out))
+                datapath.out = []
+        return results
+
+
+def _worker_main(conn, handler_factory, index):
+    shard = _Shard(handler_factory, index)
+    while True:
+        batch = conn.recv()
+        if batch is None:
+            break
+        conn.send(shard.handle(batch))
+    conn.close()
+
+
+class ShardPool(object):
+    def __init__(self, handler_factory, workers=2, batch_size=64,
+                 max_inflight=4):
+        self.handler_factory = handler_factory
+        self.workers = workers
+        self.batch_size = batch_size
+        # batches a worker may have queued, keeps both pipes from filling
+        self.max_inflight = max_inflight
+        self.datapaths = {}
+        self.conns = []
+        self.processes = []
+        self.inline = None
+        self.pending = {}
+        self.flush_scheduled = set()
+        self.inflight = {}
+        self.stats = {'events': 0, 'batches': 0, 'messages': 0}
+
+    def start(self):
+        if self.workers == 0:
+            self.inline = _Shard(self.handler_factory, 0)
+            return
+        context = multiprocessing.get_context('fork')
+        for index in range(self.workers):
+            parent, child = context.Pipe()
+            process = context.Process(
+                target=_worker_main, args=(child, self.handler_factory, index),
+                daemon=True)
+            process.start()
+            child.close()
+            self.conns.append(parent)
+            self.processes.append(process)
+            self.inflight[index] = 0
+            hub.spawn(self._reader, index)
+
+    def stop(self):
+        for conn in self.conns:
+            conn.send(None)
+        for process in self.processes:
+            process.join()
+        self.conns = []
+        self.processes = []
+
+    def shard(self, dpid):
+        return dpid % self.workers if self.workers else 0
+
+    def switch_connected(self, datapath):
+        self.datapaths[datapath.id] = datapath
+        self._submit(datapath.id, ('features', datapath.id))
+
+    def packet_in(self, msg):
+        dpid = msg.datapath.id
+        self._submit(dpid, ('packet_in', dpid, msg.match['in_port'],
+                            msg.buffer_id, msg.total_len, msg.reason,
+                            msg.table_id, msg.cookie, bytes(msg.data)))
+
+    def flow_removed(self, msg):
+        dpid = msg.datapath.id
+        self._submit(dpid, ('flow_removed', dpid, msg.cookie, msg.priority,
+                            msg.reason, msg.table_id,
+                            tuple(msg.match.items())))
+
+    def _submit(self, dpid, event):
+        self.stats['events'] += 1
+        if self.inline is not None:
+            self._deliver(self.inline.handle([event]))
+            return
+        index = self.shard(dpid)
+        batch = self.pending.setdefault(index, [])
+        batch.append(event)
+        if len(batch) >= self.batch_size:
+            self.flush(index)
+        elif index not in self.flush_scheduled:
+            self.flush_scheduled.add(index)
+            hub.spawn(self.flush, index)
+
+    def flush(self, index):
+        self.flush_scheduled.discard(index)
+        if self.inflight[index] >= self.max_inflight:
+            # the batch keeps growing until the worker answers, see _reader
+            return
+        batch = self.pending.pop(index, None)
+        if not batch:
+            return
+        self.inflight[index] += 1
+        self.stats['batches'] += 1
+        self.conns[index].send(batch)
+
+    def _reader(self, index):
+        conn = self.conns[index]
+        while True:
+            trampoline(conn.fileno(), read=True)
+            try:
+                results = conn.recv()
+            except EOFError:
+                return
+            self.inflight[index] -= 1
+            self._deliver(results)
+            if self.pending.get(index):
+                self.flush(index)
+
+    def _deliver(self, results):
+        for dpid, bufs in results:
+            datapath = self.datapaths.get(dpid)
+            if datapath is None:
+                continue
+            for buf in bufs:
+                datapath.send(buf)
+            self.stats['messages'] += len(bufs)
+
+    def idle(self):
+        """True once every submitted event has been handled."""
+        return not self.pending and not any(self.inflight.values())
@@ -0,0 +1,555 @@
+"""Stages of pipeline_switch's multi-table pipeline.
+
+Each stage owns an OpenFlow table and hands what it does not decide on to
+a later table with OFPInstructionGotoTable, so its flows never have to
+repeat another stage's match fields:
+
+    AclStage  drop flows for the firewall rules (see firewall_rules),
+              everything else goes on to the next stage
+    VipStage  per-connection rewrite flows for the VIP (see lb_conntrack)
+              that send the rewritten packet straight to L2 forwarding;
+              only VIP traffic without a connection flow, and FIN/RST
+              segments the connection tracking needs, come up to the
+              controller, everything else goes on
+
+L2 forwarding is flow_strategy's DestinationMatchStrategy on two more
+tables. The stages take their settings from the app's class attributes of
+the same names and, like the strategies, have switch_connected(),
+flow_removed(), reconcile() (see flow_sync) and dump()/restore() (see
+state_store).
+"""
+
+import os
+
+from ryu.lib import hub
+from ryu.lib.packet import arp
+from ryu.lib.packet import ether_types
+from ryu.lib.packet import ethernet
+from ryu.lib.packet import packet
+from ryu.lib.packet.ether_types import ETH_TYPE_IP
+
+from firewall_rules import Rule, RuleSet, load_rules, rule_from_match
+from lb_conntrack import CLOSING, OPEN, ConnectionTable, TCP_FIN, TCP_RST
+from lb_health import HealthChecker
+from lb_scheduler import Backend, SCHEDULERS
+
+
+class AclStage(object):
+    priority = 100
+    cookie = 0xf1
+
+    def __init__(self, app, table_id, next_table):
+        self.app = app
+        self.table_id = table_id
+        self.next_table = next_table
+        self.rules_file = app.rules_file
+        self.poll_interval = app.rules_poll_interval
+        self.rules = RuleSet()
+        self.rules_mtime = None
+        self.thread = None
+
+    def start(self):
+        self.reload_rules()
+        if self.thread is None:
+            self.thread = hub.spawn(self._watcher)
+
+    def switch_connected(self, datapath):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        mod = parser.OFPFlowMod(
+            datapath=datapath, table_id=self.table_id, priority=0,
+            match=parser.OFPMatch(),
+            instructions=[parser.OFPInstructionGotoTable(self.next_table)])
+        self.app.flow_programmer.submit(datapath, mod)
+        for rule in self.rules.rules:
+            self._flow(datapath, rule, ofproto.OFPFC_ADD)
+
+    def _flow(self, datapath, rule, command):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        mod = parser.OFPFlowMod(datapath=datapath, table_id=self.table_id,
+                                command=command, cookie=self.cookie,
+                                priority=self.priority,
+                                out_port=ofproto.OFPP_ANY,
+                                out_group=ofproto.OFPG_ANY,
+                                match=rule.match(parser), instructions=[])
+        self.app.flow_programmer.submit(datapath, mod)
+
+    def set_policy(self, rules):
+        """Replace the policy, only touching flows that changed."""
+        new = RuleSet(rules)
+        old = self.rules
+        self.rules = new
+        for datapath in self.app.datapaths.values():
+            ofproto = datapath.ofproto
+            for rule in old.rules - new.rules:
+                self._flow(datapath, rule, ofproto.OFPFC_DELETE_STRICT)
+            for rule in new.rules - old.rules:
+                self._flow(datapath, rule, ofproto.OFPFC_ADD)
+
+    def reload_rules(self):
+        try:
+            mtime = os.stat(self.rules_file).st_mtime
+        except OSError as e:
+            self.app.logger.error("firewall rules unavailable: %s", e)
+            return
+        if mtime == self.rules_mtime:
+            return
+        self.rules_mtime = mtime
+        try:
+            rules = load_rules(self.rules_file)
+        except (OSError, ValueError) as e:
+            # keep enforcing the previous policy
+            self.app.logger.error("bad firewall rules in %s: %s",
+                                  self.rules_file, e)
+            return
+        self.set_policy(rules)
+        self.app.logger.info("loaded %d firewall rules from %s",
+                             len(self.rules), self.rules_file)
+
+    def _watcher(self):
+        while True:
+            hub.sleep(self.poll_interval)
+            self.reload_rules()
+
+    def allows(self, key, client_mac, backend):
+        """Whether the policy lets a VIP connection use backend.
+
+        Its packets are only checked here on their way in, before the
+        rewrite: the client's against the VIP, the back-end's replies
+        against the client.
+        """
+        client_ip, _vip, proto, client_port, service_port = key
+        rules = self.rules
+        return rules.lookup_ip(client_ip, backend.ip, proto, client_port,
+                               service_port) is None and \
+            rules.lookup_ip(backend.ip, client_ip, proto, service_port,
+                            client_port) is None and \
+            rules.lookup_mac(client_mac, backend.mac) is None and \
+            rules.lookup_mac(backend.mac, client_mac) is None
+
+    def flow_removed(self, msg):
+        pass
+
+    def reconcile(self, datapath, stats):
+        parser = datapath.ofproto_parser
+        # compared as Rules, see firewall_monitor
+        policy = set(rule_from_match(rule.match(parser))
+                     for rule in self.rules.rules)
+        return [stat for stat in stats
+                if stat.table_id == self.table_id and
+                stat.cookie == self.cookie and
+                (stat.priority != self.priority or
+                 rule_from_match(stat.match) not in policy)]
+
+    def dump(self):
+        return {'rules': dict((rule, True) for rule in self.rules.rules)}
+
+    def restore(self, tables):
+        self.rules = RuleSet(Rule(*rule) for rule in tables.get('rules', {}))
+
+
+class VipStage(object):
+    conn_priority = 20
+    punt_priority = 30
+    # low 16 bits hold the back-end's index in the pool
+    cookie = 0x1b0000
+    cookie_mask = 0xffff0000
+
+    def __init__(self, app, table_id, next_table, l2_table):
+        self.app = app
+        self.logger = app.logger
+        self.datapaths = app.datapaths
+        self.mac_to_port = app.mac_to_port
+        self.table_id = table_id
+        self.next_table = next_table
+        # rewritten packets skip source learning, the VIP is no host
+        self.l2_table = l2_table
+        self.virtual_ip = app.virtual_ip
+        self.virtual_mac = app.virtual_mac
+        self.idle_timeout = app.flow_idle_timeout
+        self.load_poll_interval = app.load_poll_interval
+        self.pool = [Backend(**b) for b in app.backends]
+        self.sched = SCHEDULERS[app.scheduler](self.pool)
+        self.conns = ConnectionTable(self.sched, app.conn_linger,
+                                     app.conn_time_wait, app.sticky_timeout)
+        self.health = HealthChecker(self, app.health_interval,
+                                    app.health_max_missed)
+        # dpid -> flow stats parts so far, back-end name -> bytes/sec
+        self.load_parts = {}
+        self.load = {}
+        self.load_thread = None
+
+    def start(self):
+        self.health.start()
+        if self.load_thread is None:
+            self.load_thread = hub.spawn(self._load_poller)
+
+    def switch_connected(self, datapath):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        app = self.app
+
+        # ARP for the VIP, including health probe replies
+        match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_ARP,
+                                arp_tpa=self.virtual_ip)
+        actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,
+                                          ofproto.OFPCML_NO_BUFFER)]
+        app.add_flow(datapath, self.punt_priority, match, actions,
+                     table_id=self.table_id)
+
+        # FIN and RST segments of tracked connections, both directions
+        ends = [dict(ipv4_dst=self.virtual_ip)]
+        ends += [dict(ipv4_src=backend.ip) for backend in self.pool]
+        for end in ends:
+            for flag in (TCP_FIN, TCP_RST):
+                match = parser.OFPMatch(eth_type=ETH_TYPE_IP, ip_proto=6,
+                                        tcp_flags=(flag, flag), **end)
+                app.add_flow(datapath, self.punt_priority, match, actions,
+                             table_id=self.table_id)
+
+        self.install_punt(datapath)
+        app.add_flow(datapath, 0, parser.OFPMatch(), [],
+                     table_id=self.table_id, goto_table=self.next_table)
+
+    def install_punt(self, datapath):
+        """The stage's miss for VIP traffic: new connections come up."""
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        match = parser.OFPMatch(eth_type=ETH_TYPE_IP,
+                                ipv4_dst=self.virtual_ip)
+        actions = [parser.OFPActionOutput(
+            ofproto.OFPP_CONTROLLER, self.app.buffering.max_len(datapath))]
+        self.app.add_flow(datapath, 1, match, actions,
+                          table_id=self.table_id)
+
+    def _backend_cookie(self, backend):
+        return self.cookie | self.pool.index(backend)
+
+    def _cookie_backend(self, cookie):
+        if cookie & self.cookie_mask != self.cookie:
+            return None
+        index = cookie & ~self.cookie_mask
+        if index < len(self.pool):
+            return self.pool[index]
+        return None
+
+    def _port(self, datapath, mac, default=None):
+        port = self.mac_to_port.get(datapath.id, {}).get(mac, default)
+        if port is None:
+            return datapath.ofproto.OFPP_FLOOD
+        return port
+
+    def _backend_port(self, datapath, backend):
+        return self._port(datapath, backend.mac, backend.port)
+
+    def backend_down(self, backend):
+        self.sched.remove(backend)
+        # its connections get rescheduled on their next packet
+        self.conns.backend_removed(backend)
+        for datapath in self.datapaths.values():
+            ofproto = datapath.ofproto
+            parser = datapath.ofproto_parser
+            mod = parser.OFPFlowMod(datapath=datapath,
+                                    command=ofproto.OFPFC_DELETE,
+                                    table_id=self.table_id,
+                                    cookie=self._backend_cookie(backend),
+                                    cookie_mask=0xffffffffffffffff,
+                                    out_port=ofproto.OFPP_ANY,
+                                    out_group=ofproto.OFPG_ANY,
+                                    match=parser.OFPMatch())
+            self.app.flow_programmer.submit(datapath, mod)
+
+    def backend_up(self, backend):
+        self.sched.add(backend)
+
+    def port_down(self, datapath, port_no):
+        self.health.port_down(datapath, port_no)
+
+    def _load_poller(self):
+        while True:
+            hub.sleep(self.load_poll_interval)
+            self.conns.expire()
+            for datapath in list(self.datapaths.values()):
+                parser = datapath.ofproto_parser
+                req = parser.OFPFlowStatsRequest(
+                    datapath, table_id=self.table_id, cookie=self.cookie,
+                    cookie_mask=self.cookie_mask)
+                datapath.send_msg(req)
+
+    def flow_stats_reply(self, msg):
+        # a reply can come in several parts, rates are over all of them
+        dpid = msg.datapath.id
+        parts = self.load_parts.setdefault(dpid, [])
+        parts.extend(msg.body)
+        if msg.flags & msg.datapath.ofproto.OFPMPF_REPLY_MORE:
+            return
+        del self.load_parts[dpid]
+        rates = dict((b.name, 0.0) for b in self.pool)
+        for stat in parts:
+            backend = self._cookie_backend(stat.cookie)
+            if backend is None:
+                continue
+            # average rate over the flow's lifetime is enough to rank
+            duration = stat.duration_sec + stat.duration_nsec / 1e9
+            rates[backend.name] += stat.byte_count / max(duration, 1.0)
+        # and a back-end's load adds up the connected switches
+        self.load[dpid] = rates
+        for backend in self.pool:
+            self.sched.update_load(backend, sum(
+                self.load[d][backend.name] for d in self.load
+                if d in self.datapaths))
+
+    def flow_removed(self, msg):
+        # only the client side of a connection reports its removal
+        if msg.table_id == self.table_id and \
+                self._cookie_backend(msg.cookie) is not None and \
+                msg.match.get('ipv4_dst') == self.virtual_ip:
+            self.conns.idle(self._match_key(msg.match))
+
+    def packet_in(self, msg, hdr, in_port):
+        """True if the PacketIn was VIP traffic and has been dealt with."""
+        datapath = msg.datapath
+        if hdr.ethertype == ether_types.ETH_TYPE_ARP:
+            if hdr.arp_dst_ip != self.virtual_ip:
+                return False
+            if hdr.arp_opcode == arp.ARP_REPLY:
+                self.health.reply_received(hdr.arp_src_ip)
+            elif hdr.arp_opcode == arp.ARP_REQUEST:
+                self._arp_reply(datapath, hdr, in_port)
+            return True
+        if hdr.ethertype != ETH_TYPE_IP:
+            return False
+        if hdr.ipv4_dst == self.virtual_ip:
+            self._client_packet(datapath, hdr, in_port, msg)
+            return True
+        if hdr.tcp_flags is not None and \
+                hdr.tcp_flags & (TCP_FIN | TCP_RST) and \
+                any(b.ip == hdr.ipv4_src for b in self.pool):
+            self._server_close(datapath, hdr, in_port, msg)
+            return True
+        return False
+
+    def _arp_reply(self, datapath, hdr, in_port):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        pkt = packet.Packet()
+        pkt.add_protocol(ethernet.ethernet(
+            dst=hdr.arp_src_mac, src=self.virtual_mac,
+            ethertype=ether_types.ETH_TYPE_ARP))
+        pkt.add_protocol(arp.arp(
+            opcode=arp.ARP_REPLY, src_mac=self.virtual_mac,
+            src_ip=self.virtual_ip, dst_mac=hdr.arp_src_mac,
+            dst_ip=hdr.arp_src_ip))
+        pkt.serialize()
+        out = parser.OFPPacketOut(datapath=datapath,
+                                  buffer_id=ofproto.OFP_NO_BUFFER,
+                                  in_port=ofproto.OFPP_CONTROLLER,
+                                  actions=[parser.OFPActionOutput(in_port)],
+                                  data=pkt.data)
+        datapath.send_msg(out)
+
+    @staticmethod
+    def _match_key(match):
+        proto = match['ip_proto']
+        l4 = {6: 'tcp', 17: 'udp'}.get(proto)
+        if l4 is None:
+            return (match['ipv4_src'], match['ipv4_dst'], proto, None, None)
+        return (match['ipv4_src'], match['ipv4_dst'], proto,
+                match[l4 + '_src'], match[l4 + '_dst'])
+
+    def _conn_flows(self, parser, conn):
+        """(match, rewrite actions) of the client- and back-end-side flows.
+
+        Forwarding is left to the L2 stage, so the flows don't depend on
+        where the client or the back-end are.
+        """
+        client_ip, vip, proto, client_port, service_port = conn.key
+        backend = conn.backend
+        l4 = {6: 'tcp', 17: 'udp'}.get(proto)
+        inbound = {}
+        outbound = {}
+        if l4 is not None:
+            inbound = {l4 + '_src': client_port, l4 + '_dst': service_port}
+            outbound = {l4 + '_src': service_port, l4 + '_dst': client_port}
+
+        match = parser.OFPMatch(eth_type=ETH_TYPE_IP, ip_proto=proto,
+                                ipv4_src=client_ip, ipv4_dst=vip, **inbound)
+        actions = [parser.OFPActionSetField(eth_dst=backend.mac),
+                   parser.OFPActionSetField(ipv4_dst=backend.ip)]
+        forward = (match, actions)
+
+        match = parser.OFPMatch(eth_type=ETH_TYPE_IP, ip_proto=proto,
+                                ipv4_src=backend.ip, ipv4_dst=client_ip,
+                                **outbound)
+        actions = [parser.OFPActionSetField(eth_src=self.virtual_mac),
+                   parser.OFPActionSetField(ipv4_src=vip)]
+        return forward, (match, actions)
+
+    def _client_packet(self, datapath, hdr, in_port, msg):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        key = (hdr.ipv4_src, hdr.ipv4_dst, hdr.ip_proto,
+               hdr.src_port, hdr.dst_port)
+        flags = hdr.tcp_flags or 0
+
+        if flags & (TCP_FIN | TCP_RST):
+            conn = self.conns.lookup(key)
+            if conn is None:
+                self._unknown_close(datapath, hdr, in_port, key, msg)
+                return
+            self._forward(datapath, msg, in_port,
+                          self._conn_flows(parser, conn)[0][1],
+                          conn.backend.mac, conn.backend.port)
+            if self.conns.tcp_flags(conn, flags, True):
+                self._remove_conn_flows(conn)
+            return
+
+        # only back-ends the firewall lets this client talk to both ways
+        conn, install = self.conns.open(
+            key, datapath.id, in_port, hdr.src,
+            lambda backend: self.app.acl.allows(key, hdr.src, backend))
+        if conn is None:
+            self.logger.warning("no back-end for %s", key)
+            self.app.buffering.release(datapath, msg)
+            return
+        forward, reverse = self._conn_flows(parser, conn)
+        if not install:
+            self._forward(datapath, msg, in_port, forward[1],
+                          conn.backend.mac, conn.backend.port)
+            return
+        cookie = self._backend_cookie(conn.backend)
+        self.app.add_flow(datapath, self.conn_priority, reverse[0],
+                          reverse[1], cookie=cookie,
+                          idle_timeout=self.idle_timeout,
+                          table_id=self.table_id, goto_table=self.l2_table)
+        # the packet that brought us here takes the new flow, straight from
+        # the switch's buffer if it has one
+        buffered = msg.buffer_id != ofproto.OFP_NO_BUFFER
+        self.app.add_flow(datapath, self.conn_priority, forward[0],
+                          forward[1],
+                          buffer_id=msg.buffer_id if buffered else None,
+                          cookie=cookie, idle_timeout=self.idle_timeout,
+                          flags=ofproto.OFPFF_SEND_FLOW_REM,
+                          table_id=self.table_id, goto_table=self.l2_table)
+        if not buffered:
+            self._forward(datapath, msg, in_port, forward[1],
+                          conn.backend.mac, conn.backend.port)
+
+    def _unknown_close(self, datapath, hdr, in_port, key, msg):
+        """Send a FIN/RST we have no connection for to a back-end."""
+        parser = datapath.ofproto_parser
+        backend = self.sched.pick(
+            key, lambda b: self.app.acl.allows(key, hdr.src, b))
+        if backend is None:
+            self.app.buffering.release(datapath, msg)
+            return
+        self.logger.debug("FIN/RST for unknown connection %s to %s", key,
+                          backend.name)
+        self._forward(datapath, msg, in_port,
+                      [parser.OFPActionSetField(eth_dst=backend.mac),
+                       parser.OFPActionSetField(ipv4_dst=backend.ip)],
+                      backend.mac, backend.port)
+
+    def _server_close(self, datapath, hdr, in_port, msg):
+        parser = datapath.ofproto_parser
+        key = (hdr.ipv4_dst, self.virtual_ip, hdr.ip_proto,
+               hdr.dst_port, hdr.src_port)
+        conn = self.conns.lookup(key)
+        if conn is None or conn.backend.ip != hdr.ipv4_src:
+            # not load-balanced traffic, it only came up for its flags
+            self._forward(datapath, msg, in_port, [], hdr.dst)
+            return
+        self._forward(datapath, msg, in_port,
+                      self._conn_flows(parser, conn)[1][1], hdr.dst)
+        if self.conns.tcp_flags(conn, hdr.tcp_flags, False):
+            self._remove_conn_flows(conn)
+
+    def _forward(self, datapath, msg, in_port, actions, mac, default=None):
+        """PacketOut with actions, then where L2 knows mac to be."""
+        parser = datapath.ofproto_parser
+        data = None
+        if msg.buffer_id == datapath.ofproto.OFP_NO_BUFFER:
+            data = msg.data
+        actions = actions + [parser.OFPActionOutput(
+            self._port(datapath, mac, default))]
+        out = parser.OFPPacketOut(datapath=datapath, buffer_id=msg.buffer_id,
+                                  in_port=in_port, actions=actions, data=data)
+        self.app.flow_programmer.send(datapath, out)
+
+    def _remove_conn_flows(self, conn):
+        # the flows are where the connection was opened, not necessarily
+        # on the switch that saw the close
+        datapath = self.datapaths.get(conn.dpid)
+        if datapath is None:
+            return
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        forward, reverse = self._conn_flows(parser, conn)
+        mod = parser.OFPFlowMod(datapath=datapath, table_id=self.table_id,
+                                command=ofproto.OFPFC_DELETE_STRICT,
+                                priority=self.conn_priority,
+                                out_port=ofproto.OFPP_ANY,
+                                out_group=ofproto.OFPG_ANY, match=forward[0])
+        self.app.flow_programmer.submit(datapath, mod)
+        # the back-end's last segments still have to look like the VIP's
+        self.app.add_flow(datapath, self.conn_priority, reverse[0],
+                          reverse[1],
+                          cookie=self._backend_cookie(conn.backend),
+                          hard_timeout=self.conns.time_wait,
+                          table_id=self.table_id, goto_table=self.l2_table)
+
+    def reconcile(self, datapath, stats):
+        stale = []
+        # connection key -> [client-side flow, back-end-side flow]
+        conn_flows = {}
+        for stat in stats:
+            if stat.table_id != self.table_id or \
+                    stat.priority != self.conn_priority or \
+                    self._cookie_backend(stat.cookie) is None:
+                continue
+            key = self._match_key(stat.match)
+            if key[1] == self.virtual_ip:
+                conn_flows.setdefault(key, [None, None])[0] = stat
+            else:
+                key = (key[1], self.virtual_ip, key[2], key[4], key[3])
+                conn_flows.setdefault(key, [None, None])[1] = stat
+
+        installed = set()
+        for key, (forward, reverse) in conn_flows.items():
+            if self._conn_installed(datapath, key, forward, reverse):
+                installed.add(key)
+            else:
+                stale += [stat for stat in (forward, reverse)
+                          if stat is not None]
+        self.conns.switch_reset(datapath.id, installed)
+        return stale
+
+    def _conn_installed(self, datapath, key, forward, reverse):
+        """Whether a connection's flows in the switch can stay; one we
+        don't know is adopted."""
+        if forward is None or reverse is None or \
+                forward.cookie != reverse.cookie:
+            return False
+        backend = self._cookie_backend(forward.cookie)
+        if backend not in self.sched.backends:
+            return False
+        conn = self.conns.lookup(key)
+        if conn is None:
+            # the flows don't say where the client is, the host cache may
+            client = self.app.hosts.lookup_ip(key[0])
+            self.conns.adopt(key, backend, datapath.id, None,
+                             client.mac if client is not None else None)
+            return True
+        return conn.backend is backend and conn.dpid == datapath.id and \
+            conn.state in (OPEN, CLOSING)
+
+    def dump(self):
+        return self.conns.dump()
+
+    def restore(self, tables):
+        self.conns.restore(tables, dict((b.name, b) for b in self.pool))
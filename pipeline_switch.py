@@ -0,0 +1,268 @@
+"""Firewall, load balancer and learning switch as one multi-table pipeline.
+
+firewall_monitor, load_balancer and learning_switch each program table 0
+on their own; run side by side their flows would have to be crossed, one
+per rule x connection x host pair. Here each is a stage with its own
+tables, see pipeline_stages:
+
+    table 0  ACL   firewall drop flows, else goto 1
+    table 1  VIP   connection rewrites, then goto 3; new VIP connections
+                   to the controller; else goto 2
+    table 2  L2    eth_src=X, in_port=P -> goto 3, unknown sources copied
+                   to the controller (see flow_strategy's 'dst')
+    table 3  L2    eth_dst=X -> output P, else FLOOD
+
+so a switch holds rules + 2 flows per connection + 2 per host, and the
+controller only sees packets a stage has no flow for and has to decide
+on. Connections are tracked per connection only; the group mode of
+load_balancer does not fit, a group bucket cannot goto a table.
+
+Firewall rules see packets as they enter, before the VIP rewrite: to keep
+a client away from the service, block it from the VIP.
+"""
+
+import os
+
+from ryu.base import app_manager
+from ryu.controller import ofp_event
+from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER
+from ryu.controller.handler import DEAD_DISPATCHER
+from ryu.controller.handler import set_ev_cls
+from ryu.ofproto import ofproto_v1_3
+from ryu.lib.packet import ether_types
+
+from flow_pipeline import FlowProgrammer, FlowProgrammerEvents
+from flow_strategy import DestinationMatchStrategy
+from flow_sync import FlowReconciler
+from host_tracker import HostTracker
+from instrument import Instrumentation
+from packet_buffer import PacketBuffering
+from packet_in_guard import PacketInGuard
+from pipeline_stages import AclStage, VipStage
+from state_store import StateStore, flat_table, nest_table
+
+
+class SimpleSwitch13(FlowProgrammerEvents, app_manager.RyuApp):
+    OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
+
+    acl_table = 0
+    vip_table = 1
+    l2_src_table = 2
+    l2_dst_table = 3
+
+    # drop rules, see firewall_rules for the format. The file is watched
+    # and changes are pushed to the switches without a restart.
+    rules_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'firewall_rules.json')
+    rules_poll_interval = 2
+
+    # the VIP, its back-ends and their scheduling, as in load_balancer
+    virtual_ip = '10.0.0.42'
+    virtual_mac = '02:00:00:00:00:42'
+    backends = [
+        dict(name='h4', ip='10.0.0.4', mac='00:00:00:00:00:04', port=1),
+        dict(name='h5', ip='10.0.0.5', mac='00:00:00:00:00:05', port=1),
+    ]
+    scheduler = 'round_robin'
+    flow_idle_timeout = 30
+    conn_linger = 300
+    conn_time_wait = 10
+    sticky_timeout = 0
+    load_poll_interval = 5
+    health_interval = 0.2
+    health_max_missed = 3
+
+    # L2 source entries, seconds, 0 disables the timeout
+    idle_timeout = 60
+    hard_timeout = 600
+
+    # PacketIns/sec a switch may send, enforced by a meter where the switch
+    # has them; single sources are policed by the controller, see
+    # packet_in_guard. 0 leaves the switches unmetered.
+    packet_in_rate = 1000
+    # bytes of a new VIP connection's first frame sent up while the switch
+    # buffers the rest, None for whole frames, see packet_buffer
+    miss_send_len = 128
+    # path prefix of the learned tables, the policy in force and the
+    # connection and affinity tables, saved every state_interval seconds
+    # and restored on start while under state_max_age seconds old, see
+    # state_store; None starts empty. Either way the flows a switch kept
+    # are reconciled with them when it connects, see flow_sync.
+    state_file = None
+    state_interval = 5
+    state_max_age = 300
+    # timing histograms of the event handlers and PacketIn stages, written
+    # to instrument_file every instrument_interval seconds if set, and one
+    # PacketIn in log_every logged, see instrument. SIGUSR1 and SIGUSR2
+    # profile the running controller.
+    instrument_file = None
+    instrument_interval = 10
+    log_every = 100
+
+    def __init__(self, *args, **kwargs):
+        super(SimpleSwitch13, self).__init__(*args, **kwargs)
+        self.mac_to_port = {}
+        self.datapaths = {}
+        self.flow_programmer = FlowProgrammer()
+        self.hosts = HostTracker()
+        self.guard = PacketInGuard(self, self.packet_in_rate)
+        self.buffering = PacketBuffering(self, self.miss_send_len)
+        self.acl = AclStage(self, self.acl_table, self.vip_table)
+        self.vip = VipStage(self, self.vip_table, self.l2_src_table,
+                            self.l2_dst_table)
+        self.l2 = DestinationMatchStrategy(self,
+                                           idle_timeout=self.idle_timeout,
+                                           hard_timeout=self.hard_timeout)
+        self.l2.src_table = self.l2_src_table
+        self.l2.dst_table = self.l2_dst_table
+        self.stages = [self.acl, self.vip, self.l2]
+        self.reconciler = FlowReconciler(self)
+        self.instr = Instrumentation(self, self.instrument_file,
+                                     self.instrument_interval, self.log_every)
+        self.instr.instrument(self)
+        self.instr.start()
+        self.store = None
+        if self.state_file is not None:
+            self.store = StateStore(self, self.state_file, self.state_interval,
+                                    max_age=self.state_max_age)
+            self.restore_state(self.store.load())
+            self.store.start()
+        self.acl.start()
+        self.vip.start()
+
+    @set_ev_cls(ofp_event.EventOFPStateChange,
+                [MAIN_DISPATCHER, DEAD_DISPATCHER])
+    def _state_change_handler(self, ev):
+        datapath = ev.datapath
+        if ev.state == MAIN_DISPATCHER:
+            self.datapaths[datapath.id] = datapath
+        elif ev.state == DEAD_DISPATCHER and datapath.id is not None and \
+                self.datapaths.get(datapath.id) is datapath:
+            del self.datapaths[datapath.id]
+            # its connections idle out, and expire unless it comes back
+            self.vip.conns.switch_reset(datapath.id)
+
+    @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
+    def switch_features_handler(self, ev):
+        datapath = ev.msg.datapath
+        self.instr.watch(datapath)
+
+        self.mac_to_port.setdefault(datapath.id, {})
+        self.flow_programmer.reset(datapath)
+        self.reconciler.switch_connected(datapath)
+        self.guard.switch_connected(datapath)
+        self.buffering.switch_features(ev.msg)
+        for stage in self.stages:
+            stage.switch_connected(datapath)
+
+    def reconcile(self, datapath, stats):
+        stale = []
+        for stage in self.stages:
+            stale += stage.reconcile(datapath, stats)
+        return stale
+
+    def dump_state(self):
+        tables = {'mac_to_port': flat_table(self.mac_to_port),
+                  'hosts': self.hosts.dump()}
+        for stage in self.stages:
+            tables.update(stage.dump())
+        return tables
+
+    def restore_state(self, tables):
+        nest_table(tables.get('mac_to_port', {}), self.mac_to_port)
+        self.hosts.restore(tables.get('hosts', {}))
+        for stage in self.stages:
+            stage.restore(tables)
+
+    def stop(self):
+        self.instr.close()
+        if self.store is not None:
+            self.store.close()
+        super(SimpleSwitch13, self).stop()
+
+    def add_flow(self, datapath, priority, match, actions, buffer_id=None,
+                 table_id=0, goto_table=None, idle_timeout=0, hard_timeout=0,
+                 flags=0, cookie=0):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,
+                                             actions)]
+        if goto_table is not None:
+            inst.append(parser.OFPInstructionGotoTable(goto_table))
+        if buffer_id:
+            mod = parser.OFPFlowMod(datapath=datapath, buffer_id=buffer_id,
+                                    table_id=table_id, priority=priority,
+                                    match=match, instructions=inst,
+                                    idle_timeout=idle_timeout,
+                                    hard_timeout=hard_timeout, flags=flags,
+                                    cookie=cookie)
+        else:
+            mod = parser.OFPFlowMod(datapath=datapath, table_id=table_id,
+                                    priority=priority, match=match,
+                                    instructions=inst,
+                                    idle_timeout=idle_timeout,
+                                    hard_timeout=hard_timeout, flags=flags,
+                                    cookie=cookie)
+        self.flow_programmer.submit(datapath, self.guard.meter(datapath, mod))
+
+    @set_ev_cls(ofp_event.EventOFPMeterFeaturesStatsReply,
+                [CONFIG_DISPATCHER, MAIN_DISPATCHER])
+    def _meter_features_reply_handler(self, ev):
+        self.guard.meter_features_reply(ev.msg)
+
+    @set_ev_cls(ofp_event.EventOFPFlowStatsReply,
+                [CONFIG_DISPATCHER, MAIN_DISPATCHER])
+    def _flow_stats_reply_handler(self, ev):
+        if not self.reconciler.flow_stats_reply(ev.msg):
+            self.vip.flow_stats_reply(ev.msg)
+
+    @set_ev_cls(ofp_event.EventOFPPortStatus, MAIN_DISPATCHER)
+    def _port_status_handler(self, ev):
+        msg = ev.msg
+        ofproto = msg.datapath.ofproto
+        if msg.reason == ofproto.OFPPR_DELETE or \
+                msg.desc.state & ofproto.OFPPS_LINK_DOWN:
+            self.vip.port_down(msg.datapath, msg.desc.port_no)
+
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def _flow_removed_handler(self, ev):
+        self.flow_programmer.flow_removed(ev.msg)
+        for stage in self.stages:
+            stage.flow_removed(ev.msg)
+
+    @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
+    def _packet_in_handler(self, ev):
+        msg = ev.msg
+        datapath = msg.datapath
+        in_port = msg.match['in_port']
+
+        eth = self.instr.parse(msg.data)
+
+        if eth is None or eth.ethertype == ether_types.ETH_TYPE_LLDP:
+            return
+        if not self.guard.admit(datapath, in_port, eth.src):
+            return
+        if not self.buffering.complete(msg):
+            # only the VIP punt buffers, ask it for whole frames
+            self.vip.install_punt(datapath)
+            return
+
+        dpid = datapath.id
+        self.mac_to_port.setdefault(dpid, {})
+
+        self.instr.log_sampled(self.logger, "packet in %s %s %s %s",
+                               dpid, eth.src, eth.dst, in_port)
+
+        self.hosts.learn(dpid, in_port, eth)
+        # a packet the VIP stage sent up never reached the L2 tables, its
+        # source is learned here
+        if self.vip.packet_in(msg, eth, in_port):
+            self.l2.host_seen(datapath, eth.src, in_port)
+            return
+        if self.hosts.arp_proxy(datapath, in_port, eth,
+                                self.acl.rules.lookup_mac):
+            self.l2.host_seen(datapath, eth.src, in_port)
+            return
+
+        self.l2.packet_in(msg, in_port, eth.src, eth.dst)
@@ -0,0 +1,105 @@
+"""Cheap header extraction for PacketIn payloads.
+
+packet.Packet(msg.data) decodes every layer of a frame into ryu objects,
+while the handlers mostly need the Ethernet header and a few IPv4/ARP
+fields. parse() reads those straight out of a memoryview with fixed struct
+offsets; Headers.pkt still gives the full ryu decode for the rare handler
+that needs it, built lazily on first access.
+"""
+
+import socket
+import struct
+
+from ryu.lib.packet import packet
+from ryu.lib.packet import ether_types
+
+_ETH_HDR = struct.Struct('!6s6sH')
+_VLAN_TAG = struct.Struct('!HH')
+_IPV4_HDR = struct.Struct('!BBHHHBBH4s4s')
+_ARP_HDR = struct.Struct('!HHBBH6s4s6s4s')
+_L4_PORTS = struct.Struct('!HH')
+
+_VLAN_TYPES = (ether_types.ETH_TYPE_8021Q, ether_types.ETH_TYPE_8021AD)
+_IPPROTO_TCP = 6
+_IPPROTO_UDP = 17
+_TCP_FLAGS_OFFSET = 13
+
+
+def _mac(raw):
+    return raw.hex(':')
+
+
+class Headers(object):
+    __slots__ = ('data', 'dst', 'src', 'ethertype', 'vlan_id',
+                 'ipv4_src', 'ipv4_dst', 'ip_proto', 'src_port', 'dst_port',
+                 'tcp_flags', 'arp_opcode', 'arp_src_mac', 'arp_src_ip',
+                 'arp_dst_mac', 'arp_dst_ip', '_pkt')
+
+    def __init__(self, data):
+        self.data = data
+        self.vlan_id = None
+        self.ipv4_src = self.ipv4_dst = self.ip_proto = None
+        self.src_port = self.dst_port = self.tcp_flags = None
+        self.arp_opcode = None
+        self.arp_src_mac = self.arp_src_ip = None
+        self.arp_dst_mac = self.arp_dst_ip = None
+        self._pkt = None
+
+    @property
+    def pkt(self):
+        # full decode, only for handlers that need more than the fast path
+        if self._pkt is None:
+            self._pkt = packet.Packet(self.data)
+        return self._pkt
+
+
+def parse(data):
+    """Extract Ethernet, IPv4/TCP/UDP and ARP fields from a raw frame.
+
+    Returns None if the frame is too short to carry an Ethernet header.
+    Fields of layers that are absent or truncated are left as None.
+    """
+    view = memoryview(data)
+    if len(view) < _ETH_HDR.size:
+        return None
+    hdr = Headers(data)
+    dst, src, ethertype = _ETH_HDR.unpack_from(view, 0)
+    hdr.dst = _mac(dst)
+    hdr.src = _mac(src)
+    offset = _ETH_HDR.size
+
+    while ethertype in _VLAN_TYPES and len(view) >= offset + _VLAN_TAG.size:
+        tci, ethertype = _VLAN_TAG.unpack_from(view, offset)
+        hdr.vlan_id = tci & 0x0fff
+        offset += _VLAN_TAG.size
+    hdr.ethertype = ethertype
+
+    if ethertype == ether_types.ETH_TYPE_IP:
+        if len(view) < offset + _IPV4_HDR.size:
+            return hdr
+        (ver_ihl, _tos, _total_len, _ident, frag, _ttl, proto, _csum,
+         src_ip, dst_ip) = _IPV4_HDR.unpack_from(view, offset)
+        hdr.ipv4_src = socket.inet_ntoa(src_ip)
+        hdr.ipv4_dst = socket.inet_ntoa(dst_ip)
+        hdr.ip_proto = proto
+        # ports are only present in the first fragment
+        if frag & 0x1fff:
+            return hdr
+        offset += (ver_ihl & 0x0f) * 4
+        if proto in (_IPPROTO_TCP, _IPPROTO_UDP) and \
+                len(view) >= offset + _L4_PORTS.size:
+            hdr.src_port, hdr.dst_port = _L4_PORTS.unpack_from(view, offset)
+            if proto == _IPPROTO_TCP and \
+                    len(view) > offset + _TCP_FLAGS_OFFSET:
+                hdr.tcp_flags = view[offset + _TCP_FLAGS_OFFSET]
+    elif ethertype == ether_types.ETH_TYPE_ARP:
+        if len(view) < offset + _ARP_HDR.size:
+            return hdr
+        (_hwtype, _proto, _hlen, _plen, opcode, src_mac, src_ip,
+         dst_mac, dst_ip) = _ARP_HDR.unpack_from(view, offset)
+        hdr.arp_opcode = opcode
+        hdr.arp_src_mac = _mac(src_mac)
+        hdr.arp_src_ip = socket.inet_ntoa(src_ip)
+        hdr.arp_dst_mac = _mac(dst_mac)
+        hdr.arp_dst_ip = socket.inet_ntoa(dst_ip)
+    return hdr
@@ -0,0 +1,197 @@
+"""Controller state saved across restarts.
+
+StateStore keeps an app's tables, {key: value} dicts of JSON-able data
+named by the app, in two files next to each other:
+
+    <path>.snap   every table as of one generation, written to a temporary
+                  file and renamed over the previous snapshot
+    <path>.log    one line per entry changed since, [generation, table,
+                  key, value], value null for an entry that went away
+
+Every interval seconds save() diffs the app's dump_state() against what
+was last written and appends only the changes. The first save of a run,
+and any save once the log is over compact_after lines, writes a new
+snapshot under the next generation and truncates the log; lines of an
+older generation, left by a crash between the two, are skipped on load.
+Tuples, in keys or values, are written as JSON arrays and come back as
+tuples.
+
+load() ignores state older than max_age seconds: a controller upgrade
+picks up where the previous process left off, a start long after it may
+be facing another network and begins empty. The app restores what load()
+returns in __init__, calls start() and reads the switches' flows back
+on connect, see flow_sync.
+"""
+
+import json
+import os
+import time
+
+from ryu.lib import hub
+
+_VERSION = 1
+_SEPARATORS = (',', ':')
+_MISSING = object()
+
+
+def _encode(value):
+    if isinstance(value, tuple):
+        return [_encode(v) for v in value]
+    return value
+
+
+def _decode(value):
+    if isinstance(value, list):
+        return tuple(_decode(v) for v in value)
+    return value
+
+
+def flat_table(nested):
+    """{(outer, inner): value} of a {outer: {inner: value}} dict, e.g.
+    mac_to_port."""
+    return dict(((outer, inner), value)
+                for outer, entries in nested.items()
+                for inner, value in entries.items())
+
+
+def nest_table(flat, nested):
+    """Merge a flat_table() back into nested."""
+    for (outer, inner), value in flat.items():
+        nested.setdefault(outer, {})[inner] = value
+
+
+class StateStore(object):
+    def __init__(self, app, path, interval=5, compact_after=10000,
+                 max_age=300):
+        self.app = app
+        self.path = path
+        self.interval = interval
+        self.compact_after = compact_after
+        self.max_age = max_age
+        self.generation = 0
+        # table -> {key: encoded value} as last written
+        self.saved = {}
+        self.log = None
+        self.log_lines = 0
+        self.thread = None
+        self.stats = {'snapshots': 0, 'logged': 0}
+
+    def load(self):
+        """{table: {key: value}} as last saved, {} if missing or stale."""
+        try:
+            with open(self.path + '.snap') as f:
+                doc = json.load(f)
+        except (OSError, ValueError) as e:
+            self.app.logger.info("no saved state in %s: %s", self.path, e)
+            return {}
+        if doc.get('version') != _VERSION:
+            return {}
+        # the log is written to after the snapshot
+        age = time.time() - max(os.path.getmtime(self.path + suffix)
+                                for suffix in ('.snap', '.log')
+                                if os.path.exists(self.path + suffix))
+        if self.max_age and age > self.max_age:
+            self.app.logger.info("saved state in %s is %.0fs old, starting "
+                                 "empty", self.path, age)
+            return {}
+
+        generation = doc['generation']
+        tables = {}
+        for name, entries in doc['tables'].items():
+            tables[name] = dict((_decode(k), _decode(v)) for k, v in entries)
+        try:
+            with open(self.path + '.log') as f:
+                for line in f:
+                    try:
+                        gen, name, key, value = json.loads(line)
+                    except ValueError:
+                        # torn by a crash mid-write, nothing follows it
+                        break
+                    if gen != generation:
+                        continue
+                    if value is None:
+                        tables.get(name, {}).pop(_decode(key), None)
+                    else:
+                        tables.setdefault(name, {})[_decode(key)] = \
+                            _decode(value)
+        except OSError:
+            pass
+        self.generation = generation
+        self.app.logger.info("restored %s from %s",
+                             ', '.join('%d %s' % (len(t), n)
+                                       for n, t in sorted(tables.items())),
+                             self.path)
+        return tables
+
+    def start(self):
+        if self.thread is None:
+            self.thread = hub.spawn(self._saver)
+
+    def _saver(self):
+        while True:
+            hub.sleep(self.interval)
+            try:
+                self.save()
+            except OSError as e:
+                self.app.logger.error("saving state to %s failed: %s",
+                                      self.path, e)
+
+    def save(self):
+        current = {}
+        for name, entries in self.app.dump_state().items():
+            current[name] = dict((k, _encode(v)) for k, v in entries.items())
+        if self.log is None or self.log_lines >= self.compact_after:
+            self._snapshot(current)
+            return
+
+        lines = []
+        for name in set(current) | set(self.saved):
+            entries = current.get(name, {})
+            saved = self.saved.get(name, {})
+            for key, value in entries.items():
+                if saved.get(key, _MISSING) != value:
+                    lines.append([self.generation, name, _encode(key), value])
+            for key in saved:
+                if key not in entries:
+                    lines.append([self.generation, name, _encode(key), None])
+        if lines:
+            self.log.write(''.join(json.dumps(line, separators=_SEPARATORS) +
+                                   '\n' for line in lines))
+            self.log.flush()
+            self.log_lines += len(lines)
+            self.stats['logged'] += len(lines)
+        self.saved = current
+
+    def _snapshot(self, current):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        generation = self.generation + 1
+        doc = {'version': _VERSION, 'generation': generation,
+               'tables': dict((name, [[_encode(k), v]
+                                      for k, v in entries.items()])
+                              for name, entries in current.items())}
+        tmp = self.path + '.snap.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(doc, f, separators=_SEPARATORS)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path + '.snap')
+
+        if self.log is not None:
+            self.log.close()
+        self.log = open(self.path + '.log', 'w')
+        self.log_lines = 0
+        self.generation = generation
+        self.saved = current
+        self.stats['snapshots'] += 1
+
+    def close(self):
+        """Save what changed since the last interval, e.g. on shutdown."""
+        if self.thread is not None:
+            hub.kill(self.thread)
+            self.thread = None
+        self.save()
+        if self.log is not None:
+            self.log.close()
+            self.log = None
@@ -0,0 +1,277 @@
+"""LLDP link discovery and shortest-path computation.
+
+Topology sends an LLDP frame out of every live port of every switch each
+interval; the switch at the other end of a link sends it back up as a
+PacketIn, which turns it into a directed link (src_dpid, src_port) ->
+(dst_dpid, dst_port). A link that is not re-announced within link_timeout,
+or whose port goes down, is removed. Ports that are not part of a link are
+edge ports, where hosts live.
+
+Paths are computed per destination switch: one breadth-first search from
+the destination gives every other switch its next hop towards it, so the
+per-destination flows installed along different paths always agree and
+cannot loop. Trees are cached and recomputed by the discovery thread after
+a change, off the PacketIn path. A link change only invalidates the trees
+it affects: a removed link the ones that route over it, a new link the
+ones it makes shorter.
+
+The owning app calls switch_connected(), switch_disconnected(),
+port_desc_reply(), port_status() and packet_in() from its handlers.
+Callables in link_listeners are called with (link, up, stale) on every
+change, stale listing the destination switches whose paths it changed.
+"""
+
+import collections
+import struct
+import time
+
+from ryu.lib import hub
+from ryu.lib.packet import packet
+from ryu.lib.packet import ethernet
+from ryu.lib.packet import ether_types
+from ryu.lib.packet import lldp
+
+_CHASSIS_PREFIX = b'dpid:'
+_PORT_NO = struct.Struct('!I')
+
+Link = collections.namedtuple('Link', 'src_dpid src_port dst_dpid dst_port')
+
+
+class Topology(object):
+    # above any forwarding entry, LLDP must always reach the controller
+    lldp_priority = 0xfff0
+
+    def __init__(self, app, interval=1.0, link_timeout=3.5):
+        self.app = app
+        self.interval = interval
+        self.link_timeout = link_timeout
+        self.thread = None
+        self.datapaths = {}
+        # dpid -> set of live port numbers
+        self.ports = {}
+        # (src_dpid, src_port) -> Link, and when it was last announced
+        self.links = {}
+        self.last_seen = {}
+        # dst_dpid -> {src_dpid: set of src ports}, for the reverse search
+        self.inbound = {}
+        # dst_dpid -> (distance, next hop) dicts keyed by dpid
+        self._trees = {}
+        self.link_listeners = []
+        self.stats = {'hits': 0, 'misses': 0, 'invalidated': 0}
+
+    def start(self):
+        if self.thread is None:
+            self.thread = hub.spawn(self._run)
+
+    def _run(self):
+        while True:
+            for datapath in list(self.datapaths.values()):
+                for port_no in sorted(self.ports.get(datapath.id, ())):
+                    self.send_lldp(datapath, port_no)
+            hub.sleep(self.interval)
+            self.expire()
+            self.precompute()
+
+    def switch_connected(self, datapath):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        self.switch_disconnected(datapath.id)
+        self.datapaths[datapath.id] = datapath
+        self.ports[datapath.id] = set()
+
+        match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_LLDP)
+        actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,
+                                          ofproto.OFPCML_NO_BUFFER)]
+        self.app.add_flow(datapath, self.lldp_priority, match, actions)
+        datapath.send_msg(parser.OFPPortDescStatsRequest(datapath, 0))
+
+    def switch_disconnected(self, dpid):
+        self.datapaths.pop(dpid, None)
+        self.ports.pop(dpid, None)
+        for link in list(self.links.values()):
+            if dpid in (link.src_dpid, link.dst_dpid):
+                self._remove_link(link)
+
+    def port_desc_reply(self, msg):
+        datapath = msg.datapath
+        ofproto = datapath.ofproto
+        ports = self.ports.setdefault(datapath.id, set())
+        for port in msg.body:
+            if port.port_no <= ofproto.OFPP_MAX and \
+                    not port.state & ofproto.OFPPS_LINK_DOWN:
+                ports.add(port.port_no)
+                self.send_lldp(datapath, port.port_no)
+
+    def port_status(self, msg):
+        datapath = msg.datapath
+        ofproto = datapath.ofproto
+        port = msg.desc
+        ports = self.ports.setdefault(datapath.id, set())
+        if port.port_no > ofproto.OFPP_MAX:
+            return
+        if msg.reason == ofproto.OFPPR_DELETE or \
+                port.state & ofproto.OFPPS_LINK_DOWN:
+            ports.discard(port.port_no)
+            for link in list(self.links.values()):
+                if (link.src_dpid, link.src_port) == \
+                        (datapath.id, port.port_no) or \
+                        (link.dst_dpid, link.dst_port) == \
+                        (datapath.id, port.port_no):
+                    self._remove_link(link)
+        elif port.port_no not in ports:
+            ports.add(port.port_no)
+            self.send_lldp(datapath, port.port_no)
+
+    def send_lldp(self, datapath, port_no):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        pkt = packet.Packet()
+        pkt.add_protocol(ethernet.ethernet(
+            dst=lldp.LLDP_MAC_NEAREST_BRIDGE, src='02:00:00:00:00:01',
+            ethertype=ether_types.ETH_TYPE_LLDP))
+        pkt.add_protocol(lldp.lldp([
+            lldp.ChassisID(subtype=lldp.ChassisID.SUB_LOCALLY_ASSIGNED,
+                           chassis_id=_CHASSIS_PREFIX +
+                           (b'%016x' % datapath.id)),
+            lldp.PortID(subtype=lldp.PortID.SUB_PORT_COMPONENT,
+                        port_id=_PORT_NO.pack(port_no)),
+            lldp.TTL(ttl=120),
+            lldp.End()]))
+        pkt.serialize()
+
+        actions = [parser.OFPActionOutput(port_no)]
+        out = parser.OFPPacketOut(datapath=datapath,
+                                  buffer_id=ofproto.OFP_NO_BUFFER,
+                                  in_port=ofproto.OFPP_CONTROLLER,
+                                  actions=actions, data=pkt.data)
+        datapath.send_msg(out)
+
+    def packet_in(self, msg, in_port):
+        """Record the link an LLDP PacketIn came over.
+
+        Returns the Link, or None if the frame is not one of our probes.
+        """
+        frame = packet.Packet(msg.data).get_protocol(lldp.lldp)
+        if frame is None or len(frame.tlvs) < 2:
+            return None
+        chassis, port = frame.tlvs[0], frame.tlvs[1]
+        if not isinstance(chassis, lldp.ChassisID) or \
+                not chassis.chassis_id.startswith(_CHASSIS_PREFIX) or \
+                not isinstance(port, lldp.PortID) or \
+                len(port.port_id) != _PORT_NO.size:
+            return None
+        src_dpid = int(chassis.chassis_id[len(_CHASSIS_PREFIX):], 16)
+        src_port, = _PORT_NO.unpack(port.port_id)
+        if src_dpid not in self.datapaths:
+            return None
+
+        link = Link(src_dpid, src_port, msg.datapath.id, in_port)
+        key = (src_dpid, src_port)
+        self.last_seen[key] = time.monotonic()
+        previous = self.links.get(key)
+        if previous != link:
+            if previous is not None:
+                self._remove_link(previous)
+            self._add_link(link)
+        return link
+
+    def expire(self):
+        deadline = time.monotonic() - self.link_timeout
+        for key, seen in list(self.last_seen.items()):
+            if seen < deadline:
+                self._remove_link(self.links[key])
+
+    def _add_link(self, link):
+        self.links[(link.src_dpid, link.src_port)] = link
+        self.last_seen.setdefault((link.src_dpid, link.src_port),
+                                  time.monotonic())
+        self.inbound.setdefault(link.dst_dpid, {}).setdefault(
+            link.src_dpid, set()).add(link.src_port)
+        stale = []
+        for dst, (dist, _next_hop) in list(self._trees.items()):
+            if link.dst_dpid in dist and (
+                    link.src_dpid not in dist or
+                    dist[link.dst_dpid] + 1 < dist[link.src_dpid]):
+                stale.append(dst)
+        self._invalidate(stale)
+        for listener in self.link_listeners:
+            listener(link, True, stale)
+
+    def _remove_link(self, link):
+        key = (link.src_dpid, link.src_port)
+        if self.links.get(key) != link:
+            return
+        del self.links[key]
+        self.last_seen.pop(key, None)
+        ports = self.inbound[link.dst_dpid][link.src_dpid]
+        ports.discard(link.src_port)
+        if not ports:
+            del self.inbound[link.dst_dpid][link.src_dpid]
+        stale = [dst for dst, (_dist, next_hop) in self._trees.items()
+                 if next_hop.get(link.src_dpid) ==
+                 (link.dst_dpid, link.src_port)]
+        self._invalidate(stale)
+        for listener in self.link_listeners:
+            listener(link, False, stale)
+
+    def _invalidate(self, stale):
+        for dst in stale:
+            del self._trees[dst]
+        self.stats['invalidated'] += len(stale)
+
+    def is_edge(self, dpid, port_no):
+        return (dpid, port_no) not in self.links
+
+    def edge_ports(self, dpid):
+        return [p for p in sorted(self.ports.get(dpid, ()))
+                if self.is_edge(dpid, p)]
+
+    def _tree(self, dst):
+        tree = self._trees.get(dst)
+        if tree is not None:
+            self.stats['hits'] += 1
+            return tree
+        self.stats['misses'] += 1
+        dist = {dst: 0}
+        next_hop = {}
+        frontier = collections.deque([dst])
+        while frontier:
+            node = frontier.popleft()
+            inbound = self.inbound.get(node, {})
+            for src in sorted(inbound):
+                if src not in dist:
+                    dist[src] = dist[node] + 1
+                    next_hop[src] = (node, min(inbound[src]))
+                    frontier.append(src)
+        tree = self._trees[dst] = (dist, next_hop)
+        return tree
+
+    def precompute(self):
+        for dpid in list(self.datapaths):
+            if dpid not in self._trees:
+                self._tree(dpid)
+
+    def next_hop(self, src_dpid, dst_dpid):
+        """Output port on src_dpid towards dst_dpid, None if unreachable."""
+        hop = self._tree(dst_dpid)[1].get(src_dpid)
+        return hop[1] if hop is not None else None
+
+    def path(self, src_dpid, dst_dpid):
+        """Switches from src_dpid to dst_dpid as (dpid, out_port) pairs.
+
+        The last switch is given without an output port, the caller knows
+        where the destination hangs off it. Returns None if unreachable.
+        """
+        next_hop = self._tree(dst_dpid)[1]
+        hops = []
+        dpid = src_dpid
+        while dpid != dst_dpid:
+            hop = next_hop.get(dpid)
+            if hop is None:
+                return None
+            hops.append((dpid, hop[1]))
+            dpid = hop[0]
+        hops.append((dst_dpid, None))
+        return hops